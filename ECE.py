@@ -2,10 +2,19 @@ import argparse
 import os
 import torch.nn
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset
 from transformers import BertTokenizer, BertForMaskedLM
+import sys
 import time
 import numpy as np
+import dist_utils
+import early_exit
+import autotune
+import corpus_bin
+import corpus_store
+import memtrack
+import profiling
+import score_store
 
 """setting agrparse"""
 parser = argparse.ArgumentParser(description='Training')
@@ -23,19 +32,40 @@ parser.add_argument('--scope', type=str, default='Ind_BiLSTM', help='scope')
 parser.add_argument('--batch_size', type=int, default=8, help='number of example per batch')
 parser.add_argument('--learning_rate', type=float, default=0.00001, help='learning rate')
 parser.add_argument('--weight_decay', type=float, default=0.01, help='weight decay for bert')
+parser.add_argument('--grad_accum_steps', type=int, default=1, help='number of batches per optimizer step')
+parser.add_argument('--gradient_checkpointing', type=bool, default=False,
+                    help='recompute bert activations in backward to save memory')
+parser.add_argument('--dist_backend', type=str, default='gloo', help='torch.distributed backend under torchrun')
 parser.add_argument('--usegpu', type=bool, default=True, help='gpu')
 """other"""
 parser.add_argument('--test_only', type=bool, default=True, help='no training')
 parser.add_argument('--checkpoint', type=bool, default=True, help='load checkpoint')
 parser.add_argument('--checkpointpath', type=str, default='checkpoint/ECE/', help='path to load checkpoint')
+parser.add_argument('--early_exit_path', type=str, default='', help='early exit heads for test_only, see early_exit.py')
+parser.add_argument('--exit_threshold', type=float, default=0.,
+                    help='confidence to stop at an exit head, 0: the calibrated one of --thresholds_file')
+parser.add_argument('--thresholds_file', type=str, default='early_exit_thresholds.json',
+                    help='thresholds of early_exit.py --mode calibrate, without one the heads keep their own')
+parser.add_argument('--dump_scores', type=str, default='', help='test_only: store mask scores, see score_store.py')
+parser.add_argument('--tuned_config', type=str, default='', help='batch size and threads from autotune.py')
+parser.add_argument('--profile_report', type=str, default='', help='stage timings to <path>.json/.csv')
+parser.add_argument('--profile_trace', type=str, default='', help='torch.profiler trace directory')
+parser.add_argument('--profile_window', type=str, default='5,2,5', help='traced steps: wait,warmup,active')
+parser.add_argument('--memory_report', type=str, default='', help='peak memory per fold and phase to <path>.json/.csv')
+parser.add_argument('--memory_budget_gb', type=float, default=0, help='warn when a phase would exceed it, 0 disables')
+parser.add_argument('--memory_top', type=int, default=10, help='largest live tensors listed per phase')
 parser.add_argument('--savecheckpoint', type=bool, default=False, help='save checkpoint')
 parser.add_argument('--save_path', type=str, default='prompt_ECE', help='path to save checkpoint')
 parser.add_argument('--device', type=str, default='2', help='device id')
 parser.add_argument('--dataset', type=str, default='data_combine_ECE/', help='path for dataset')
+parser.add_argument('--corpus_store', type=str, default='',
+                    help='corpus_store.py store, its fold views replace the fold files of --dataset')
 
 opt = parser.parse_args()
+autotune.apply(opt, opt.tuned_config, 'inference' if opt.test_only else 'train')
 os.environ["CUDA_VISIBLE_DEVICES"] = opt.device
 
+use_gpu = False
 if opt.usegpu and torch.cuda.is_available():
     use_gpu = True
 
@@ -54,15 +84,9 @@ class MyDataset(Dataset):
         self.test = test
         self.n_cut = 0
         self.tokenizer = tokenizer
-        inputFile = open(input_file, 'r')
-        while True:
-            line = inputFile.readline()
-            if line == '':
-                break
-            line = line.strip().split()
+        for line, pairs, part_sentence in corpus_bin.documents(input_file):
             self.doc_id.append(line[0])
             d_len = int(line[1])
-            pairs = eval('[' + inputFile.readline().strip() + ']')
             pos, cause = zip(*pairs)
 
             full_document = ""
@@ -70,14 +94,9 @@ class MyDataset(Dataset):
             mask_label_full_document = ""
             ECE_document = ""
             mask_label_ECE_document = ""
-            part_sentence = []
 
             cnt_cause_gt = 0
 
-            for _ in range(d_len):
-                words = inputFile.readline().strip().split(',')[-1]
-                part_sentence.append(words)
-
             cnt_cause_gt = len(set(cause))
 
             self.gt_cause.append(cnt_cause_gt)
@@ -156,6 +175,20 @@ class MyDataset(Dataset):
 
         self.index = [i for i in range(len(self.x_bert))]
 
+    @classmethod
+    def from_store(cls, store, view, tokenizer):
+        """the dataset of a fold view of a corpus_store.py store, only changed documents are tokenized again"""
+        print('load view {} of {}'.format(view, store.path))
+        self = cls.__new__(cls)
+        data = store.script_data('ECE', view, tokenizer)
+        self.doc_id = store.view(view)
+        self.tokenizer = tokenizer
+        self.x_bert, self.y_bert, self.label, self.mask_label = (data['train_ids'], data['y_bert'], data['label'],
+                                                                 data['mask_label'])
+        self.ECE, self.gt_cause = data['input_ids'], data['gt_cause']
+        self.index = [i for i in range(len(self.x_bert))]
+        return self
+
     def __getitem__(self, index):
         index = self.index[index]
         feed_list = [self.x_bert[index], self.y_bert[index], self.label[index], self.mask_label[index], self.ECE[index],
@@ -183,10 +216,12 @@ def print_training_info():
     print('\n\n>>>>>>>>>>>>>>>>>>>>TRAINING INFO:\n')
     print('batch-{}, lr-{}'.format(
         opt.batch_size, opt.learning_rate))
+    print('grad_accum_steps-{}, effective batch-{}, gradient_checkpointing-{}'.format(
+        opt.grad_accum_steps, opt.batch_size * opt.grad_accum_steps, opt.gradient_checkpointing))
     print('training_iter-{}\n'.format(opt.training_iter))
 
 
-def prf_prompt(logits, labels, x_bert, gt_cause):
+def prf_prompt(logits, labels, x_bert, gt_cause, distributed=False):
     cause_gt = torch.sum(gt_cause)
     cause_pre = 0
     cause_acc = 0
@@ -209,6 +244,8 @@ def prf_prompt(logits, labels, x_bert, gt_cause):
                 j = j + 1
             else:
                 j = j + 1
+    if distributed:
+        cause_gt, cause_pre, cause_acc = dist_utils.all_reduce_counts([cause_gt, cause_pre, cause_acc])
     p_cause = cause_acc / (cause_pre + 1e-8)
     r_cause = cause_acc / (cause_gt + 1e-8)
     f_cause = 2 * p_cause * r_cause / (p_cause + r_cause + 1e-8)
@@ -216,22 +253,104 @@ def prf_prompt(logits, labels, x_bert, gt_cause):
     return p_cause, r_cause, f_cause
 
 
+def train_epoch(model, optimizer, trainloader, prof, grad_accum_steps=1):
+    """one epoch of the training loop, with an optimizer step every grad_accum_steps batches"""
+    model.train()
+    optimizer.zero_grad()
+    for index, data in enumerate(prof.iterate(trainloader, 'train')):
+        update = (index + 1) % grad_accum_steps == 0 or index + 1 == len(trainloader)
+        # the last group of an epoch can be shorter than grad_accum_steps
+        group_start = index - index % grad_accum_steps
+        group_size = min(grad_accum_steps, len(trainloader) - group_start)
+        with torch.autograd.set_detect_anomaly(True), dist_utils.maybe_no_sync(model, update):
+            x_bert, y_bert, label, mask_label, ECE_x_bert, gt_cause = data
+            if use_gpu:
+                x_bert = x_bert.cuda()
+                y_bert = y_bert.cuda()
+                label = label.cuda()
+                mask_label = mask_label.cuda()
+                ECE_x_bert = ECE_x_bert.cuda()
+            prof.mark('to_device')
+            loss, logits = model(ECE_x_bert, mask_label)
+            prof.mark('forward')
+
+            if use_gpu:
+                loss = loss.cuda()
+            (loss / group_size).backward()
+            prof.mark('backward')
+            if update:
+                optimizer.step()
+                optimizer.zero_grad()
+            prof.mark('optimizer')
+
+            if not prof.enabled:
+                print("loss: {:.4f}".format(loss))
+            if index % 20 == 0:
+                logits = F.softmax(logits.detach(), dim=-1)
+                p_cause, r_cause, f_cause = prf_prompt(logits.cpu(), label.cpu(), ECE_x_bert.cpu(),
+                                                       gt_cause)
+                print(
+                    "iter: {} c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}".format(index, p_cause, r_cause, f_cause))
+            prof.mark('train_score')
+
+
+def test_pass(model, testloader, prof):
+    """the test loop: softmax logits and the columns of every test batch, concatenated on the cpu"""
+    all_test_logits = torch.tensor([])
+    all_test_label = torch.tensor([])
+    all_test_mask_label = torch.tensor([])
+    all_test_y_bert = torch.tensor([])
+    all_test_x_bert = torch.tensor([])
+    all_test_cause_gt = torch.tensor([])
+    model.eval()
+    with torch.no_grad():
+        for _, data in enumerate(prof.iterate(testloader, 'test')):
+            x_bert, y_bert, label, mask_label, ECE_x_bert, gt_cause = data
+            if use_gpu:
+                x_bert = x_bert.cuda()
+                y_bert = y_bert.cuda()
+                label = label.cuda()
+                mask_label = mask_label.cuda()
+                ECE_x_bert = ECE_x_bert.cuda()
+            prof.mark('to_device')
+            loss, logits = model(ECE_x_bert, label)
+            logits = F.softmax(logits, dim=-1)
+            prof.mark('forward')
+            all_test_label = torch.cat((all_test_label, label.cpu()), 0)
+            all_test_mask_label = torch.cat((all_test_mask_label, mask_label.cpu()), 0)
+            all_test_logits = torch.cat((all_test_logits, logits.cpu()), 0)
+            all_test_y_bert = torch.cat((all_test_y_bert, y_bert.cpu()), 0)
+            all_test_x_bert = torch.cat((all_test_x_bert, ECE_x_bert.cpu()), 0)
+            all_test_cause_gt = torch.cat((all_test_cause_gt, gt_cause), 0)
+            prof.mark('cpu_copy')
+    return all_test_logits, all_test_label, all_test_mask_label, all_test_y_bert, all_test_x_bert, all_test_cause_gt
+
+
 def run():
+    rank, world_size = dist_utils.init_distributed(opt.dist_backend)
+    prof = profiling.StageProfiler(opt.profile_report, opt.profile_trace, opt.profile_window, rank)
+    mem = memtrack.MemoryTracker(opt.memory_report, opt.memory_budget_gb, opt.memory_top, rank)
+    if rank != 0:
+        sys.stdout = open(os.devnull, 'w')
     if opt.log_file_name:
         save_path = opt.save_path
 
         if not os.path.exists(save_path):
-            os.makedirs(save_path)
+            os.makedirs(save_path, exist_ok=True)
         # sys.stdout = open(save_path + '/' + opt.log_file_name, 'w')
 
     print_time()
     bert_path = './bert-base-chinese'
     tokenizer = BertTokenizer.from_pretrained(bert_path)
+    store = corpus_store.CorpusStore(opt.corpus_store) if opt.corpus_store else None
 
     # train
     print_training_info()  # 输出训练的超参数信息
     max_result_cause_f, max_result_cause_r, max_result_cause_p = [], [], []
     for fold in range(1, 11):
+        prof.set_fold(fold)
+        mem.set_fold(fold)
+        mem.phase('build')
         # model
         print('build model..')
         model = prompt_bert(bert_path)
@@ -241,6 +360,9 @@ def run():
                                map_location=torch.device('cpu'))
         if use_gpu:
             model = model.cuda()
+        if opt.gradient_checkpointing:
+            model.bert.gradient_checkpointing_enable()
+        model = dist_utils.wrap_model(model)
 
         train_file_name = 'fold{}_train.txt'.format(fold)
         test_file_name = 'fold{}_test.txt'.format(fold)
@@ -248,116 +370,70 @@ def run():
         train = opt.dataset + train_file_name
         test = opt.dataset + test_file_name
         edict = {"train": train, "test": test}
-        NLP_Dataset = {x: MyDataset(edict[x], tokenizer=tokenizer) for x in ['train', 'test']}
-        trainloader = DataLoader(NLP_Dataset['train'], batch_size=opt.batch_size, shuffle=True, drop_last=True)
-        testloader = DataLoader(NLP_Dataset['test'], batch_size=opt.batch_size, shuffle=False)
+        if store is not None:
+            NLP_Dataset = {x: MyDataset.from_store(store, 'fold{}_{}'.format(fold, x), tokenizer)
+                           for x in ['train', 'test']}
+        else:
+            NLP_Dataset = {x: MyDataset(edict[x], tokenizer=tokenizer) for x in ['train', 'test']}
+        trainloader = dist_utils.train_loader(NLP_Dataset['train'], opt.batch_size, rank, world_size)
+        testloader = dist_utils.test_loader(NLP_Dataset['test'], opt.batch_size, rank, world_size)
 
         max_p_emotion, max_r_emotion, max_f1_emotion, max_p_cause, max_r_cause, max_f1_cause, max_p_pair, max_r_pair,\
         max_f1_pair = [-1.] * 9
         optimizer = torch.optim.AdamW(model.parameters(), lr=opt.learning_rate, weight_decay=opt.weight_decay)
         if opt.test_only:
-            all_test_logits = torch.tensor([])
-            all_test_label = torch.tensor([])
-            all_test_mask_label = torch.tensor([])
-            all_test_y_bert = torch.tensor([])
-            all_test_x_bert = torch.tensor([])
-            all_test_cause_gt = torch.tensor([])
-            model.eval()
-            with torch.no_grad():
-                for _, data in enumerate(testloader):
-                    x_bert, y_bert, label, mask_label, ECE_x_bert, gt_cause = data
-                    if use_gpu:
-                        x_bert = x_bert.cuda()
-                        y_bert = y_bert.cuda()
-                        label = label.cuda()
-                        mask_label = mask_label.cuda()
-                        ECE_x_bert = ECE_x_bert.cuda()
-                    loss, logits = model(ECE_x_bert, label)
-                    logits = F.softmax(logits, dim=-1)
-                    all_test_label = torch.cat((all_test_label, label.cpu()), 0)
-                    all_test_mask_label = torch.cat((all_test_mask_label, mask_label.cpu()), 0)
-                    all_test_logits = torch.cat((all_test_logits, logits.cpu()), 0)
-                    all_test_y_bert = torch.cat((all_test_y_bert, y_bert.cpu()), 0)
-                    all_test_x_bert = torch.cat((all_test_x_bert, ECE_x_bert.cpu()), 0)
-                    all_test_cause_gt = torch.cat((all_test_cause_gt, gt_cause), 0)
-
+            if opt.early_exit_path:
+                model = early_exit.attach(dist_utils.unwrap_model(model),
+                                          opt.early_exit_path + '/fold{}.pth'.format(fold),
+                                          early_exit.calibrated_threshold('ECE', opt.thresholds_file,
+                                                                          opt.exit_threshold))
+            mem.phase('test', memtrack.test_buffer_bytes(len(testloader.dataset)))
+            all_test_logits, all_test_label, all_test_mask_label, all_test_y_bert, all_test_x_bert, \
+                all_test_cause_gt = test_pass(model, testloader, prof)
+            p_cause, r_cause, f_cause = prf_prompt(all_test_logits, all_test_label, all_test_x_bert,
+                                                   all_test_cause_gt, distributed=world_size > 1)
+            prof.mark('score')
+            if opt.dump_scores and world_size == 1:
+                score_store.write_fold(opt.dump_scores, fold, 'ECE', all_test_logits, all_test_x_bert,
+                                       all_test_label, {'gt_cause': all_test_cause_gt},
+                                       checkpoint=opt.checkpointpath + '/fold{}.pth'.format(fold),
+                                       test_file=test)
+            print("c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}".format(p_cause, r_cause, f_cause))
+            if f_cause > max_f1_cause:
+                max_p_cause, max_r_cause, max_f1_cause = p_cause, r_cause, f_cause
+            print(
+                "max result---- c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}".format(max_p_cause, max_r_cause, max_f1_cause))
+        else:
+            for i in range(opt.training_iter):
+                mem.phase('train')
+                dist_utils.set_epoch(trainloader, i)
+                train_epoch(model, optimizer, trainloader, prof, opt.grad_accum_steps)
+                mem.phase('test', memtrack.test_buffer_bytes(len(testloader.dataset)))
+                all_test_logits, all_test_label, all_test_mask_label, all_test_y_bert, all_test_x_bert, \
+                    all_test_cause_gt = test_pass(model, testloader, prof)
                 p_cause, r_cause, f_cause = prf_prompt(all_test_logits, all_test_label, all_test_x_bert,
-                                                       all_test_cause_gt)
+                                                       all_test_cause_gt, distributed=world_size > 1)
+                prof.mark('score')
+                print("iter{} test result:".format(i))
                 print("c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}".format(p_cause, r_cause, f_cause))
+
                 if f_cause > max_f1_cause:
                     max_p_cause, max_r_cause, max_f1_cause = p_cause, r_cause, f_cause
+                    if opt.savecheckpoint and rank == 0:
+                        torch.save(dist_utils.unwrap_model(model), save_path + '/' + 'fold{}.pth'.format(fold))
+                print("iter{} test result:".format(i))
                 print(
-                    "max result---- c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}".format(max_p_cause, max_r_cause, max_f1_cause))
-        else:
-            for i in range(opt.training_iter):
-                model.train()
-                start_time, step = time.time(), 1
-                for index, data in enumerate(trainloader):
-                    with torch.autograd.set_detect_anomaly(True):
-                        x_bert, y_bert, label, mask_label, ECE_x_bert, gt_cause = data
-                        if use_gpu:
-                            x_bert = x_bert.cuda()
-                            y_bert = y_bert.cuda()
-                            label = label.cuda()
-                            mask_label = mask_label.cuda()
-                            ECE_x_bert = ECE_x_bert.cuda()
-                        loss, logits = model(ECE_x_bert, mask_label)
-                        logits = F.softmax(logits, dim=-1)
-
-                        optimizer.zero_grad()
-                        if use_gpu:
-                            loss = loss.cuda()
-                        loss.backward()
-                        optimizer.step()
-
-                        print("loss: {:.4f}".format(loss))
-                        if index % 20 == 0:
-                            p_cause, r_cause, f_cause = prf_prompt(logits.cpu(), label.cpu(), ECE_x_bert.cpu(),
-                                                                   gt_cause)
-                            print(
-                                "iter: {} c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}".format(index, p_cause, r_cause, f_cause))
-                all_test_logits = torch.tensor([])
-                all_test_label = torch.tensor([])
-                all_test_mask_label = torch.tensor([])
-                all_test_y_bert = torch.tensor([])
-                all_test_x_bert = torch.tensor([])
-                all_test_cause_gt = torch.tensor([])
-
-                model.eval()
-                with torch.no_grad():
-                    for _, data in enumerate(testloader):
-                        x_bert, y_bert, label, mask_label, ECE_x_bert, gt_cause = data
-                        if use_gpu:
-                            x_bert = x_bert.cuda()
-                            y_bert = y_bert.cuda()
-                            label = label.cuda()
-                            mask_label = mask_label.cuda()
-                            ECE_x_bert = ECE_x_bert.cuda()
-                        loss, logits = model(ECE_x_bert, label)
-                        logits = F.softmax(logits, dim=-1)
-                        all_test_label = torch.cat((all_test_label, label.cpu()), 0)
-                        all_test_mask_label = torch.cat((all_test_mask_label, mask_label.cpu()), 0)
-                        all_test_logits = torch.cat((all_test_logits, logits.cpu()), 0)
-                        all_test_y_bert = torch.cat((all_test_y_bert, y_bert.cpu()), 0)
-                        all_test_x_bert = torch.cat((all_test_x_bert, ECE_x_bert.cpu()), 0)
-                        all_test_cause_gt = torch.cat((all_test_cause_gt, gt_cause), 0)
-
-                    p_cause, r_cause, f_cause = prf_prompt(all_test_logits, all_test_label, all_test_x_bert,
-                                                           all_test_cause_gt)
-                    print("iter{} test result:".format(i))
-                    print("c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}".format(p_cause, r_cause, f_cause))
-
-                    if f_cause > max_f1_cause:
-                        max_p_cause, max_r_cause, max_f1_cause = p_cause, r_cause, f_cause
-                        if opt.savecheckpoint:
-                            torch.save(model, save_path + '/' + 'fold{}.pth'.format(fold))
-                    print("iter{} test result:".format(i))
-                    print(
-                        "max result---- c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}".format(max_p_cause, max_r_cause,
-                                                                                    max_f1_cause))
+                    "max result---- c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}".format(max_p_cause, max_r_cause,
+                                                                                max_f1_cause))
         max_result_cause_f.append(max_f1_cause)
         max_result_cause_p.append(max_p_cause)
         max_result_cause_r.append(max_r_cause)
+        prof.write()
+        # drop the model, data and test buffers of this fold before the next one is built
+        model = optimizer = NLP_Dataset = trainloader = testloader = None
+        all_test_logits = all_test_label = all_test_mask_label = all_test_y_bert = all_test_x_bert = None
+        all_test_cause_gt = None
+        mem.end_fold()
 
     print("cause")
     print(max_result_cause_f)
@@ -366,6 +442,7 @@ def run():
     print("average p {:.4f}".format(sum(max_result_cause_p) / len(max_result_cause_p)))
     print(max_result_cause_r)
     print("average r {:.4f}".format(sum(max_result_cause_r) / len(max_result_cause_r)))
+    dist_utils.cleanup()
 
 
 if __name__ == '__main__':
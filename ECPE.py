@@ -2,10 +2,19 @@ import argparse
 import os
 import torch.nn
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset
 from transformers import BertTokenizer, BertForMaskedLM
+import sys
 import time
 import numpy as np
+import dist_utils
+import early_exit
+import autotune
+import corpus_bin
+import corpus_store
+import memtrack
+import profiling
+import score_store
 
 """setting agrparse"""
 parser = argparse.ArgumentParser(description='Training')
@@ -23,19 +32,40 @@ parser.add_argument('--scope', type=str, default='Ind_BiLSTM', help='scope')
 parser.add_argument('--batch_size', type=int, default=8, help='number of example per batch')
 parser.add_argument('--learning_rate', type=float, default=0.00001, help='learning rate')
 parser.add_argument('--weight_decay', type=float, default=0.01, help='weight decay for bert')
+parser.add_argument('--grad_accum_steps', type=int, default=1, help='number of batches per optimizer step')
+parser.add_argument('--gradient_checkpointing', type=bool, default=False,
+                    help='recompute bert activations in backward to save memory')
+parser.add_argument('--dist_backend', type=str, default='gloo', help='torch.distributed backend under torchrun')
 parser.add_argument('--usegpu', type=bool, default=True, help='gpu')
 """other"""
 parser.add_argument('--test_only', type=bool, default=False, help='no training')
 parser.add_argument('--checkpoint', type=bool, default=False, help='load checkpoint')
 parser.add_argument('--checkpointpath', type=str, default='checkpoint/ECPE/', help='path to load checkpoint')
+parser.add_argument('--early_exit_path', type=str, default='', help='early exit heads for test_only, see early_exit.py')
+parser.add_argument('--exit_threshold', type=float, default=0.,
+                    help='confidence to stop at an exit head, 0: the calibrated one of --thresholds_file')
+parser.add_argument('--thresholds_file', type=str, default='early_exit_thresholds.json',
+                    help='thresholds of early_exit.py --mode calibrate, without one the heads keep their own')
+parser.add_argument('--dump_scores', type=str, default='', help='test_only: store mask scores, see score_store.py')
+parser.add_argument('--tuned_config', type=str, default='', help='batch size and threads from autotune.py')
+parser.add_argument('--profile_report', type=str, default='', help='stage timings to <path>.json/.csv')
+parser.add_argument('--profile_trace', type=str, default='', help='torch.profiler trace directory')
+parser.add_argument('--profile_window', type=str, default='5,2,5', help='traced steps: wait,warmup,active')
+parser.add_argument('--memory_report', type=str, default='', help='peak memory per fold and phase to <path>.json/.csv')
+parser.add_argument('--memory_budget_gb', type=float, default=0, help='warn when a phase would exceed it, 0 disables')
+parser.add_argument('--memory_top', type=int, default=10, help='largest live tensors listed per phase')
 parser.add_argument('--savecheckpoint', type=bool, default=False, help='save checkpoint')
 parser.add_argument('--save_path', type=str, default='prompt_ECPE', help='path to save checkpoint')
 parser.add_argument('--device', type=str, default='2', help='device id')
 parser.add_argument('--dataset', type=str, default='data_combine_ECPE/', help='path for dataset')
+parser.add_argument('--corpus_store', type=str, default='',
+                    help='corpus_store.py store, its fold views replace the fold files of --dataset')
 
 opt = parser.parse_args()
+autotune.apply(opt, opt.tuned_config, 'inference' if opt.test_only else 'train')
 os.environ["CUDA_VISIBLE_DEVICES"] = opt.device
 
+use_gpu = False
 if opt.usegpu and torch.cuda.is_available():
     use_gpu = True
 
@@ -54,28 +84,18 @@ class MyDataset(Dataset):
         self.n_cut = 0
         self.tokenizer = tokenizer
         cnt_over_limit = 0
-        inputFile = open(input_file, 'r')
-        while True:
-            line = inputFile.readline()
-            if line == '':
-                break
-            line = line.strip().split()
+        for line, pairs, part_sentence in corpus_bin.documents(input_file):
             self.doc_id.append(line[0])
             d_len = int(line[1])
-            pairs = eval('[' + inputFile.readline().strip() + ']')
             pos, cause = zip(*pairs)
 
             full_document = ""
             mask_full_document = ""
             mask_label_full_document = ""
-            part_sentence = []
             cnt_emotion_gt = 0
             cnt_cause_gt = 0
             cnt_pair_gt = 0
 
-            for _ in range(d_len):
-                words = inputFile.readline().strip().split(',')[-1]
-                part_sentence.append(words)
             cnt_emotion_gt = len(set(pos))
             cnt_cause_gt = len(set(cause))
             cnt_pair_gt = len(set(pairs))
@@ -143,6 +163,20 @@ class MyDataset(Dataset):
         self.index = [i for i in range(len(self.x_bert))]
         print("num_for_over_limit{}".format(cnt_over_limit))
 
+    @classmethod
+    def from_store(cls, store, view, tokenizer):
+        """the dataset of a fold view of a corpus_store.py store, only changed documents are tokenized again"""
+        print('load view {} of {}'.format(view, store.path))
+        self = cls.__new__(cls)
+        data = store.script_data('ECPE', view, tokenizer)
+        self.doc_id = store.view(view)
+        self.tokenizer = tokenizer
+        self.x_bert, self.y_bert, self.label, self.mask_label = (data['input_ids'], data['y_bert'], data['label'],
+                                                                 data['mask_label'])
+        self.gt_emotion, self.gt_cause, self.gt_pair = data['gt_emotion'], data['gt_cause'], data['gt_pair']
+        self.index = [i for i in range(len(self.x_bert))]
+        return self
+
     def __getitem__(self, index):
         index = self.index[index]
         feed_list = [self.x_bert[index], self.y_bert[index], self.label[index], self.mask_label[index],
@@ -170,10 +204,12 @@ def print_training_info():
     print('\n\n>>>>>>>>>>>>>>>>>>>>TRAINING INFO:\n')
     print('batch-{}, lr-{}'.format(
         opt.batch_size, opt.learning_rate))
+    print('grad_accum_steps-{}, effective batch-{}, gradient_checkpointing-{}'.format(
+        opt.grad_accum_steps, opt.batch_size * opt.grad_accum_steps, opt.gradient_checkpointing))
     print('training_iter-{}\n'.format(opt.training_iter))
 
 
-def crf_prompt(logits, labels, x_bert, gt_emotion, gt_cause, gt_pair):
+def crf_prompt(logits, labels, x_bert, gt_emotion, gt_cause, gt_pair, distributed=False):
     label_index = [122, 123, 124, 125, 126, 127, 128, 129, 130, 8108, 8111, 8110, 8124, 8122, 8115, 8121, 8126, 8123,
                    8131, 8113, 8128, 8130, 8133, 8125, 8132, 8153, 8149, 8143, 8162, 8114, 8176, 8211, 8226, 8229, 8198,
                    8216, 8234, 8218, 8240, 8164, 8245, 8239, 8250, 8252, 8208, 8248, 8264, 8214, 8249, 8145, 8246, 8247,
@@ -229,6 +265,10 @@ def crf_prompt(logits, labels, x_bert, gt_emotion, gt_cause, gt_pair):
                 j = j + 1
             else:
                 j = j + 1
+    if distributed:
+        emo_gt, emo_pre, emo_acc, cause_gt, cause_pre, cause_acc, pair_gt, pair_pre, pair_acc = \
+            dist_utils.all_reduce_counts([emo_gt, emo_pre, emo_acc, cause_gt, cause_pre, cause_acc, pair_gt,
+                                          pair_pre, pair_acc])
     p_emotion = emo_acc / (emo_pre + 1e-8)
     p_cause = cause_acc / (cause_pre + 1e-8)
     p_pair = pair_acc / (pair_pre + 1e-8)
@@ -242,17 +282,110 @@ def crf_prompt(logits, labels, x_bert, gt_emotion, gt_cause, gt_pair):
     return p_emotion, r_emotion, f_emotion, p_cause, r_cause, f_cause, p_pair, r_pair, f_pair
 
 
+def train_epoch(model, optimizer, trainloader, prof, grad_accum_steps=1):
+    """one epoch of the training loop, with an optimizer step every grad_accum_steps batches"""
+    model.train()
+    optimizer.zero_grad()
+    for index, data in enumerate(prof.iterate(trainloader, 'train')):
+        update = (index + 1) % grad_accum_steps == 0 or index + 1 == len(trainloader)
+        # the last group of an epoch can be shorter than grad_accum_steps
+        group_start = index - index % grad_accum_steps
+        group_size = min(grad_accum_steps, len(trainloader) - group_start)
+        with torch.autograd.set_detect_anomaly(True), dist_utils.maybe_no_sync(model, update):
+            x_bert, y_bert, label, mask_label, gt_emotion, gt_cause, gt_pair = data
+            if use_gpu:
+                x_bert = x_bert.cuda()
+                y_bert = y_bert.cuda()
+                label = label.cuda()
+                mask_label = mask_label.cuda()
+            prof.mark('to_device')
+            loss, logits = model(x_bert, mask_label)
+            prof.mark('forward')
+
+            if use_gpu:
+                loss = loss.cuda()
+            (loss / group_size).backward()
+            prof.mark('backward')
+            if update:
+                optimizer.step()
+                optimizer.zero_grad()
+            prof.mark('optimizer')
+
+            if not prof.enabled:
+                print("loss: {:.4f}".format(loss))
+            if index % 20 == 0:
+                logits = F.softmax(logits.detach(), dim=-1)
+                p_emotion, r_emotion, f_emotion, p_cause, r_cause, f_cause, p_pair, r_pair, f_pair = \
+                    crf_prompt(logits.cpu(), label.cpu(), x_bert.cpu(), gt_emotion, gt_cause, gt_pair)
+                print(
+                    "iter: {} e_p: {:.4f} e_r: {:.4f} e_f: {:.4f} c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}"
+                    " pair_p: {:.4f} pair_r: {:.4f} pair_f: {:.4f}".format(
+                        index,
+                        p_emotion,
+                        r_emotion,
+                        f_emotion,
+                        p_cause,
+                        r_cause,
+                        f_cause,
+                        p_pair,
+                        r_pair,
+                        f_pair))
+            prof.mark('train_score')
+
+
+def test_pass(model, testloader, prof):
+    """the test loop: softmax logits and the columns of every test batch, concatenated on the cpu"""
+    all_test_logits = torch.tensor([])
+    all_test_label = torch.tensor([])
+    all_test_mask_label = torch.tensor([])
+    all_test_y_bert = torch.tensor([])
+    all_test_x_bert = torch.tensor([])
+    all_test_emotion_gt = torch.tensor([])
+    all_test_cause_gt = torch.tensor([])
+    all_test_pair_gt = torch.tensor([])
+    model.eval()
+    with torch.no_grad():
+        for _, data in enumerate(prof.iterate(testloader, 'test')):
+            x_bert, y_bert, label, mask_label, gt_emotion, gt_cause, gt_pair = data
+            if use_gpu:
+                x_bert = x_bert.cuda()
+                y_bert = y_bert.cuda()
+                label = label.cuda()
+                mask_label = mask_label.cuda()
+            prof.mark('to_device')
+            loss, logits = model(x_bert, label)
+            logits = F.softmax(logits, dim=-1)
+            prof.mark('forward')
+            all_test_label = torch.cat((all_test_label, label.cpu()), 0)
+            all_test_mask_label = torch.cat((all_test_mask_label, mask_label.cpu()), 0)
+            all_test_logits = torch.cat((all_test_logits, logits.cpu()), 0)
+            all_test_y_bert = torch.cat((all_test_y_bert, y_bert.cpu()), 0)
+            all_test_x_bert = torch.cat((all_test_x_bert, x_bert.cpu()), 0)
+            all_test_emotion_gt = torch.cat((all_test_emotion_gt, gt_emotion), 0)
+            all_test_cause_gt = torch.cat((all_test_cause_gt, gt_cause), 0)
+            all_test_pair_gt = torch.cat((all_test_pair_gt, gt_pair), 0)
+            prof.mark('cpu_copy')
+    return all_test_logits, all_test_label, all_test_mask_label, all_test_y_bert, all_test_x_bert, \
+        all_test_emotion_gt, all_test_cause_gt, all_test_pair_gt
+
+
 def run():
+    rank, world_size = dist_utils.init_distributed(opt.dist_backend)
+    prof = profiling.StageProfiler(opt.profile_report, opt.profile_trace, opt.profile_window, rank)
+    mem = memtrack.MemoryTracker(opt.memory_report, opt.memory_budget_gb, opt.memory_top, rank)
+    if rank != 0:
+        sys.stdout = open(os.devnull, 'w')
     if opt.log_file_name:
         save_path = opt.save_path
 
         if not os.path.exists(save_path):
-            os.makedirs(save_path)
+            os.makedirs(save_path, exist_ok=True)
         # sys.stdout = open(save_path + '/' + opt.log_file_name, 'w')
 
     print_time()
     bert_path = './bert-base-chinese'
     tokenizer = BertTokenizer.from_pretrained(bert_path)
+    store = corpus_store.CorpusStore(opt.corpus_store) if opt.corpus_store else None
 
     # train
     print_training_info()  # 输出训练的超参数信息
@@ -261,6 +394,9 @@ def run():
     max_result_pair_f, max_result_pair_p, max_result_pair_r = [], [], []
     max_result_cause_f, max_result_cause_p, max_result_cause_r = [], [], []
     for fold in range(1, 11):
+        prof.set_fold(fold)
+        mem.set_fold(fold)
+        mem.phase('build')
         # model
         print('build model..')
         model = prompt_bert(bert_path)
@@ -270,6 +406,9 @@ def run():
                                map_location=torch.device('cpu'))
         if use_gpu:
             model = model.cuda()
+        if opt.gradient_checkpointing:
+            model.bert.gradient_checkpointing_enable()
+        model = dist_utils.wrap_model(model)
 
         train_file_name = 'fold{}_train.txt'.format(fold)
         test_file_name = 'fold{}_test.txt'.format(fold)
@@ -277,48 +416,78 @@ def run():
         train = opt.dataset + train_file_name
         test = opt.dataset + test_file_name
         edict = {"train": train, "test": test}
-        NLP_Dataset = {x: MyDataset(edict[x], test=(x == 'test'), tokenizer=tokenizer) for x in ['train', 'test']}
-        trainloader = DataLoader(NLP_Dataset['train'], batch_size=opt.batch_size, shuffle=True, drop_last=True)
-        testloader = DataLoader(NLP_Dataset['test'], batch_size=opt.batch_size, shuffle=False)
+        if store is not None:
+            NLP_Dataset = {x: MyDataset.from_store(store, 'fold{}_{}'.format(fold, x), tokenizer)
+                           for x in ['train', 'test']}
+        else:
+            NLP_Dataset = {x: MyDataset(edict[x], test=(x == 'test'), tokenizer=tokenizer) for x in ['train', 'test']}
+        trainloader = dist_utils.train_loader(NLP_Dataset['train'], opt.batch_size, rank, world_size)
+        testloader = dist_utils.test_loader(NLP_Dataset['test'], opt.batch_size, rank, world_size)
 
         max_p_emotion, max_r_emotion, max_f1_emotion, max_p_cause, max_r_cause, max_f1_cause, max_p_pair,\
         max_r_pair, max_f1_pair = [-1.] * 9
         optimizer = torch.optim.AdamW(model.parameters(), lr=opt.learning_rate, weight_decay=opt.weight_decay)
         if opt.test_only:
-            all_test_logits = torch.tensor([])
-            all_test_label = torch.tensor([])
-            all_test_mask_label = torch.tensor([])
-            all_test_y_bert = torch.tensor([])
-            all_test_x_bert = torch.tensor([])
-            all_test_emotion_gt = torch.tensor([])
-            all_test_cause_gt = torch.tensor([])
-            all_test_pair_gt = torch.tensor([])
-            model.eval()
-            with torch.no_grad():
-                for _, data in enumerate(testloader):
-                    x_bert, y_bert, label, mask_label, gt_emotion, gt_cause, gt_pair = data
-                    if use_gpu:
-                        x_bert = x_bert.cuda()
-                        y_bert = y_bert.cuda()
-                        label = label.cuda()
-                        mask_label = mask_label.cuda()
-                    loss, logits = model(x_bert, label)
-                    logits = F.softmax(logits, dim=-1)
-                    all_test_label = torch.cat((all_test_label, label.cpu()), 0)
-                    all_test_mask_label = torch.cat((all_test_mask_label, mask_label.cpu()), 0)
-                    all_test_logits = torch.cat((all_test_logits, logits.cpu()), 0)
-                    all_test_y_bert = torch.cat((all_test_y_bert, y_bert.cpu()), 0)
-                    all_test_x_bert = torch.cat((all_test_x_bert, x_bert.cpu()), 0)
-                    all_test_emotion_gt = torch.cat((all_test_emotion_gt, gt_emotion), 0)
-                    all_test_cause_gt = torch.cat((all_test_cause_gt, gt_cause), 0)
-                    all_test_pair_gt = torch.cat((all_test_pair_gt, gt_pair), 0)
+            if opt.early_exit_path:
+                model = early_exit.attach(dist_utils.unwrap_model(model),
+                                          opt.early_exit_path + '/fold{}.pth'.format(fold),
+                                          early_exit.calibrated_threshold('ECPE', opt.thresholds_file,
+                                                                          opt.exit_threshold))
+            mem.phase('test', memtrack.test_buffer_bytes(len(testloader.dataset)))
+            all_test_logits, all_test_label, all_test_mask_label, all_test_y_bert, all_test_x_bert, \
+                all_test_emotion_gt, all_test_cause_gt, all_test_pair_gt = test_pass(model, testloader, prof)
+            p_emotion, r_emotion, f_emotion, p_cause, r_cause, f_cause, p_pair, r_pair, f_pair = crf_prompt(
+                all_test_logits, all_test_label, all_test_x_bert, all_test_emotion_gt, all_test_cause_gt,
+                all_test_pair_gt, distributed=world_size > 1)
+            prof.mark('score')
+            if opt.dump_scores and world_size == 1:
+                score_store.write_fold(opt.dump_scores, fold, 'ECPE', all_test_logits, all_test_x_bert,
+                                       all_test_label, {'gt_emotion': all_test_emotion_gt,
+                                                        'gt_cause': all_test_cause_gt,
+                                                        'gt_pair': all_test_pair_gt},
+                                       checkpoint=opt.checkpointpath + '/fold{}.pth'.format(fold),
+                                       test_file=test)
+            print(
+                "e_p: {:.4f} e_r: {:.4f} e_f: {:.4f} c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}"
+                " pair_p: {:.4f} pair_r: {:.4f} pair_f: {:.4f}".format(
+                    p_emotion,
+                    r_emotion,
+                    f_emotion,
+                    p_cause,
+                    r_cause,
+                    f_cause,
+                    p_pair,
+                    r_pair,
+                    f_pair))
+            if f_emotion > max_f1_emotion:
+                max_f1_emotion, max_p_emotion, max_r_emotion = f_emotion, p_emotion, r_emotion
+            if f_cause > max_f1_cause:
+                max_f1_cause, max_p_cause, max_r_cause = f_cause, p_cause, r_cause
+            if f_pair > max_f1_pair:
+                max_f1_pair, max_p_pair, max_r_pair = f_pair, p_pair, r_pair
+
+            print(
+                "max result---- e_p: {:.4f} e_r: {:.4f} e_f: {:.4f} c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}"
+                " pair_p: {:.4f} pair_r: {:.4f} pair_f: {:.4f}".format(
+                    max_p_emotion, max_r_emotion, max_f1_emotion, max_p_cause, max_r_cause, max_f1_cause,
+                    max_p_pair, max_r_pair, max_f1_pair))
 
+        else:
+            for i in range(opt.training_iter):
+                mem.phase('train')
+                dist_utils.set_epoch(trainloader, i)
+                train_epoch(model, optimizer, trainloader, prof, opt.grad_accum_steps)
+                mem.phase('test', memtrack.test_buffer_bytes(len(testloader.dataset)))
+                all_test_logits, all_test_label, all_test_mask_label, all_test_y_bert, all_test_x_bert, \
+                    all_test_emotion_gt, all_test_cause_gt, all_test_pair_gt = test_pass(model, testloader, prof)
                 p_emotion, r_emotion, f_emotion, p_cause, r_cause, f_cause, p_pair, r_pair, f_pair = crf_prompt(
                     all_test_logits, all_test_label, all_test_x_bert, all_test_emotion_gt, all_test_cause_gt,
-                    all_test_pair_gt)
+                    all_test_pair_gt, distributed=world_size > 1)
+                prof.mark('score')
+                print("iter{} test result:".format(i))
                 print(
-                    "e_p: {:.4f} e_r: {:.4f} e_f: {:.4f} c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}"
-                    " pair_p: {:.4f} pair_r: {:.4f} pair_f: {:.4f}".format(
+                    "e_p: {:.4f} e_r: {:.4f} e_f: {:.4f} c_p: {:.4f} c_r: {:.4f} c_f: {:.4f} pair_p: {:.4f}"
+                    " pair_r: {:.4f} pair_f: {:.4f}".format(
                         p_emotion,
                         r_emotion,
                         f_emotion,
@@ -334,111 +503,15 @@ def run():
                     max_f1_cause, max_p_cause, max_r_cause = f_cause, p_cause, r_cause
                 if f_pair > max_f1_pair:
                     max_f1_pair, max_p_pair, max_r_pair = f_pair, p_pair, r_pair
+                    if opt.savecheckpoint and rank == 0:
+                        torch.save(dist_utils.unwrap_model(model), save_path + '/' + 'fold{}.pth'.format(fold))
 
+                print("iter{} test result:".format(i))
                 print(
                     "max result---- e_p: {:.4f} e_r: {:.4f} e_f: {:.4f} c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}"
                     " pair_p: {:.4f} pair_r: {:.4f} pair_f: {:.4f}".format(
                         max_p_emotion, max_r_emotion, max_f1_emotion, max_p_cause, max_r_cause, max_f1_cause,
                         max_p_pair, max_r_pair, max_f1_pair))
-
-        else:
-            for i in range(opt.training_iter):
-                model.train()
-                start_time, step = time.time(), 1
-                for index, data in enumerate(trainloader):
-                    with torch.autograd.set_detect_anomaly(True):
-                        x_bert, y_bert, label, mask_label, gt_emotion, gt_cause, gt_pair = data
-                        if use_gpu:
-                            x_bert = x_bert.cuda()
-                            y_bert = y_bert.cuda()
-                            label = label.cuda()
-                            mask_label = mask_label.cuda()
-                        loss, logits = model(x_bert, mask_label)
-                        logits = F.softmax(logits, dim=-1)
-
-                        optimizer.zero_grad()
-                        if use_gpu:
-                            loss = loss.cuda()
-                        loss.backward()
-                        optimizer.step()
-
-                        print("loss: {:.4f}".format(loss))
-                        if index % 20 == 0:
-                            p_emotion, r_emotion, f_emotion, p_cause, r_cause, f_cause, p_pair, r_pair, f_pair = \
-                                crf_prompt(logits.cpu(), label.cpu(), x_bert.cpu(), gt_emotion, gt_cause, gt_pair)
-                            print(
-                                "iter: {} e_p: {:.4f} e_r: {:.4f} e_f: {:.4f} c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}"
-                                " pair_p: {:.4f} pair_r: {:.4f} pair_f: {:.4f}".format(
-                                    index,
-                                    p_emotion,
-                                    r_emotion,
-                                    f_emotion,
-                                    p_cause,
-                                    r_cause,
-                                    f_cause,
-                                    p_pair,
-                                    r_pair,
-                                    f_pair))
-                all_test_logits = torch.tensor([])
-                all_test_label = torch.tensor([])
-                all_test_mask_label = torch.tensor([])
-                all_test_y_bert = torch.tensor([])
-                all_test_x_bert = torch.tensor([])
-                all_test_emotion_gt = torch.tensor([])
-                all_test_cause_gt = torch.tensor([])
-                all_test_pair_gt = torch.tensor([])
-
-                model.eval()
-                with torch.no_grad():
-                    for _, data in enumerate(testloader):
-                        x_bert, y_bert, label, mask_label, gt_emotion, gt_cause, gt_pair = data
-                        if use_gpu:
-                            x_bert = x_bert.cuda()
-                            y_bert = y_bert.cuda()
-                            label = label.cuda()
-                            mask_label = mask_label.cuda()
-                        loss, logits = model(x_bert, label)
-                        logits = F.softmax(logits, dim=-1)
-                        all_test_label = torch.cat((all_test_label, label.cpu()), 0)
-                        all_test_mask_label = torch.cat((all_test_mask_label, mask_label.cpu()), 0)
-                        all_test_logits = torch.cat((all_test_logits, logits.cpu()), 0)
-                        all_test_y_bert = torch.cat((all_test_y_bert, y_bert.cpu()), 0)
-                        all_test_x_bert = torch.cat((all_test_x_bert, x_bert.cpu()), 0)
-                        all_test_emotion_gt = torch.cat((all_test_emotion_gt, gt_emotion), 0)
-                        all_test_cause_gt = torch.cat((all_test_cause_gt, gt_cause), 0)
-                        all_test_pair_gt = torch.cat((all_test_pair_gt, gt_pair), 0)
-
-                    p_emotion, r_emotion, f_emotion, p_cause, r_cause, f_cause, p_pair, r_pair, f_pair = crf_prompt(
-                        all_test_logits, all_test_label, all_test_x_bert, all_test_emotion_gt, all_test_cause_gt,
-                        all_test_pair_gt)
-                    print("iter{} test result:".format(i))
-                    print(
-                        "e_p: {:.4f} e_r: {:.4f} e_f: {:.4f} c_p: {:.4f} c_r: {:.4f} c_f: {:.4f} pair_p: {:.4f}"
-                        " pair_r: {:.4f} pair_f: {:.4f}".format(
-                            p_emotion,
-                            r_emotion,
-                            f_emotion,
-                            p_cause,
-                            r_cause,
-                            f_cause,
-                            p_pair,
-                            r_pair,
-                            f_pair))
-                    if f_emotion > max_f1_emotion:
-                        max_f1_emotion, max_p_emotion, max_r_emotion = f_emotion, p_emotion, r_emotion
-                    if f_cause > max_f1_cause:
-                        max_f1_cause, max_p_cause, max_r_cause = f_cause, p_cause, r_cause
-                    if f_pair > max_f1_pair:
-                        max_f1_pair, max_p_pair, max_r_pair = f_pair, p_pair, r_pair
-                        if opt.savecheckpoint:
-                            torch.save(model, save_path + '/' + 'fold{}.pth'.format(fold))
-
-                    print("iter{} test result:".format(i))
-                    print(
-                        "max result---- e_p: {:.4f} e_r: {:.4f} e_f: {:.4f} c_p: {:.4f} c_r: {:.4f} c_f: {:.4f}"
-                        " pair_p: {:.4f} pair_r: {:.4f} pair_f: {:.4f}".format(
-                            max_p_emotion, max_r_emotion, max_f1_emotion, max_p_cause, max_r_cause, max_f1_cause,
-                            max_p_pair, max_r_pair, max_f1_pair))
         max_result_emo_f.append(max_f1_emotion)
         max_result_cause_f.append(max_f1_cause)
         max_result_pair_f.append(max_f1_pair)
@@ -448,6 +521,12 @@ def run():
         max_result_emo_r.append(max_r_emotion)
         max_result_cause_r.append(max_r_cause)
         max_result_pair_r.append(max_r_pair)
+        prof.write()
+        # drop the model, data and test buffers of this fold before the next one is built
+        model = optimizer = NLP_Dataset = trainloader = testloader = None
+        all_test_logits = all_test_label = all_test_mask_label = all_test_y_bert = all_test_x_bert = None
+        all_test_emotion_gt = all_test_cause_gt = all_test_pair_gt = None
+        mem.end_fold()
 
     print("emotion")
     print(max_result_emo_f)
@@ -470,6 +549,7 @@ def run():
     print("average p {:.4f}".format(sum(max_result_pair_p) / len(max_result_pair_p)))
     print(max_result_pair_r)
     print("average r {:.4f}".format(sum(max_result_pair_r) / len(max_result_pair_r)))
+    dist_utils.cleanup()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,197 @@
+"""
+batch size / thread count autotuner for prompt_bert.
+
+synthetic batches shaped like MyDataset (--seq_len tokens, a [MASK] every --mask_every tokens,
+labels at the masks) are run for training (forward, backward, AdamW step) and inference (forward
+under no_grad). for every thread count the batch size is doubled until samples/sec stops
+improving, the peak RSS passes --memory_gb or the batch fails to allocate. the best setting per
+mode and all probes are written to --output.
+
+    python autotune.py --bert_path ./bert-base-chinese --threads 4,8,16 --output autotune.json
+    python ECPE.py --tuned_config autotune.json ...
+
+the task scripts read the file with --tuned_config. the test pass takes the fastest inference
+batch size. training keeps the effective batch (--batch_size x --grad_accum_steps) and takes the
+fastest tuned micro-batch that divides it, the rest is made up by gradient accumulation.
+"""
+import argparse
+import json
+import os
+import platform
+import threading
+import time
+import torch
+import prompt_utils
+
+
+def current_rss():
+    """resident set size in bytes, from /proc where available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler(object):
+    """peak RSS while the with-block runs, sampled every interval seconds"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    def loop(self):
+        while self.running:
+            self.peak = max(self.peak, current_rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def synthetic_batch(batch_size, seq_len=512, mask_every=12, vocab_size=prompt_utils.vocab_size, seed=0):
+    """input ids with [CLS] / [SEP] and a [MASK] every mask_every tokens, labels only at the masks"""
+    g = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(1000, vocab_size, (batch_size, seq_len), generator=g)
+    input_ids[:, 0] = prompt_utils.cls_id
+    input_ids[:, -1] = prompt_utils.sep_id
+    input_ids[:, mask_every::mask_every] = prompt_utils.mask_id
+    labels = torch.full_like(input_ids, -100)
+    sel = input_ids == prompt_utils.mask_id
+    labels[sel] = torch.tensor(prompt_utils.verbalizer_ids)[torch.randint(0, 3, (int(sel.sum()),), generator=g)]
+    return input_ids, labels
+
+
+def probe(model, mode, batch_size, steps=3, seq_len=512, mask_every=12):
+    """samples/sec and peak RSS of steps batches after one warm-up batch"""
+    input_ids, labels = synthetic_batch(batch_size, seq_len, mask_every)
+    if mode == 'train':
+        model.train()
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+
+        def step():
+            loss, _ = model(input_ids, labels)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+    else:
+        model.eval()
+
+        def step():
+            with torch.no_grad():
+                model(input_ids, None)
+    with RssSampler() as rss:
+        step()
+        start = time.perf_counter()
+        for _ in range(steps):
+            step()
+        seconds = time.perf_counter() - start
+    return {'mode': mode, 'threads': torch.get_num_threads(), 'batch_size': batch_size,
+            'samples_per_sec': batch_size * steps / seconds, 'peak_rss_mb': rss.peak / (1 << 20)}
+
+
+def tune(model, mode, threads, max_batch=64, memory_gb=0., steps=3, seq_len=512, mask_every=12, log=print):
+    probes = []
+    for n in threads:
+        torch.set_num_threads(n)
+        best, batch_size = 0., 1
+        while batch_size <= max_batch:
+            try:
+                result = probe(model, mode, batch_size, steps, seq_len, mask_every)
+            except (RuntimeError, MemoryError) as e:
+                log('{} threads {} batch {}: failed ({})'.format(mode, n, batch_size, str(e).splitlines()[0]))
+                break
+            probes.append(result)
+            log('{mode} threads {threads} batch {batch_size}: {samples_per_sec:.2f} samples/s, '
+                'peak rss {peak_rss_mb:.0f} MB'.format(**result))
+            if memory_gb and result['peak_rss_mb'] > memory_gb * 1024:
+                result['over_budget'] = True
+                break
+            if result['samples_per_sec'] < 0.97 * best:
+                break
+            best = max(best, result['samples_per_sec'])
+            batch_size *= 2
+    return probes
+
+
+def best_probe(probes, mode, divides=None):
+    """fastest probe of mode within the memory budget; divides: the batch size must divide it"""
+    candidates = [p for p in probes if p['mode'] == mode and not p.get('over_budget') and
+                  (divides is None or divides % p['batch_size'] == 0)]
+    return max(candidates, key=lambda p: p['samples_per_sec']) if candidates else None
+
+
+def apply(opt, path, mode='train'):
+    """
+    override opt.batch_size (and opt.grad_accum_steps when training) and the torch threads with the
+    tuned config at path. called by the task scripts right after parsing their arguments.
+    """
+    if not path:
+        return
+    with open(path) as f:
+        config = json.load(f)
+    if mode == 'train':
+        effective = opt.batch_size * getattr(opt, 'grad_accum_steps', 1)
+        best = best_probe(config['probes'], 'train', divides=effective)
+        if best is None:
+            print('{}: no tuned training batch size divides {}, keeping --batch_size'.format(path, effective))
+            return
+        opt.batch_size = best['batch_size']
+        opt.grad_accum_steps = effective // best['batch_size']
+    else:
+        best = best_probe(config['probes'], 'inference')
+        if best is None:
+            print('{}: no tuned inference batch size, keeping --batch_size'.format(path))
+            return
+        opt.batch_size = best['batch_size']
+    torch.set_num_threads(best['threads'])
+    print('tuned {}: batch_size {} grad_accum_steps {} threads {}'.format(
+        mode, opt.batch_size, getattr(opt, 'grad_accum_steps', 1), best['threads']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='autotune batch size and threads')
+    parser.add_argument('--bert_path', type=str, default='./bert-base-chinese', help='bert to build prompt_bert from')
+    parser.add_argument('--checkpoint', type=str, default='', help='tune a fold checkpoint instead')
+    parser.add_argument('--modes', type=str, default='train,inference')
+    parser.add_argument('--threads', type=str, default='', help='comma separated thread counts, default 1..cores')
+    parser.add_argument('--max_batch', type=int, default=64, help='largest batch size probed')
+    parser.add_argument('--memory_gb', type=float, default=0, help='peak RSS budget, 0 disables')
+    parser.add_argument('--steps', type=int, default=3, help='timed batches per probe')
+    parser.add_argument('--seq_len', type=int, default=512, help='tokens per example, the scripts pad to 512')
+    parser.add_argument('--mask_every', type=int, default=12, help='one [MASK] per this many tokens')
+    parser.add_argument('--output', type=str, default='autotune.json')
+    opt = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    if opt.threads:
+        threads = [int(t) for t in opt.threads.split(',')]
+    else:
+        threads = sorted(set([1, 2, 4, 8, 16, 32, 64][:max(1, cores.bit_length())] + [cores]))
+        threads = [t for t in threads if t <= cores]
+    model = prompt_utils.load_checkpoint(opt.checkpoint) if opt.checkpoint else prompt_utils.prompt_bert(opt.bert_path)
+    config = {'host': platform.node(), 'cpu_count': cores, 'torch': torch.__version__, 'seq_len': opt.seq_len,
+              'probes': []}
+    for mode in opt.modes.split(','):
+        config['probes'].extend(tune(model, mode, threads, opt.max_batch, opt.memory_gb, opt.steps, opt.seq_len,
+                                     opt.mask_every))
+        config[mode] = best_probe(config['probes'], mode)
+        print('best {}: {}'.format(mode, config[mode]))
+    with open(opt.output, 'w') as f:
+        json.dump(config, f, indent=2)
+    print('written to {}'.format(opt.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+offline micro-benchmarks of the data, model and scoring paths. no network and no gpu: the model
+is a tiny randomly initialized BERT and the tokenizer uses a local vocab.txt (--vocab, or a
+generated one that puts 是/非/无, the clause numbers and the special tokens at the ids of
+bert-base-chinese and fills the other ids with CJK characters).
+
+    python bench.py --output bench.json
+    python bench.py --suites model --batch_sizes 1,8 --seq_lens 128,512 --hidden 256 --layers 4
+
+suites:
+    dataset   MyDataset of every task script, prompt_utils.PromptDataset and PromptDataset with a
+              TokenStore on a seeded synthetic corpus (docs/sec, tokens/sec)
+    model     prompt_bert forward and forward + backward per batch size and sequence length
+    scoring   crf_prompt / prf_prompt of the scripts and prompt_utils.score_batch
+    concat    the torch.cat accumulation of the test loops against a list and a single cat
+
+every result holds seconds, docs_per_sec and tokens_per_sec where they apply, and the peak RSS
+while it ran; the JSON file also records the environment and the settings.
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import torch
+from transformers import BertConfig, BertForMaskedLM, BertTokenizer
+import prompt_utils
+from autotune import RssSampler, current_rss
+
+scripts = {'ECE': 'ECE', 'ECPE': 'ECPE', 'CCRC': 'CCRC', 'M2M': 'ECPE_M2M'}
+specials = {0: '[PAD]', 100: '[UNK]', 101: '[CLS]', 102: '[SEP]', 103: '[MASK]'}
+
+
+def write_vocab(path):
+    """vocab.txt of bert-base-chinese size with the ids the prompts and the decoders rely on"""
+    fixed = dict(specials)
+    fixed.update({prompt_utils.yes_id: '是', prompt_utils.no_id: '非', prompt_utils.none_id: '无'})
+    fixed.update({token: str(k + 1) for k, token in enumerate(prompt_utils.label_index)})
+    used = set(fixed.values())
+    # CJK unified ideographs and extension A, more than the 21128 ids need
+    chars = (chr(c) for c in list(range(0x4e00, 0xa000)) + list(range(0x3400, 0x4dc0)) if chr(c) not in used)
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(prompt_utils.vocab_size):
+            f.write((fixed[i] if i in fixed else next(chars)) + '\n')
+
+
+def tiny_bert(directory, vocab, hidden=64, layers=2, heads=2, seed=0):
+    """a random BertForMaskedLM and its tokenizer saved under directory, loadable by prompt_bert"""
+    if vocab:
+        with open(vocab, encoding='utf-8') as src, open(os.path.join(directory, 'vocab.txt'), 'w',
+                                                        encoding='utf-8') as dst:
+            dst.write(src.read())
+    else:
+        write_vocab(os.path.join(directory, 'vocab.txt'))
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size=prompt_utils.vocab_size, hidden_size=hidden, num_hidden_layers=layers,
+                        num_attention_heads=heads, intermediate_size=4 * hidden, max_position_embeddings=512)
+    BertForMaskedLM(config).save_pretrained(directory)
+    BertTokenizer(os.path.join(directory, 'vocab.txt')).save_pretrained(directory)
+    return directory
+
+
+def synthetic_docs(tokenizer, n_docs, seed=0, min_clauses=5, max_clauses=20):
+    """seeded documents of random CJK clauses with one or two emotion cause pairs"""
+    rng = random.Random(seed)
+    chars = [t for t in tokenizer.vocab if len(t) == 1 and '\u4e00' <= t <= '\u9fff']
+    docs = []
+    for d in range(n_docs):
+        n = rng.randint(min_clauses, max_clauses)
+        clauses = [' '.join(rng.choice(chars) for _ in range(rng.randint(4, 14))) for _ in range(n)]
+        emotion = rng.randint(1, n)
+        pairs = sorted({(emotion, min(n, max(1, emotion + rng.randint(-2, 1)))) for _ in range(rng.randint(1, 2))})
+        docs.append(prompt_utils.raw_doc(clauses, pairs, doc_id=str(d + 1), conditional=rng.randint(0, 1)))
+    return docs
+
+
+def measure(name, fn, docs=None, tokens=None, **extra):
+    """run fn once, return its timing record"""
+    start_rss = current_rss()
+    with RssSampler() as rss:
+        start = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - start
+    result = {'name': name, 'seconds': seconds, 'peak_rss_mb': rss.peak / (1 << 20),
+              'rss_growth_mb': (rss.peak - start_rss) / (1 << 20)}
+    if docs is not None:
+        result['docs_per_sec'] = docs / seconds
+    if tokens is not None:
+        result['tokens_per_sec'] = tokens / seconds
+    result.update(extra)
+    print('{name}: {seconds:.3f}s, peak rss {peak_rss_mb:.0f} MB'.format(**result) +
+          ''.join(', {} {:.1f}'.format(k, result[k]) for k in ('docs_per_sec', 'tokens_per_sec') if k in result))
+    return result
+
+
+def import_script(task):
+    """the module of a task script; they parse sys.argv when imported"""
+    argv = sys.argv
+    sys.argv = [scripts[task] + '.py']
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return importlib.import_module(scripts[task])
+    finally:
+        sys.argv = argv
+
+
+def bench_dataset(opt, tokenizer, docs, tasks, workdir):
+    results = []
+    path = os.path.join(workdir, 'bench_fold.txt')
+    with open(path, 'w', encoding='utf-8') as f:
+        for doc in docs:
+            f.write(prompt_utils.format_doc(doc))
+    for task in tasks:
+        n_tokens = sum(prompt_utils.build_example(task, d, tokenizer)['n_tokens'] for d in docs)
+        try:
+            module = import_script(task)
+
+            def script_dataset():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    module.MyDataset(path, test=True, tokenizer=tokenizer)
+            results.append(measure('dataset/{}/MyDataset'.format(task), script_dataset, len(docs), n_tokens))
+        except Exception as e:
+            results.append({'name': 'dataset/{}/MyDataset'.format(task), 'error': '{}: {}'.format(type(e).__name__, e)})
+            print('dataset/{}/MyDataset: {}'.format(task, results[-1]['error']))
+        results.append(measure('dataset/{}/PromptDataset'.format(task), lambda: prompt_utils.PromptDataset(
+            task, docs, tokenizer, verbose=False), len(docs), n_tokens))
+        results.append(measure('dataset/{}/PromptDataset+TokenStore'.format(task), lambda: prompt_utils.PromptDataset(
+            task, docs, tokenizer, verbose=False, store=prompt_utils.TokenStore(tokenizer)), len(docs), n_tokens))
+    return results
+
+
+def bench_model(opt, model):
+    results = []
+    for seq_len in [int(s) for s in opt.seq_lens.split(',')]:
+        for batch_size in [int(b) for b in opt.batch_sizes.split(',')]:
+            input_ids = torch.randint(1000, prompt_utils.vocab_size, (batch_size, seq_len))
+            input_ids[:, 5::12] = prompt_utils.mask_id
+            labels = torch.where(input_ids == prompt_utils.mask_id, torch.full_like(input_ids, prompt_utils.yes_id),
+                                 torch.full_like(input_ids, -100))
+            n = batch_size * opt.repeat
+
+            def forward():
+                model.eval()
+                with torch.no_grad():
+                    for _ in range(opt.repeat):
+                        model(input_ids, None)
+
+            def backward():
+                model.train()
+                for _ in range(opt.repeat):
+                    loss, _ = model(input_ids, labels)
+                    loss.backward()
+                model.zero_grad()
+            forward()
+            tag = 'b{}_l{}'.format(batch_size, seq_len)
+            results.append(measure('model/forward/' + tag, forward, n, n * seq_len, batch_size=batch_size,
+                                   seq_len=seq_len))
+            results.append(measure('model/forward_backward/' + tag, backward, n, n * seq_len, batch_size=batch_size,
+                                   seq_len=seq_len))
+    return results
+
+
+def bench_scoring(opt, tokenizer, docs, tasks):
+    results = []
+    docs = docs[:opt.score_docs]
+    for task in tasks:
+        dataset = prompt_utils.PromptDataset(task, docs, tokenizer, verbose=False)
+        batch = {k: torch.tensor(v) for k, v in dataset.data.items()}
+        torch.manual_seed(opt.seed)
+        logits = torch.randn(len(docs), 512, prompt_utils.vocab_size)
+        logits[:, :, prompt_utils.verbalizer_ids] += 6
+        probs = torch.softmax(logits, -1)
+        del logits
+        n_tokens = int(sum(batch['n_tokens']))
+        try:
+            module = import_script(task)
+            if task == 'ECPE':
+                args = (batch['gt_emotion'], batch['gt_cause'], batch['gt_pair'])
+                score = module.crf_prompt
+            elif task == 'M2M':
+                args = (batch['gt_emotion'], batch['gt_cause'], batch['gt_pair'])
+                score = module.prf_prompt
+            elif task == 'ECE':
+                args = (batch['gt_cause'],)
+                score = module.prf_prompt
+            else:
+                args = (batch['gt_conditional'], batch['emotion_index'])
+                score = module.prf_prompt
+
+            def script_score():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    score(probs, batch['label'], batch['input_ids'], *args)
+            results.append(measure('scoring/{}/{}'.format(task, score.__name__), script_score, len(docs), n_tokens))
+        except Exception as e:
+            results.append({'name': 'scoring/{}/script'.format(task), 'error': '{}: {}'.format(type(e).__name__, e)})
+        results.append(measure('scoring/{}/score_batch'.format(task), lambda: prompt_utils.score_batch(
+            task, prompt_utils.new_counts(), probs, batch, normalized=True), len(docs), n_tokens))
+    return results
+
+
+def bench_concat(opt):
+    shape = (opt.concat_batch, 512, prompt_utils.vocab_size)
+    n = opt.concat_batches * opt.concat_batch
+
+    def cat_loop():
+        all_logits = torch.tensor([])
+        for _ in range(opt.concat_batches):
+            all_logits = torch.cat((all_logits, torch.ones(shape)), 0)
+
+    def list_cat():
+        parts = [torch.ones(shape) for _ in range(opt.concat_batches)]
+        torch.cat(parts, 0)
+    return [measure('concat/cat_loop', cat_loop, n, n * 512), measure('concat/list_cat', list_cat, n, n * 512)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='offline micro-benchmarks')
+    parser.add_argument('--suites', type=str, default='dataset,model,scoring,concat')
+    parser.add_argument('--tasks', type=str, default='ECE,ECPE,CCRC,M2M')
+    parser.add_argument('--vocab', type=str, default='', help='local vocab.txt, default generates one')
+    parser.add_argument('--hidden', type=int, default=64, help='hidden size of the random BERT')
+    parser.add_argument('--layers', type=int, default=2, help='layers of the random BERT')
+    parser.add_argument('--heads', type=int, default=2, help='attention heads of the random BERT')
+    parser.add_argument('--docs', type=int, default=200, help='synthetic documents for the dataset suite')
+    parser.add_argument('--score_docs', type=int, default=8, help='documents scored at once (512 x 21128 each)')
+    parser.add_argument('--batch_sizes', type=str, default='1,4,8')
+    parser.add_argument('--seq_lens', type=str, default='128,512')
+    parser.add_argument('--repeat', type=int, default=3, help='batches per model measurement')
+    parser.add_argument('--concat_batch', type=int, default=2, help='batch of the concat suite')
+    parser.add_argument('--concat_batches', type=int, default=4, help='batches accumulated by the concat suite')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='bench.json')
+    opt = parser.parse_args()
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    suites = opt.suites.split(',')
+    tasks = opt.tasks.split(',')
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        bert_path = tiny_bert(workdir, opt.vocab, opt.hidden, opt.layers, opt.heads, opt.seed)
+        tokenizer = BertTokenizer.from_pretrained(bert_path)
+        docs = synthetic_docs(tokenizer, max(opt.docs, opt.score_docs), opt.seed)
+        if 'dataset' in suites:
+            results.extend(bench_dataset(opt, tokenizer, docs[:opt.docs], tasks, workdir))
+        if 'model' in suites:
+            results.extend(bench_model(opt, prompt_utils.prompt_bert(bert_path)))
+        if 'scoring' in suites:
+            results.extend(bench_scoring(opt, tokenizer, docs, tasks))
+    if 'concat' in suites:
+        results.extend(bench_concat(opt))
+    report = {'env': {'host': platform.node(), 'python': platform.python_version(), 'torch': torch.__version__,
+                      'threads': torch.get_num_threads(), 'cpu_count': os.cpu_count()},
+              'settings': vars(opt), 'results': results}
+    with open(opt.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('{} results written to {}'.format(len(results), opt.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""
+streaming bulk inference over a large corpus.
+
+documents are read one at a time from an ECPE text file (the format of the fold files) or from
+JSONL ({"doc_id": ..., "clauses": [...], "emotions": [...], "pairs": [...]} per line). a pool
+of workers builds and tokenizes the prompts, the model runs on fixed-size batches of prompts and
+every finished document is appended to the output JSONL right away. only --prefetch documents
+are in flight at any time.
+
+every --checkpoint_every documents <output>.state records the input byte offset after the last
+written document and the size of the output. after a crash, --resume True truncates the output
+to that size and continues reading at that offset.
+
+    python bulk_predict.py --task ECPE --checkpoint checkpoint/ECPE/fold1.pth \
+        --input news.jsonl --output news_pred.jsonl --workers 4 --batch_size 16 --resume True
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import torch
+from transformers import BertTokenizer
+import predictor
+import prompt_utils
+from pred_cache import PredictionCache
+
+_worker = {}
+
+
+def iter_ecpe(path, offset=0):
+    """(end offset, document) of an ECPE text file, starting at byte offset"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            line = f.readline()
+            if not line.strip():
+                return
+            header = line.decode('utf-8').strip().split()
+            pairs = prompt_utils.parse_pairs(f.readline().decode('utf-8'))
+            lines = [f.readline().decode('utf-8').strip() for _ in range(int(header[1]))]
+            yield f.tell(), prompt_utils.make_doc(header, pairs, lines)
+
+
+def iter_jsonl(path, offset=0):
+    """(end offset, document dict) of a JSONL file, blank lines are skipped"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in iter(f.readline, b''):
+            if line.strip():
+                yield f.tell(), json.loads(line.decode('utf-8'))
+
+
+def read_corpus(path, offset=0, fmt='auto'):
+    if fmt == 'auto':
+        fmt = 'jsonl' if path.endswith('.jsonl') or path.endswith('.json') else 'ecpe'
+    return iter_jsonl(path, offset) if fmt == 'jsonl' else iter_ecpe(path, offset)
+
+
+def init_worker(task, bert_path, max_length, overlap, num_for_M):
+    _worker.update(task=task, tokenizer=BertTokenizer.from_pretrained(bert_path), max_length=max_length,
+                   overlap=overlap, num_for_M=num_for_M)
+
+
+def init_pool_worker(*args):
+    # tokenizer processes must not compete with the model for cores
+    torch.set_num_threads(1)
+    init_worker(*args)
+
+
+def prepare(item):
+    """worker side: parse and tokenize one document. returns (end offset, doc, input_ids, plan)"""
+    end, document = item
+    doc = predictor.to_doc(_worker['task'], document, str(end))
+    input_ids, plans = predictor.build_prompts(_worker['task'], [doc], _worker['tokenizer'], _worker['max_length'],
+                                               _worker['overlap'], _worker['num_for_M'])
+    return end, doc, input_ids, plans[0]
+
+
+def read_state(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return None
+
+
+def write_state(path, state):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+class Pending(object):
+    """a prepared document waiting for the slots of its windows"""
+
+    def __init__(self, end, doc, input_ids, plan):
+        self.end = end
+        self.doc = doc
+        self.input_ids = input_ids
+        self.plan = plan
+        self.slots = [None] * len(input_ids)
+
+    def done(self):
+        return all(s is not None for s in self.slots)
+
+
+def run(opt):
+    state_path = opt.output + '.state'
+    state = read_state(state_path) if opt.resume else None
+    if state is not None and state['input'] != os.path.abspath(opt.input):
+        raise ValueError('{} belongs to {}, not {}'.format(state_path, state['input'], opt.input))
+    if state is None:
+        state = {'input': os.path.abspath(opt.input), 'offset': 0, 'output_bytes': 0, 'docs': 0}
+        out = open(opt.output, 'wb')
+    else:
+        out = open(opt.output, 'r+b')
+        out.truncate(state['output_bytes'])
+        out.seek(state['output_bytes'])
+        print('resuming at byte {} of {} after {} documents'.format(state['offset'], opt.input, state['docs']))
+
+    cache = PredictionCache(opt.cache_size, opt.cache_path or None) if opt.cache_size > 0 else None
+    model = predictor.Predictor.from_checkpoint(opt.task, opt.checkpoint, opt.bert_path, window_size=opt.window_size,
+                                                max_length=opt.max_length, overlap=opt.overlap,
+                                                num_for_M=opt.num_for_M, cache=cache)
+    init_args = (opt.task, opt.bert_path, opt.max_length, opt.overlap, opt.num_for_M)
+    if opt.workers > 0:
+        pool = multiprocessing.get_context('spawn').Pool(opt.workers, initializer=init_pool_worker, initargs=init_args)
+        prepare_all = lambda items: pool.map(prepare, items, chunksize=max(1, len(items) // (4 * opt.workers)))
+    else:
+        pool = None
+        init_worker(*init_args)
+        prepare_all = lambda items: [prepare(item) for item in items]
+
+    reader = read_corpus(opt.input, state['offset'], opt.format)
+    pending, queue = [], []
+    start_time, start_docs, last_saved = time.time(), state['docs'], state['docs']
+
+    def run_batch(batch):
+        slots = model.cached_slots([ids for ids, _, _ in batch], model.run_slots)
+        for (_, item, k), s in zip(batch, slots):
+            item.slots[k] = s
+
+    def flush():
+        finished = 0
+        while finished < len(pending) and pending[finished].done():
+            finished += 1
+        items = pending[:finished]
+        del pending[:finished]
+        if not items:
+            return
+        results = model.results([i.doc for i in items], [i.plan for i in items], list(itertools.chain.from_iterable(
+            i.slots for i in items)))
+        for item, result in zip(items, results):
+            out.write((json.dumps(result, ensure_ascii=False) + '\n').encode('utf-8'))
+        state['offset'] = items[-1].end
+        state['docs'] += len(items)
+
+    def save():
+        out.flush()
+        os.fsync(out.fileno())
+        state['output_bytes'] = out.tell()
+        write_state(state_path, state)
+
+    try:
+        while True:
+            items = list(itertools.islice(reader, opt.prefetch))
+            if not items:
+                break
+            for prepared in prepare_all(items):
+                item = Pending(*prepared)
+                pending.append(item)
+                queue.extend((ids, item, k) for k, ids in enumerate(item.input_ids))
+                while len(queue) >= opt.batch_size:
+                    run_batch(queue[:opt.batch_size])
+                    del queue[:opt.batch_size]
+                    flush()
+                if state['docs'] - last_saved >= opt.checkpoint_every:
+                    save()
+                    last_saved = state['docs']
+                    print('{} documents, {:.1f} docs/s'.format(
+                        state['docs'], (state['docs'] - start_docs) / (time.time() - start_time)))
+        if queue:
+            run_batch(queue)
+            del queue[:]
+        flush()
+        save()
+    finally:
+        out.close()
+        if pool is not None:
+            pool.terminate()
+    print('done: {} documents written to {}'.format(state['docs'], opt.output))
+    if cache is not None:
+        print('cache: {}'.format(cache.stats()))
+        cache.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='streaming bulk inference')
+    parser.add_argument('--task', type=str, default='ECPE', choices=prompt_utils.tasks)
+    parser.add_argument('--checkpoint', type=str, default='checkpoint/ECPE/fold1.pth', help='fold checkpoint')
+    parser.add_argument('--bert_path', type=str, default='./bert-base-chinese', help='tokenizer')
+    parser.add_argument('--input', type=str, required=True, help='ECPE text file or JSONL')
+    parser.add_argument('--format', type=str, default='auto', choices=['auto', 'ecpe', 'jsonl'])
+    parser.add_argument('--output', type=str, required=True, help='JSONL predictions')
+    parser.add_argument('--resume', type=bool, default=False, help='continue after the last saved offset')
+    parser.add_argument('--workers', type=int, default=2, help='tokenizer processes, 0 tokenizes in process')
+    parser.add_argument('--batch_size', type=int, default=8, help='prompts per model call')
+    parser.add_argument('--prefetch', type=int, default=256, help='documents read and tokenized ahead')
+    parser.add_argument('--checkpoint_every', type=int, default=1000, help='documents between state saves')
+    parser.add_argument('--max_length', type=int, default=512, help='tokens per prompt')
+    parser.add_argument('--overlap', type=int, default=4, help='clauses shared by chunk windows')
+    parser.add_argument('--window_size', type=int, default=2, help='size of the emotion cause pair window')
+    parser.add_argument('--num_for_M', type=int, default=2, help='for M2M module')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads of the model, 0 keeps the default')
+    parser.add_argument('--cache_size', type=int, default=0, help='prompts kept in the prediction cache, 0 disables')
+    parser.add_argument('--cache_path', type=str, default='', help='sqlite file backing the prediction cache')
+    opt = parser.parse_args()
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    run(opt)
+
+
+if __name__ == '__main__':
+    main()
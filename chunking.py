@@ -0,0 +1,207 @@
+"""
+overlapping-window inference for documents whose prompt does not fit in 512 tokens.
+
+a long document is split into clause-aligned windows that each fit max_length. consecutive
+windows share --overlap clauses. every window is renumbered from 1, so its pair answers stay
+inside the clause-number verbalizers of label_index. all windows go through the fold checkpoint
+like ordinary documents, batch_size at a time, so memory is bounded by the window size.
+
+the per-clause predictions are then stitched back into whole-document predictions. every clause
+takes the mask answers of the window in which it is furthest from a window edge; on ties the
+earlier window wins. pair numbers are shifted by the window offset.
+
+    # compare truncation with chunking on the fold checkpoints
+    python chunking.py --task ECPE --dataset data_combine_ECPE/ --checkpointpath checkpoint/ECPE/ --overlap 4
+"""
+import argparse
+import os
+import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from transformers import BertTokenizer
+import prompt_utils
+
+
+def clause_costs(task, doc, tokenizer, num_for_M=2):
+    """prompt tokens of every clause; clause numbers are single tokens so the cost does not depend on them"""
+    costs = []
+    for i in range(doc['d_len']):
+        x_text, _, _ = prompt_utils.build_texts(task, prompt_utils.sub_doc(doc, i, i + 1), num_for_M)
+        costs.append(len(tokenizer.tokenize(x_text)))
+    return costs
+
+
+def plan_windows(costs, max_length=512, overlap=4, max_clause=prompt_utils.max_clause):
+    """
+    [(start, end)] clause ranges covering the document, each fitting max_length tokens with
+    [CLS]/[SEP] and at most max_clause clauses. the next window starts overlap clauses before
+    the end of the previous one, or one clause after its start if the window is shorter than that.
+    """
+    budget = max_length - 2
+    n = len(costs)
+    windows = []
+    start = 0
+    while True:
+        end, used = start, 0
+        while end < n and end - start < max_clause and used + costs[end] <= budget:
+            used += costs[end]
+            end += 1
+        # a single clause longer than the budget still gets a window, it is truncated
+        end = max(end, start + 1)
+        windows.append((start, end))
+        if end >= n:
+            return windows
+        start = max(start + 1, end - overlap)
+
+
+def needs_chunking(costs, max_length=512):
+    return sum(costs) + 2 > max_length or len(costs) > prompt_utils.max_clause
+
+
+def stitch(task, d_len, windows, window_slots):
+    """merge the decode_slots output of every window into the slots of the whole document"""
+    names = prompt_utils.slot_names[task]
+    merged = {'pair': np.full((d_len, names.count('pair')), -1, dtype=np.int16)}
+    for name in ('emotion', 'cause'):
+        if name in names:
+            merged[name] = np.full(d_len, -1, dtype=np.int8)
+    if task == 'CCRC':
+        merged['given_cause'] = np.zeros(d_len, dtype=bool)
+    margin = np.full(d_len, -1)
+    for (start, end), slots in zip(windows, window_slots):
+        for local in range(len(slots['pair'])):
+            clause = start + local
+            # distance to the nearest edge that has a neighbouring window
+            left = local if start > 0 else d_len
+            right = end - 1 - clause if end < d_len else d_len
+            m = min(left, right)
+            if m <= margin[clause]:
+                continue
+            margin[clause] = m
+            for key in merged:
+                merged[key][clause] = slots[key][local]
+            pair = merged['pair'][clause]
+            pair[pair > 0] += start
+    return merged
+
+
+def chunk_docs(task, docs, tokenizer, max_length=512, overlap=4, num_for_M=2):
+    """
+    split docs into windows; returns the window documents and, per document, its list of
+    (start, end) ranges. documents that fit are kept whole as a single window.
+    """
+    windows, plans = [], []
+    for doc in docs:
+        costs = clause_costs(task, doc, tokenizer, num_for_M)
+        plan = plan_windows(costs, max_length, overlap) if needs_chunking(costs, max_length) else [(0, doc['d_len'])]
+        plans.append(plan)
+        windows.extend(prompt_utils.sub_doc(doc, start, end) if (start, end) != (0, doc['d_len']) else doc
+                       for start, end in plan)
+    return windows, plans
+
+
+def predict_slots(task, model, tokenizer, docs, batch_size=8, max_length=512, overlap=4, window_size=2,
+                  num_for_M=2):
+    """whole-document slots (see prompt_utils.decode_slots) of docs with chunked inference"""
+    windows, plans = chunk_docs(task, docs, tokenizer, max_length, overlap, num_for_M)
+    dataset = prompt_utils.PromptDataset(task, windows, tokenizer, max_length, num_for_M, verbose=False)
+    window_slots = []
+    with torch.no_grad():
+        for batch in DataLoader(dataset, batch_size=batch_size, shuffle=False):
+            _, logits = model(batch['input_ids'], None)
+            for top1, verb, prev in prompt_utils.mask_scores(logits, batch['input_ids']):
+                window_slots.append(prompt_utils.decode_slots(task, top1, verb, prev, window_size))
+    out, k = [], 0
+    for doc, plan in zip(docs, plans):
+        out.append(stitch(task, doc['d_len'], plan, window_slots[k:k + len(plan)]))
+        k += len(plan)
+    return out
+
+
+def doc_gold(task, doc, tokenizer, num_for_M=2):
+    """slots of the annotation over the untruncated prompt, and the ground truth counters"""
+    example = prompt_utils.build_example(task, doc, tokenizer, None, num_for_M)
+    gold, = prompt_utils.label_tokens(torch.tensor(example['label']).unsqueeze(0),
+                                      torch.tensor(example['input_ids']).unsqueeze(0))
+    return prompt_utils.decode_labels(task, gold), prompt_utils.doc_targets(task, doc)
+
+
+def evaluate_fold(opt, tokenizer, model, docs):
+    gold = [doc_gold(opt.task, doc, tokenizer, opt.num_for_M) for doc in docs]
+    report = {}
+    for mode in ('truncate', 'chunk'):
+        start = time.perf_counter()
+        if mode == 'chunk':
+            slots = predict_slots(opt.task, model, tokenizer, docs, opt.batch_size, opt.max_length, opt.overlap,
+                                  opt.window_size, opt.num_for_M)
+        else:
+            slots = []
+            dataset = prompt_utils.PromptDataset(opt.task, docs, tokenizer, opt.max_length, opt.num_for_M,
+                                                 verbose=False)
+            with torch.no_grad():
+                for batch in DataLoader(dataset, batch_size=opt.batch_size, shuffle=False):
+                    _, logits = model(batch['input_ids'], None)
+                    for top1, verb, prev in prompt_utils.mask_scores(logits, batch['input_ids']):
+                        slots.append(prompt_utils.decode_slots(opt.task, top1, verb, prev, opt.window_size))
+        elapsed = time.perf_counter() - start
+        counts = prompt_utils.new_counts()
+        for (gold_slots, gt), pred in zip(gold, slots):
+            prompt_utils.add_counts(counts, opt.task, pred, pad_slots(pred, gold_slots), gt)
+        report[mode] = {'prf': prompt_utils.prf(opt.task, counts), 'seconds': elapsed}
+    return report
+
+
+def pad_slots(pred, gold):
+    """cut or extend the gold slots to the clauses the prediction covers (truncated prompts cover fewer)"""
+    n = len(pred['pair'])
+    out = {}
+    for key, value in gold.items():
+        if len(value) >= n:
+            out[key] = value[:n]
+        else:
+            fill = np.zeros((n - len(value),) + value.shape[1:], dtype=value.dtype)
+            out[key] = np.concatenate([value, fill])
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='chunked inference for over-length documents')
+    parser.add_argument('--task', type=str, default='ECPE', choices=prompt_utils.tasks)
+    parser.add_argument('--dataset', type=str, default='data_combine_ECPE/', help='path for dataset')
+    parser.add_argument('--checkpointpath', type=str, default='checkpoint/ECPE/', help='fold checkpoints')
+    parser.add_argument('--bert_path', type=str, default='./bert-base-chinese', help='tokenizer')
+    parser.add_argument('--folds', type=str, default='1,2,3,4,5,6,7,8,9,10', help='comma separated folds')
+    parser.add_argument('--batch_size', type=int, default=8, help='number of windows per batch')
+    parser.add_argument('--max_length', type=int, default=512, help='tokens per window')
+    parser.add_argument('--overlap', type=int, default=4, help='clauses shared by consecutive windows')
+    parser.add_argument('--window_size', type=int, default=2, help='size of the emotion cause pair window')
+    parser.add_argument('--num_for_M', type=int, default=2, help='for M2M module')
+    parser.add_argument('--long_only', type=bool, default=False, help='only score the over-length documents')
+    opt = parser.parse_args()
+
+    tokenizer = BertTokenizer.from_pretrained(opt.bert_path)
+    results = {'truncate': [], 'chunk': []}
+    for fold in [int(f) for f in opt.folds.split(',') if f]:
+        docs = list(prompt_utils.read_docs(opt.dataset + 'fold{}_test.txt'.format(fold)))
+        if opt.long_only:
+            docs = [d for d in docs if needs_chunking(clause_costs(opt.task, d, tokenizer, opt.num_for_M),
+                                                      opt.max_length)]
+            if not docs:
+                print('fold {}: no over-length document'.format(fold))
+                continue
+        model = prompt_utils.load_checkpoint(os.path.join(opt.checkpointpath, 'fold{}.pth'.format(fold))).eval()
+        report = evaluate_fold(opt, tokenizer, model, docs)
+        for mode in results:
+            results[mode].append(report[mode]['prf'])
+            print('fold {} {:8s} {} ({:.1f}s)'.format(
+                fold, mode, prompt_utils.format_prf(opt.task, report[mode]['prf']), report[mode]['seconds']))
+    for mode, folds in results.items():
+        if folds:
+            average = {t: tuple(np.mean([f[t][k] for f in folds]) for k in range(3))
+                       for t in prompt_utils.targets[opt.task]}
+            print('average {:8s} {}'.format(mode, prompt_utils.format_prf(opt.task, average)))
+
+
+if __name__ == '__main__':
+    main()
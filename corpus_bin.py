@@ -0,0 +1,335 @@
+"""
+columnar binary corpus, converted from the ECPE text format, read with mmap.
+
+a .bin file holds a json header and 64-byte aligned arrays: per document the id, the other header
+fields (label and conditional of CCRC) and the offsets of its clauses and pairs; the pairs as
+[P, 2] int16; per clause its number (as written, some negatives of gen_nega_samples.py repeat
+one), the offset of its UTF-8 text in one blob and the ids of its emotion and keyword columns.
+opening a corpus maps the file and makes array views of it, nothing is parsed.
+
+    python corpus_bin.py convert                                   # every data_combine_* -> data_bin/
+    python corpus_bin.py convert data_combine_ECPE --output_dir data_bin
+    python corpus_bin.py text data_bin/data_combine_ECPE/fold1_test.bin > fold1_test.txt
+    python ECPE.py --dataset data_bin/data_combine_ECPE/
+
+the converter checks that every document formats back to its exact bytes (the spacing of the pair
+line and of the header is kept per file), so the text command gives back the source file. documents
+is what MyDataset of the task scripts reads: the text file when it exists, otherwise the columns of
+the .bin file of the same name. open_corpus gives the lines the text file would have instead.
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+import numpy as np
+import prompt_utils
+
+magic = b'ECPEBIN1'
+version = 1
+align = 64
+_pair = re.compile(r'\((\d+),( ?)(\d+)\)')
+
+
+def _format_pairs(pairs, prefix, space):
+    return prefix + ', '.join('({},{}{})'.format(e, space, c) for e, c in pairs)
+
+
+def _clause_line(k, emotion, keyword, text):
+    return '{},{},{},{}'.format(k, emotion, keyword, text)
+
+
+class Corpus(object):
+    """documents of a .bin file, as views of the mapped file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self.buffer[:len(magic)]) != magic:
+            raise ValueError('{} is not a binary corpus'.format(path))
+        size = int(np.frombuffer(self.buffer, dtype='<u8', count=1, offset=len(magic))[0])
+        start = len(magic) + 8
+        self.meta = json.loads(bytes(self.buffer[start:start + size]).decode('utf-8'))
+        if self.meta['version'] != version:
+            raise ValueError('{}: binary corpus version {}, expected {}'.format(path, self.meta['version'], version))
+        for name, (dtype, shape, offset) in self.meta['arrays'].items():
+            count = int(np.prod(shape))
+            setattr(self, name, np.frombuffer(self.buffer, dtype=dtype, count=count, offset=offset).reshape(shape))
+        self.labels = self.meta['labels']
+        self.pair_prefix, self.pair_space = self.meta['pair_prefix'], self.meta['pair_space']
+        self.header_suffix = self.meta['header_suffix']
+
+    def __len__(self):
+        return len(self.doc_id)
+
+    def header(self, i):
+        first, last = self.doc_clauses[i:i + 2].tolist()
+        return [str(self.doc_id[i]), str(last - first)] + [str(x) for x in self.header_extra[i].tolist()]
+
+    def pairs(self, i):
+        first, last = self.doc_pairs[i:i + 2].tolist()
+        return [tuple(p) for p in self.pair_array[first:last].tolist()]
+
+    def clauses(self, i):
+        """the clause texts of document i, one decode for the document"""
+        first, last = self.doc_clauses[i:i + 2].tolist()
+        if first == last:
+            return []
+        text = self.text[self.clause_offsets[first]:self.clause_offsets[last]].tobytes().decode('utf-8')
+        return text.split('\n')[:-1]
+
+    def clause_lines(self, i):
+        first, last = self.doc_clauses[i:i + 2].tolist()
+        labels = self.labels
+        return [_clause_line(k, labels[e], labels[w], text) for k, e, w, text in zip(
+            self.clause_number[first:last].tolist(), self.emotion[first:last].tolist(),
+            self.keyword[first:last].tolist(), self.clauses(i))]
+
+    def lines(self, i):
+        """the lines of document i in the text format, with their newlines"""
+        out = [' '.join(self.header(i)) + self.header_suffix,
+               _format_pairs(self.pairs(i), self.pair_prefix, self.pair_space)]
+        out.extend(self.clause_lines(i))
+        return [line + '\n' for line in out]
+
+    def doc(self, i):
+        return prompt_utils.make_doc(self.header(i), self.pairs(i), self.clause_lines(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.doc(i)
+
+    def reader(self):
+        return LineReader(self)
+
+    def close(self):
+        self.buffer = None
+
+
+class LineReader(object):
+    """readline() over the text lines of a corpus, for the parsing loops of the task scripts"""
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.doc = 0
+        self.pending = []
+
+    def readline(self):
+        if not self.pending:
+            if self.doc >= len(self.corpus):
+                return ''
+            self.pending = self.corpus.lines(self.doc)[::-1]
+            self.doc += 1
+        return self.pending.pop()
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.corpus.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def binary_path(path):
+    return os.path.splitext(path)[0] + '.bin'
+
+
+def is_binary(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(magic)) == magic
+
+
+def resolve(path):
+    """the file behind path: path itself, or the .bin file of the same name when path does not exist"""
+    if not os.path.exists(path) and os.path.exists(binary_path(path)):
+        return binary_path(path)
+    return path
+
+
+def open_corpus(path):
+    """
+    the open file of a corpus for the readline loops of MyDataset: the text file, or the lines of
+    the binary corpus at path (or next to it)
+    """
+    path = resolve(path)
+    if is_binary(path):
+        return Corpus(path).reader()
+    return open(path, 'r')
+
+
+def documents(path):
+    """
+    (header fields, pairs, clause texts) of every document of a corpus, as the parsing loops of MyDataset
+    read them: from the lines of the text file, or straight from the columns of the binary corpus at path
+    (or next to it), with no text in between
+    """
+    path = resolve(path)
+    if is_binary(path):
+        corpus = Corpus(path)
+        for i in range(len(corpus)):
+            # the text after the last comma of the clause line, as split(',')[-1] of the text file
+            yield corpus.header(i), corpus.pairs(i), [text.split(',')[-1].rstrip() for text in corpus.clauses(i)]
+        corpus.close()
+        return
+    with open(path, 'r') as inputFile:
+        for line in iter(inputFile.readline, ''):
+            header = line.strip().split()
+            pairs = eval('[' + inputFile.readline().strip() + ']')
+            yield header, pairs, [inputFile.readline().strip().split(',')[-1] for _ in range(int(header[1]))]
+
+
+def parse(path):
+    """the columns of an ECPE text file; raises ValueError when a document does not round-trip"""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    lines = raw.decode('utf-8').split('\n')
+    doc_id, header_extra, doc_clauses, doc_pairs, pairs = [], [], [0], [0], []
+    number, emotion, keyword, texts = [], [], [], []
+    labels = {}
+    formats = None
+    i, checked = 0, 0
+    while i < len(lines) and lines[i].strip():
+        header = lines[i].split()
+        if len(header) < 2 or not header[1].isdigit():
+            raise ValueError('{}: "{}" is not a document header'.format(path, lines[i]))
+        d_len = int(header[1])
+        if i + 1 + d_len >= len(lines):
+            raise ValueError('{}: document {} is cut'.format(path, header[0]))
+        pair_line = lines[i + 1]
+        found = _pair.findall(pair_line)
+        if formats is None:
+            if not found:
+                raise ValueError('{}: no pairs in document {}'.format(path, header[0]))
+            formats = (lines[i][len(lines[i].rstrip()):], pair_line[:len(pair_line) - len(pair_line.lstrip())],
+                       found[0][1])
+        doc_pairs_ = [(int(e), int(c)) for e, _, c in found]
+        rendered = [' '.join(header) + formats[0], _format_pairs(doc_pairs_, formats[1], formats[2])]
+        doc_lines = lines[i + 2:i + 2 + d_len]
+        for k, line in enumerate(doc_lines, 1):
+            fields = line.split(',', 3)
+            if len(fields) != 4 or not fields[0].isdigit():
+                raise ValueError('{}: clause {} of document {} is not "k,emotion,keyword,text"'.format(
+                    path, k, header[0]))
+            number.append(int(fields[0]))
+            emotion.append(labels.setdefault(fields[1], len(labels)))
+            keyword.append(labels.setdefault(fields[2], len(labels)))
+            texts.append(fields[3])
+            rendered.append(line)
+        if rendered[:2] != lines[i:i + 2]:
+            raise ValueError('{}: document {} does not format back to its text'.format(path, header[0]))
+        doc_id.append(int(header[0]))
+        header_extra.append([int(x) for x in header[2:]])
+        doc_clauses.append(len(texts))
+        pairs.extend(doc_pairs_)
+        doc_pairs.append(len(pairs))
+        i += d_len + 2
+        checked += 1
+    if any(line for line in lines[i:]) or (lines and lines[-1] != ''):
+        raise ValueError('{}: unexpected text after document {}'.format(path, checked))
+    if len(set(len(h) for h in header_extra)) > 1:
+        raise ValueError('{}: documents have different header fields'.format(path))
+    blob = ''.join(text + '\n' for text in texts).encode('utf-8')
+    clause_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    clause_offsets[1:] = np.cumsum([len(text.encode('utf-8')) + 1 for text in texts])
+    offset_type = np.int32 if len(blob) < 2 ** 31 else np.int64
+    label_type = np.int16 if len(labels) < 2 ** 15 else np.int32
+    arrays = {
+        'doc_id': np.array(doc_id, dtype=np.int64),
+        'header_extra': np.array(header_extra, dtype=np.int64).reshape(len(doc_id), -1),
+        'doc_clauses': np.array(doc_clauses, dtype=offset_type),
+        'doc_pairs': np.array(doc_pairs, dtype=offset_type),
+        'pair_array': np.array(pairs, dtype=np.int16).reshape(-1, 2),
+        'clause_offsets': clause_offsets.astype(offset_type),
+        'clause_number': np.array(number, dtype=np.int16),
+        'emotion': np.array(emotion, dtype=label_type),
+        'keyword': np.array(keyword, dtype=label_type),
+        'text': np.frombuffer(blob, dtype=np.uint8),
+    }
+    header_suffix, pair_prefix, pair_space = formats or ('', '', '')
+    meta = {'version': version, 'source': os.path.basename(path), 'labels': sorted(labels, key=labels.get),
+            'header_suffix': header_suffix, 'pair_prefix': pair_prefix, 'pair_space': pair_space,
+            'docs': len(doc_id), 'clauses': len(texts), 'pairs': len(pairs)}
+    return meta, arrays
+
+
+def write(path, meta, arrays):
+    table, offset = {}, 0
+    for name, array in arrays.items():
+        table[name] = [array.dtype.str, list(array.shape), offset]
+        offset += -(-array.nbytes // align) * align
+    # the arrays start after the header, whose size depends on their offsets
+    base = 0
+    while True:
+        meta = dict(meta, arrays={name: [d, s, o + base] for name, (d, s, o) in table.items()})
+        header = json.dumps(meta).encode('utf-8')
+        start = -(-(len(magic) + 8 + len(header)) // align) * align
+        if start == base:
+            break
+        base = start
+    with open(path, 'wb') as f:
+        f.write(magic)
+        f.write(np.array([len(header)], dtype='<u8').tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.write(b'\0' * (meta['arrays'][name][2] - f.tell()))
+            f.write(np.ascontiguousarray(array).tobytes())
+
+
+def convert_file(source, target):
+    meta, arrays = parse(source)
+    write(target, meta, arrays)
+    with open(source, 'rb') as f:
+        expected = f.read()
+    corpus = Corpus(target)
+    if ''.join(line for i in range(len(corpus)) for line in corpus.lines(i)).encode('utf-8') != expected:
+        raise ValueError('{}: the binary corpus does not read back to the source'.format(source))
+    return meta
+
+
+def convert(directories, output_dir, log=print):
+    """every .txt file of the corpus format in directories -> output_dir/<directory>/<name>.bin"""
+    converted = []
+    for directory in directories:
+        target_dir = os.path.join(output_dir, os.path.basename(os.path.normpath(directory)))
+        os.makedirs(target_dir, exist_ok=True)
+        for source in sorted(glob.glob(os.path.join(directory, '*.txt'))):
+            target = os.path.join(target_dir, os.path.basename(binary_path(source)))
+            start = time.time()
+            try:
+                meta = convert_file(source, target)
+            except ValueError as e:
+                log('skipped {}: {}'.format(source, e))
+                continue
+            converted.append(target)
+            log('{} -> {}: {} documents, {} clauses, {:.1f} MB -> {:.1f} MB, {:.2f}s'.format(
+                source, target, meta['docs'], meta['clauses'], os.path.getsize(source) / 1e6,
+                os.path.getsize(target) / 1e6, time.time() - start))
+    return converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='binary corpus files of the data_combine_* directories')
+    parser.add_argument('mode', choices=['convert', 'text'])
+    parser.add_argument('paths', nargs='*', help='convert: directories (default data_combine_*), text: a .bin file')
+    parser.add_argument('--output_dir', type=str, default='data_bin', help='convert: directory of the .bin files')
+    opt = parser.parse_args()
+    if opt.mode == 'convert':
+        convert(opt.paths or sorted(glob.glob('data_combine_*')), opt.output_dir)
+        return
+    for path in opt.paths:
+        corpus = Corpus(resolve(path))
+        for i in range(len(corpus)):
+            sys.stdout.buffer.write(''.join(corpus.lines(i)).encode('utf-8'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+"""
+sqlite store of a corpus and of its tokenized prompts, updated one document at a time.
+
+documents are kept by doc id with the sha1 of their text. the examples of PromptDataset (per task,
+max_length and, for M2M, num_for_M) are kept with the hash of the document they were built from, so
+putting a corrected document drops its examples and the next dataset re-tokenizes that document
+only. fold views (fold{k}_train, fold{k}_test) are ordered lists of doc ids; adding, moving or
+removing a document edits its own rows of the views.
+
+    # mirror the fold files, or a source file with the folds.tsv of divide_fold.py (CCRC fold
+    # files reuse doc ids across folds)
+    python corpus_store.py sync --store store/ECPE.sqlite --dataset data_combine_ECPE/ --first_wins
+    python corpus_store.py sync --store store/CCRC.sqlite --manifest data_combine_CCRC/folds.tsv
+    # new or corrected documents, tested on fold 3 and trained on by the other folds
+    python corpus_store.py put --store store/ECPE.sqlite --input new_docs.txt --fold 3
+    python corpus_store.py remove --store store/ECPE.sqlite --doc_ids 17,42
+    # tokenize what is missing or stale, or write the views back out as fold files
+    python corpus_store.py build --store store/ECPE.sqlite --task ECPE
+    python corpus_store.py export --store store/ECPE.sqlite --output_dir data_store_ECPE/
+
+the task scripts (--corpus_store, through MyDataset.from_store and script_data), multitask.py
+(--ECPE_corpus_store ...) and sweep.py (--corpus_store) read their datasets from a store.
+"""
+import argparse
+import collections
+import glob
+import hashlib
+import json
+import os
+import pickle
+import re
+import sqlite3
+import time
+import numpy as np
+import prompt_utils
+
+# value of the padding of each array of an example, trimmed in the store
+_pads = {'input_ids': prompt_utils.pad_id, 'y_bert': prompt_utils.pad_id, 'label': -100, 'mask_label': -100}
+_chunk = 500
+
+
+def doc_hash(doc):
+    return hashlib.sha1(prompt_utils.format_doc(doc).encode('utf-8')).hexdigest()
+
+
+def tokenizer_hash(tokenizer):
+    vocab = sorted(tokenizer.get_vocab().items(), key=lambda item: item[1])
+    return hashlib.sha1(json.dumps([type(tokenizer).__name__, vocab]).encode('utf-8')).hexdigest()
+
+
+def parse_doc(text):
+    lines = text.split('\n')
+    header = lines[0].split()
+    return prompt_utils.make_doc(header, prompt_utils.parse_pairs(lines[1]),
+                                 [line.strip() for line in lines[2:2 + int(header[1])]])
+
+
+def pack(example):
+    out = {}
+    for key, value in example.items():
+        if key in _pads:
+            kept = np.flatnonzero(value != _pads[key])
+            value = value[:kept[-1] + 1 if len(kept) else 0].astype(np.int32)
+        out[key] = value
+    return sqlite3.Binary(pickle.dumps(out, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def unpack(data, max_length):
+    example = pickle.loads(data)
+    length = max_length or len(example['input_ids'])
+    for key, pad in _pads.items():
+        value = example[key]
+        example[key] = np.concatenate([value, np.full(length - len(value), pad, dtype=np.int32)]).astype(np.int64)
+    return example
+
+
+def fold_views(folds):
+    return ['fold{}_{}'.format(k, split) for k in range(1, folds + 1) for split in ('train', 'test')]
+
+
+class CorpusStore(object):
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS docs (doc_id TEXT PRIMARY KEY, hash TEXT, text TEXT);
+            CREATE TABLE IF NOT EXISTS examples (task TEXT, variant TEXT, doc_id TEXT, hash TEXT, data BLOB,
+                                                 PRIMARY KEY (task, variant, doc_id));
+            CREATE TABLE IF NOT EXISTS views (view TEXT, position INTEGER, doc_id TEXT, PRIMARY KEY (view, position));
+            CREATE INDEX IF NOT EXISTS views_doc ON views (doc_id);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        ''')
+        self.counters = collections.Counter()
+        self.tokenizers = {}
+
+    def _rows(self, query, ids, *args):
+        """rows of query for ids, given to its IN (...) in chunks"""
+        ids = list(ids)
+        for start in range(0, len(ids), _chunk):
+            part = ids[start:start + _chunk]
+            for row in self.db.execute(query.format(','.join('?' * len(part))), args + tuple(part)):
+                yield row
+
+    # documents
+
+    def hashes(self, doc_ids):
+        return dict(self._rows('SELECT doc_id, hash FROM docs WHERE doc_id IN ({})', set(doc_ids)))
+
+    def doc(self, doc_id):
+        row = self.db.execute('SELECT text FROM docs WHERE doc_id = ?', (doc_id,)).fetchone()
+        if row is None:
+            raise KeyError('doc id {} is not in {}'.format(doc_id, self.path))
+        return parse_doc(row[0])
+
+    def put(self, docs):
+        """add or replace documents by doc id; counts of added, changed and unchanged"""
+        docs = list(docs)
+        known = self.hashes(doc['doc_id'] for doc in docs)
+        counts = collections.Counter()
+        with self.db:
+            for doc in docs:
+                doc_id, h = doc['doc_id'], doc_hash(doc)
+                if known.get(doc_id) == h:
+                    counts['unchanged'] += 1
+                    continue
+                self.db.execute('INSERT OR REPLACE INTO docs VALUES (?, ?, ?)',
+                                (doc_id, h, prompt_utils.format_doc(doc)))
+                if doc_id in known:
+                    self.db.execute('DELETE FROM examples WHERE doc_id = ?', (doc_id,))
+                counts['changed' if doc_id in known else 'added'] += 1
+                known[doc_id] = h
+        return counts
+
+    def remove(self, doc_ids):
+        """drop documents, their examples and their rows of the views"""
+        doc_ids = list(doc_ids)
+        with self.db:
+            for table in ('docs', 'examples', 'views'):
+                for start in range(0, len(doc_ids), _chunk):
+                    part = doc_ids[start:start + _chunk]
+                    self.db.execute('DELETE FROM {} WHERE doc_id IN ({})'.format(table, ','.join('?' * len(part))),
+                                    part)
+
+    def prune(self):
+        """drop the documents that are in no view; returns their number"""
+        with self.db:
+            self.db.execute('DELETE FROM examples WHERE doc_id NOT IN (SELECT doc_id FROM views)')
+            return self.db.execute('DELETE FROM docs WHERE doc_id NOT IN (SELECT doc_id FROM views)').rowcount
+
+    # views
+
+    def views(self):
+        return [row[0] for row in self.db.execute('SELECT DISTINCT view FROM views ORDER BY view')]
+
+    def view(self, name):
+        return [row[0] for row in self.db.execute('SELECT doc_id FROM views WHERE view = ? ORDER BY position', (name,))]
+
+    def set_view(self, name, doc_ids):
+        with self.db:
+            self.db.execute('DELETE FROM views WHERE view = ?', (name,))
+            self.db.executemany('INSERT INTO views VALUES (?, ?, ?)',
+                                [(name, position, doc_id) for position, doc_id in enumerate(doc_ids)])
+
+    def append(self, name, doc_ids):
+        """add doc ids at the end of a view, those already in it stay where they are"""
+        present = set(self.view(name))
+        last = self.db.execute('SELECT MAX(position) FROM views WHERE view = ?', (name,)).fetchone()[0]
+        rows, position = [], -1 if last is None else last
+        for doc_id in doc_ids:
+            if doc_id not in present:
+                position += 1
+                rows.append((name, position, doc_id))
+                present.add(doc_id)
+        with self.db:
+            self.db.executemany('INSERT INTO views VALUES (?, ?, ?)', rows)
+
+    def n_folds(self):
+        return len([name for name in self.views() if re.match(r'fold\d+_test$', name)]) or 10
+
+    def assign(self, doc_ids, fold, folds=None):
+        """
+        move documents to the test split of fold and the train split of the other folds (fold 0: in no
+        test split, as in folds.tsv); the other documents of the views keep their positions
+        """
+        doc_ids = list(doc_ids)
+        folds = folds or self.n_folds()
+        if not 0 <= fold <= folds:
+            raise ValueError('fold {} is not one of the {} folds of the store'.format(fold, folds))
+        names = fold_views(folds)
+        with self.db:
+            for start in range(0, len(doc_ids), _chunk):
+                part = doc_ids[start:start + _chunk]
+                self.db.execute('DELETE FROM views WHERE view IN ({}) AND doc_id IN ({})'.format(
+                    ','.join('?' * len(names)), ','.join('?' * len(part))), names + part)
+        for name in names:
+            k, split = re.match(r'fold(\d+)_(\w+)', name).groups()
+            if (split == 'test') == (int(k) == fold):
+                self.append(name, doc_ids)
+
+    def fingerprint(self, name):
+        """sha1 of the doc ids and hashes of a view in order, changes with any document of it"""
+        h = hashlib.sha1()
+        for doc_id, doc in self.db.execute('SELECT views.doc_id, docs.hash FROM views JOIN docs USING (doc_id) '
+                                           'WHERE view = ? ORDER BY position', (name,)):
+            h.update('{}:{}\n'.format(doc_id, doc).encode('utf-8'))
+        return h.hexdigest()
+
+    def mirror(self, views, first_wins=False):
+        """
+        make the store hold exactly views ({name: documents}): documents are put, every view is
+        replaced and documents of no view are dropped. a doc id with two different documents is an
+        error unless first_wins.
+        """
+        first, conflicts = collections.OrderedDict(), []
+        for docs in views.values():
+            for doc in docs:
+                h = doc_hash(doc)
+                if first.setdefault(doc['doc_id'], (h, doc))[0] != h:
+                    conflicts.append(doc['doc_id'])
+        if conflicts and not first_wins:
+            raise ValueError('{} doc ids have different documents (e.g. {}); sync a source file with its folds.tsv '
+                             'manifest, or keep the first with first_wins'.format(len(set(conflicts)),
+                                                                                 ', '.join(sorted(set(conflicts))[:5])))
+        counts = self.put(doc for _, doc in first.values())
+        with self.db:
+            self.db.execute('DELETE FROM views')
+        for name, docs in views.items():
+            self.set_view(name, [doc['doc_id'] for doc in docs])
+        counts['removed'] = self.prune()
+        counts['conflicts'] = len(set(conflicts))
+        return counts
+
+    def sync_folds(self, dataset, first_wins=False):
+        """mirror the fold{k}_train / fold{k}_test files (text or binary corpus) of a directory"""
+        names = sorted(set(os.path.splitext(os.path.basename(path))[0]
+                           for pattern in ('fold*_train.*', 'fold*_test.*')
+                           for path in glob.glob(os.path.join(dataset, pattern))
+                           if path.endswith(('.txt', '.bin'))))
+        return self.mirror(collections.OrderedDict(
+            (name, list(prompt_utils.read_docs(os.path.join(dataset, name + '.txt')))) for name in names), first_wins)
+
+    def sync_manifest(self, manifest, folds=None):
+        """mirror the folds of a folds.tsv manifest; the doc ids are those of the manifest"""
+        with open(manifest, encoding='utf-8') as f:
+            settings = dict(item.split('=', 1) for item in f.readline()[1:].split())
+        views = collections.OrderedDict()
+        for name in fold_views(folds or int(settings['folds'])):
+            k, split = re.match(r'fold(\d+)_(\w+)', name).groups()
+            views[name] = list(prompt_utils.read_split(manifest, int(k), split))
+        return self.mirror(views)
+
+    # examples
+
+    def check_tokenizer(self, tokenizer):
+        """the examples of an other tokenizer are dropped"""
+        if id(tokenizer) not in self.tokenizers:
+            self.tokenizers[id(tokenizer)] = tokenizer_hash(tokenizer)
+        h = self.tokenizers[id(tokenizer)]
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'tokenizer'").fetchone()
+        if row is None or row[0] != h:
+            with self.db:
+                if row is not None:
+                    self.db.execute('DELETE FROM examples')
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('tokenizer', ?)", (h,))
+
+    def examples(self, task, doc_ids, tokenizer, max_length=512, num_for_M=2, store=None):
+        """
+        the build_example output of every doc id: read from the store when it was built from the
+        current document, built (through the TokenStore store) and written otherwise
+        """
+        self.check_tokenizer(tokenizer)
+        variant = '{}/{}'.format(max_length, num_for_M if task == 'M2M' else '')
+        hashes = self.hashes(doc_ids)
+        cached = {doc_id: (h, data) for doc_id, h, data in self._rows(
+            'SELECT doc_id, hash, data FROM examples WHERE task = ? AND variant = ? AND doc_id IN ({})',
+            set(doc_ids), task, variant)}
+        out, built = [], []
+        for doc_id in doc_ids:
+            if doc_id not in hashes:
+                raise KeyError('doc id {} is not in {}'.format(doc_id, self.path))
+            h, data = cached.get(doc_id, (None, None))
+            if h == hashes[doc_id]:
+                out.append(unpack(data, max_length))
+                self.counters['hits'] += 1
+                continue
+            example = prompt_utils.build_example(task, self.doc(doc_id), tokenizer, max_length, num_for_M, store)
+            out.append(example)
+            built.append((task, variant, doc_id, hashes[doc_id], pack(example)))
+            cached[doc_id] = (hashes[doc_id], built[-1][-1])
+            self.counters['built'] += 1
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO examples VALUES (?, ?, ?, ?, ?)', built)
+        return out
+
+    def dataset(self, task, view, tokenizer, max_length=512, num_for_M=2, verbose=True, store=None):
+        """PromptDataset of a view"""
+        doc_ids = self.view(view)
+        if not doc_ids:
+            raise KeyError('no view {} in {}'.format(view, self.path))
+        examples = self.examples(task, doc_ids, tokenizer, max_length, num_for_M, store)
+        return prompt_utils.PromptDataset.from_examples(task, doc_ids, examples, max_length, verbose)
+
+    def script_data(self, task, view, tokenizer, num_for_M=2):
+        """
+        the arrays of MyDataset of a task script for a view, through dataset(): only the documents
+        changed since the last run are tokenized. train_ids, the input the training targets are
+        picked from (x_bert of ECE.py), is recovered from mask_label
+        """
+        data = dict(self.dataset(task, view, tokenizer, 512, num_for_M, verbose=False).data)
+        data['train_ids'] = np.where(data['mask_label'] != -100, prompt_utils.mask_id, data['input_ids'])
+        return data
+
+    def export(self, view, path):
+        """a view as a fold file of the text format"""
+        texts = dict(self._rows('SELECT doc_id, text FROM docs WHERE doc_id IN ({})', set(self.view(view))))
+        with open(path, 'w', encoding='utf-8') as f:
+            for doc_id in self.view(view):
+                f.write(texts[doc_id])
+
+    def stats(self):
+        stats = {name: self.db.execute('SELECT COUNT(*) FROM {}'.format(name)).fetchone()[0]
+                 for name in ('docs', 'examples')}
+        stats['views'] = {name: len(self.view(name)) for name in self.views()}
+        stats.update(self.counters)
+        return stats
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='incremental corpus and prompt store')
+    parser.add_argument('mode', choices=['sync', 'put', 'remove', 'build', 'export', 'stats'])
+    parser.add_argument('--store', type=str, required=True, help='sqlite file of the store')
+    parser.add_argument('--dataset', type=str, default='', help='sync: directory of the fold files')
+    parser.add_argument('--manifest', type=str, default='', help='sync: folds.tsv of divide_fold.py instead')
+    parser.add_argument('--first_wins', action='store_true', help='sync: keep the first of two documents of an id')
+    parser.add_argument('--input', type=str, default='', help='put: file of documents in the text format')
+    parser.add_argument('--fold', type=int, default=0, help='put: test fold of the documents, 0 keeps the views')
+    parser.add_argument('--doc_ids', type=str, default='', help='remove: comma separated doc ids')
+    parser.add_argument('--task', type=str, default='ECPE', choices=prompt_utils.tasks)
+    parser.add_argument('--bert_path', type=str, default='./bert-base-chinese', help='tokenizer')
+    parser.add_argument('--max_length', type=int, default=512)
+    parser.add_argument('--num_for_M', type=int, default=2, help='for M2M module')
+    parser.add_argument('--views', type=str, default='', help='build / export: comma separated, default all')
+    parser.add_argument('--output_dir', type=str, default='', help='export: directory of the fold files')
+    opt = parser.parse_args()
+
+    start = time.time()
+    store = CorpusStore(opt.store)
+    views = [v for v in opt.views.split(',') if v] or store.views()
+    if opt.mode == 'sync':
+        if opt.manifest:
+            counts = store.sync_manifest(opt.manifest)
+        else:
+            counts = store.sync_folds(opt.dataset, opt.first_wins)
+        print(dict(counts))
+    elif opt.mode == 'put':
+        docs = list(prompt_utils.read_docs(opt.input))
+        print(dict(store.put(docs)))
+        if opt.fold:
+            store.assign([doc['doc_id'] for doc in docs], opt.fold)
+    elif opt.mode == 'remove':
+        store.remove([d for d in opt.doc_ids.split(',') if d])
+    elif opt.mode == 'build':
+        from transformers import BertTokenizer
+        tokenizer = BertTokenizer.from_pretrained(opt.bert_path)
+        token_store = prompt_utils.TokenStore(tokenizer)
+        for view in views:
+            store.examples(opt.task, store.view(view), tokenizer, opt.max_length, opt.num_for_M, token_store)
+    elif opt.mode == 'export':
+        os.makedirs(opt.output_dir, exist_ok=True)
+        for view in views:
+            store.export(view, os.path.join(opt.output_dir, view + '.txt'))
+    stats = store.stats()
+    print('{docs} documents, {examples} examples, {n} views{built}, {seconds:.1f}s'.format(
+        n=len(stats['views']), built=', {} built, {} reused'.format(stats.get('built', 0), stats.get('hits', 0))
+        if opt.mode == 'build' else '', seconds=time.time() - start, **stats))
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,101 +1,172 @@
 # encoding: utf-8
+"""
+build the conditional-ECPE dataset (data_wneg.txt) from data.txt.
+
+every document is written as it is (label 1), followed by n documents whose context clauses come
+from n other random documents (label 1 - conditional) and n documents whose emotion clause comes
+from n random documents with an other emotion (label 0). the n documents of each kind are drawn
+without replacement; the candidates of the emotion negatives come from an index of the documents
+by emotion, so nothing is drawn twice or re-parsed.
+
+the draws of every chunk of --chunk_size documents come from its own seed derived from --seed,
+so the output only depends on the seed (and the chunk size), not on the number of --workers.
+
+    python gen_nega_samples.py                       # data.txt -> data_wneg.txt, n = 2
+    python gen_nega_samples.py --n 5 --seed 1 --workers 8
+"""
+import argparse
+import multiprocessing
+import re
 import numpy as np
 
+_docs = []
+_index = {}
 
-def write_a_doc(ofile, doc_num, label, cond_label, doclen, line1, emo, cau, emo_list, cau_list, con_list):
-    ofile.write("{} {} {} {}\n".format(doc_num, doclen, label, cond_label))
-    ofile.write(line1)
-    caucnt = 0
-    concnt = 0
-    for i in range(doclen):
-        if i + 1 in emo:
-            ori_line = emo_list[0].strip().split(",")
-            ofile.write("{},{},{},{}\n".format(i + 1, ori_line[1], ori_line[2], ori_line[3]))
-        elif i + 1 in cau:
-            ofile.write(cau_list[caucnt])
-            caucnt += 1
-        else:
-            if concnt < len(con_list):
-                ori_line = con_list[concnt].strip().split(",")[3]
-                concnt += 1
-                ofile.write("{},null,null,{}\n".format(i + 1, ori_line))
+
+def read_docs(path):
+    """
+    documents of data.txt with their emotion, cause and other (context) clause lines, split into
+    the fields the output needs once, here
+    """
+    data = open(path, 'r', encoding='utf-8').readlines()
+    docs = []
+    i = 0
+    while i < len(data):
+        doclen = int(data[i].split(" ")[1])
+        pairs = [(int(e), int(c)) for e, c in re.findall(r'\((\d+),\s*(\d+)\)', data[i + 1])]
+        emo, cau = zip(*pairs)
+        emo_list, cau_list, con_list = [], [], []
+        for j in range(doclen):
+            line = data[i + 2 + j]
+            if j + 1 in emo:
+                emo_list.append(line)
+                if j + 1 in cau:
+                    cau_list.append(line)
+            elif j + 1 in cau:
+                cau_list.append(line)
+            else:
+                con_list.append(line)
+        emotion = emo_list[0].strip().split(",")
+        # the clauses of the output in order: an emotion clause, a cause line as it is, or a context clause
+        slots, caucnt = [], 0
+        for j in range(1, doclen + 1):
+            if j in emo:
+                slots.append((str(j), 'emotion'))
+            elif j in cau:
+                slots.append((cau_list[caucnt], 'cause'))
+                caucnt += 1
             else:
-                ofile.write("{},null,null,\n".format(i + 1))
-
-
-data = open("data.txt", 'r', encoding='utf-8').readlines()
-ofile = open("data_wneg.txt", 'w', encoding='utf-8')
-# if you want to create the dataset with different n, change the following values
-n = 2
-
-doc_content = {}
-doc_id = 0
-i = 0
-while i < len(data):
-    if data[i] == "":
-        break
-    doclen = int(data[i].split(" ")[1])
-    content_list = []
-    content_list.append(data[i])
-    content_list.append(data[i + 1])
-    pairs = eval('[' + data[i + 1].strip() + ']')
-    emo, cau = zip(*pairs)
-    content_list.append(emo)
-    content_list.append(cau)
-    emo_list = []
-    cau_list = []
-    con_list = []
-    for j in range(doclen):
-        if j + 1 in emo:
-            emo_list.append(data[i + 2 + j])
-            if j + 1 in cau:
-                cau_list.append(data[i + 2 + j])
-        elif j + 1 in cau:
-            cau_list.append(data[i + 2 + j])
+                slots.append((str(j) + ',null,null,', 'context'))
+        docs.append({'header': ' {} '.format(doclen), 'line1': data[i + 1], 'slots': slots,
+                     'label': int(data[i].strip().split(" ")[2]), 'emoword': emotion[1],
+                     'emotion': ',{},{},{}\n'.format(emotion[1], emotion[2], emotion[3]),
+                     'context': [line.strip().split(",")[3] for line in con_list]})
+        i += doclen + 2
+    return docs
+
+
+def format_doc(doc_num, label, cond_label, doc, emotion, context):
+    """
+    one document of the output: the cause clauses of doc, the emotion clause fields of emotion (at
+    every emotion position) and the context clause texts of context in order, empty when they run out
+    """
+    out = [str(doc_num) + doc['header'] + '{} {}\n'.format(label, cond_label), doc['line1']]
+    texts = iter(context)
+    for text, kind in doc['slots']:
+        if kind == 'emotion':
+            out.append(text + emotion)
+        elif kind == 'cause':
+            out.append(text)
+        else:
+            out.append(text + next(texts, '') + '\n')
+    return ''.join(out)
+
+
+def sample_rows(rng, pool_size, rows, n):
+    """rows x n indices into range(pool_size), distinct within a row, every ordered n-tuple equally likely"""
+    if n > pool_size:
+        raise ValueError('{} negatives asked from {} candidates'.format(n, pool_size))
+    if 2 * n > pool_size:
+        return np.argsort(rng.random((rows, pool_size)), axis=1)[:, :n]
+    out = rng.integers(0, pool_size, (rows, n))
+    while n > 1:
+        ordered = np.sort(out, axis=1)
+        repeated = (ordered[:, 1:] == ordered[:, :-1]).any(axis=1)
+        if not repeated.any():
+            break
+        # redraw whole rows, which keeps the rows uniform over distinct tuples
+        out[repeated] = rng.integers(0, pool_size, (int(repeated.sum()), n))
+    return out
+
+
+def emotion_index(emowords):
+    """emotion word -> indices of the documents with an other emotion word"""
+    return {word: np.flatnonzero(emowords != word) for word in np.unique(emowords)}
+
+
+def sample_negatives(emowords, index, start, stop, n, rng):
+    """context and emotion negatives of documents start..stop-1, as [stop - start, n] document indices"""
+    rows = stop - start
+    context = sample_rows(rng, len(emowords), rows, n)
+    emotion = np.empty((rows, n), dtype=np.int64)
+    chunk = emowords[start:stop]
+    for word in np.unique(chunk):
+        selected = np.flatnonzero(chunk == word)
+        emotion[selected] = index[word][sample_rows(rng, len(index[word]), len(selected), n)]
+    return context, emotion
+
+
+def init_worker(docs):
+    global _docs
+    _docs = docs
+    emowords = np.array([doc['emoword'] for doc in docs])
+    _index.update(emowords=emowords, others=emotion_index(emowords))
+
+
+def generate_chunk(job):
+    start, stop, n, seed = job
+    context, emotion = sample_negatives(_index['emowords'], _index['others'], start, stop, n,
+                                        np.random.default_rng(seed))
+    out = []
+    for row, doc_id in enumerate(range(start, stop)):
+        doc = _docs[doc_id]
+        doc_num = doc_id * (2 * n + 1) + 1
+        out.append(format_doc(doc_num, 1, doc['label'], doc, doc['emotion'], doc['context']))
+        for k, nega_index in enumerate(context[row]):
+            out.append(format_doc(doc_num + 1 + k, 1 - doc['label'], doc['label'], doc, doc['emotion'],
+                                  _docs[nega_index]['context']))
+        for k, nega_index in enumerate(emotion[row]):
+            out.append(format_doc(doc_num + 1 + n + k, 0, doc['label'], doc, _docs[nega_index]['emotion'],
+                                  doc['context']))
+    return ''.join(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='conditional-ECPE dataset with negative samples')
+    parser.add_argument('--input', type=str, default='data.txt')
+    parser.add_argument('--output', type=str, default='data_wneg.txt')
+    # if you want to create the dataset with different n, change this value
+    parser.add_argument('--n', type=int, default=2, help='negative documents of each kind per document')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1, help='processes formatting the documents')
+    parser.add_argument('--chunk_size', type=int, default=1000, help='documents per job, part of the seed')
+    opt = parser.parse_args()
+
+    docs = read_docs(opt.input)
+    bounds = list(range(0, len(docs), opt.chunk_size))
+    seeds = np.random.SeedSequence(opt.seed).spawn(len(bounds))
+    jobs = [(start, min(start + opt.chunk_size, len(docs)), opt.n, seed) for start, seed in zip(bounds, seeds)]
+    with open(opt.output, 'w', encoding='utf-8') as ofile:
+        if opt.workers > 1:
+            with multiprocessing.Pool(opt.workers, initializer=init_worker, initargs=(docs,)) as pool:
+                for text in pool.imap(generate_chunk, jobs):
+                    ofile.write(text)
         else:
-            con_list.append(data[i + 2 + j])
-
-    content_list.append(emo_list)
-    content_list.append(cau_list)
-    content_list.append(con_list)
-
-    doc_content[doc_id] = content_list
-    doc_id += 1
-    i += doclen + 2
-
-doc_num = 1
-for doc_id in range(len(doc_content)):
-    content_list = doc_content[doc_id]
-    [line0, line1, emo, cau, emo_list, cau_list, con_list] = content_list
-    emoword = emo_list[0].split(",")[1]
-    doclen = int(line0.strip().split(" ")[1])
-    label = int(line0.strip().split(" ")[2])
-    mark_nega_index = {}
-    # generate original samples
-    write_a_doc(ofile, doc_num, 1, label, doclen, line1, emo, cau, emo_list, cau_list, con_list)
-    doc_num += 1
-
-    # generate negative samples
-    mark_nega_index = {}
-    for cnt in range(n):
-        nega_index = np.random.randint(len(doc_content))
-        while (nega_index in mark_nega_index):
-            nega_index = np.random.randint(len(doc_content))
-        mark_nega_index[nega_index] = 1
-
-        nega_con_list = doc_content[nega_index][6]
-        write_a_doc(ofile, doc_num, 1 - label, label, doclen, line1, emo, cau, emo_list, cau_list, nega_con_list)
-        doc_num += 1
-
-    mark_nega_index = {}
-    for cnt in range(n):
-        nega_index = np.random.randint(len(doc_content))
-        negaemoword = doc_content[nega_index][4][0].split(",")[1]
-        while (nega_index in mark_nega_index or negaemoword == emoword):
-            nega_index = np.random.randint(len(doc_content))
-            negaemoword = doc_content[nega_index][4][0].split(",")[1]
-        mark_nega_index[nega_index] = 1
-
-        nega_emo_list = doc_content[nega_index][4]
-        write_a_doc(ofile, doc_num, 0, label, doclen, line1, emo, cau, nega_emo_list, cau_list, con_list)
-        doc_num += 1
+            init_worker(docs)
+            for job in jobs:
+                ofile.write(generate_chunk(job))
+    print('{} documents, {} written to {}'.format(len(docs), len(docs) * (2 * opt.n + 1), opt.output))
+
+
+if __name__ == '__main__':
+    main()
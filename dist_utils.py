@@ -0,0 +1,154 @@
+"""
+helpers for data-parallel training of the task scripts, launched with torchrun:
+
+    OMP_NUM_THREADS=8 torchrun --nproc_per_node 2 ECPE.py --dataset data_combine_ECPE_balance/
+
+without torchrun (WORLD_SIZE unset) every helper falls back to the single-process behaviour.
+"""
+import collections
+import contextlib
+import os
+import random
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Sampler, Subset
+from torch.utils.data.distributed import DistributedSampler
+
+
+def init_distributed(backend='gloo'):
+    """join the process group created by torchrun, return (rank, world_size)"""
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def wrap_model(model):
+    if not is_distributed():
+        return model
+    return torch.nn.parallel.DistributedDataParallel(model)
+
+
+def unwrap_model(model):
+    return model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
+
+
+class GroupedSampler(Sampler):
+    """
+    batch sampler of whole groups (e.g. prompt_utils.variant_groups): the shuffled groups are packed,
+    best fit, into global batches of at most batch_size documents, so every group trains in one step.
+    only a group larger than batch_size is cut into batch_size pieces. a batch the groups do not fill
+    stays short, every rank takes its strided share of each global batch and a batch with fewer
+    documents than ranks is dropped
+    """
+
+    def __init__(self, groups, batch_size, rank=0, world_size=1, seed=0):
+        self.members = {}
+        for index, group in enumerate(groups):
+            self.members.setdefault(group, []).append(index)
+        self.batch_size = batch_size
+        self.rank = rank
+        self.world_size = world_size
+        # one seed on every rank, as in DistributedSampler, so the ranks cut the same order
+        self.seed = seed
+        self.epoch = 0
+        self.packed = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        """global batches of this epoch, in the order they were opened"""
+        if self.packed is not None and self.packed[0] == self.epoch:
+            return self.packed[1]
+        order = list(self.members.values())
+        random.Random(self.seed * 100003 + self.epoch).shuffle(order)
+        batches = []
+        # room -> open batches with that many free places, oldest first
+        room = {r: collections.deque() for r in range(1, self.batch_size)}
+        for members in order:
+            for k in range(0, len(members), self.batch_size):
+                piece = members[k:k + self.batch_size]
+                fit = next((r for r in range(len(piece), self.batch_size) if room[r]), None)
+                if fit is None:
+                    batch, fit = [], self.batch_size
+                    batches.append(batch)
+                else:
+                    batch = room[fit].popleft()
+                batch.extend(piece)
+                if fit > len(piece):
+                    room[fit - len(piece)].append(batch)
+        batches = [batch for batch in batches if len(batch) >= self.world_size]
+        self.packed = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield batch[self.rank::self.world_size]
+
+    def __len__(self):
+        return len(self.batches())
+
+
+def train_loader(dataset, batch_size, rank=0, world_size=1, groups=None):
+    """
+    every rank draws batch_size // world_size documents per step, so the global batch matches
+    a single-process run with the same --batch_size. with groups, the documents of a group are
+    drawn in the same step and a batch may be shorter (GroupedSampler)
+    """
+    if world_size > 1 and batch_size % world_size != 0:
+        raise ValueError('batch_size {} is not divisible by world size {}'.format(batch_size, world_size))
+    if groups is not None:
+        return DataLoader(dataset, batch_sampler=GroupedSampler(groups, batch_size, rank, world_size))
+    if world_size == 1:
+        return DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True, drop_last=True)
+    return DataLoader(dataset, batch_size=batch_size // world_size, sampler=sampler, drop_last=True)
+
+
+def test_loader(dataset, batch_size, rank=0, world_size=1):
+    """
+    strided shard of the test set; unlike DistributedSampler nothing is padded or repeated,
+    so the reduced metric counters equal the single-process ones
+    """
+    if world_size == 1:
+        return DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    return DataLoader(Subset(dataset, range(rank, len(dataset), world_size)), batch_size=batch_size, shuffle=False)
+
+
+def set_epoch(loader, epoch):
+    if isinstance(loader.sampler, (DistributedSampler, GroupedSampler)):
+        loader.sampler.set_epoch(epoch)
+
+
+def maybe_no_sync(model, update):
+    """skip the gradient all-reduce on accumulation steps that do not call optimizer.step()"""
+    if update or not isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+
+def all_reduce_counts(counts):
+    """sum a list of metric counters over all ranks"""
+    counts = [float(c) for c in counts]
+    if not is_distributed():
+        return counts
+    buf = torch.tensor(counts, dtype=torch.float64)
+    dist.all_reduce(buf, op=dist.ReduceOp.SUM)
+    return buf.tolist()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
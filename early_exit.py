@@ -0,0 +1,374 @@
+"""
+early-exit inference for prompt_bert.
+
+small heads on intermediate BERT layers predict the verbalizer tokens (是/非/无 and the clause
+numbers) at the mask positions. a batch stops at the first head whose softmax is at least
+--exit_threshold for every mask slot, otherwise it runs all layers and the normal MLM head.
+
+    # 1. fit the heads of every fold on its training file (backbone frozen)
+    python early_exit.py --mode train --task ECPE --dataset data_combine_ECPE/ \
+        --checkpointpath checkpoint/ECPE/ --heads_path checkpoint/ECPE_exit/
+    # 2. pick the threshold with the largest saving whose F1 drop stays below --target_f1_loss
+    python early_exit.py --mode calibrate --task ECPE --dataset data_combine_ECPE/ \
+        --checkpointpath checkpoint/ECPE/ --heads_path checkpoint/ECPE_exit/ --target_f1_loss 0.005
+    # 3. latency / F1 of the calibrated threshold against the full model
+    python early_exit.py --mode report --task ECPE --dataset data_combine_ECPE/ \
+        --checkpointpath checkpoint/ECPE/ --heads_path checkpoint/ECPE_exit/
+
+the task scripts use the heads with --early_exit_path checkpoint/ECPE_exit/, at the threshold calibrated
+for the task in early_exit_thresholds.json (or the one saved with the heads), unless --exit_threshold is set
+"""
+import argparse
+import json
+import os
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from transformers import BertTokenizer
+from transformers.activations import ACT2FN
+import prompt_utils
+from prompt_utils import mask_id, verbalizer_ids, vocab_size
+
+
+class ExitHead(torch.nn.Module):
+    """BERT MLM head restricted to the verbalizer tokens"""
+
+    def __init__(self, config):
+        super(ExitHead, self).__init__()
+        self.dense = torch.nn.Linear(config.hidden_size, config.hidden_size)
+        self.act = ACT2FN[config.hidden_act]
+        self.LayerNorm = torch.nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
+        self.decoder = torch.nn.Linear(config.hidden_size, len(verbalizer_ids))
+
+    def init_from(self, cls):
+        """start from the final MLM head, which already maps hidden states to the verbalizers"""
+        transform = cls.predictions.transform
+        self.dense.load_state_dict(transform.dense.state_dict())
+        self.LayerNorm.load_state_dict(transform.LayerNorm.state_dict())
+        ids = torch.tensor(verbalizer_ids)
+        with torch.no_grad():
+            self.decoder.weight.copy_(cls.predictions.decoder.weight[ids])
+            self.decoder.bias.copy_(cls.predictions.decoder.bias[ids])
+
+    def forward(self, hidden):
+        return self.decoder(self.LayerNorm(self.act(self.dense(hidden))))
+
+
+def expand_logits(verb_logits, sel):
+    """scatter verbalizer logits into a [batch, seq, vocab] tensor the script scorers can read"""
+    logits = verb_logits.new_full(sel.shape + (vocab_size,), -1e4)
+    rows = verb_logits.new_full((verb_logits.shape[0], vocab_size), -1e4)
+    rows[:, verbalizer_ids] = verb_logits
+    logits[sel] = rows
+    return logits
+
+
+class EarlyExitBert(torch.nn.Module):
+    def __init__(self, model, exit_layers=(4, 6, 8, 10), threshold=1.0):
+        super(EarlyExitBert, self).__init__()
+        self.model = model
+        config = model.bert.config
+        self.n_layers = config.num_hidden_layers
+        self.exit_layers = sorted(set(l for l in exit_layers if 0 < l < self.n_layers))
+        self.heads = torch.nn.ModuleDict({str(l): ExitHead(config) for l in self.exit_layers})
+        for head in self.heads.values():
+            head.init_from(model.bert.cls)
+        self.threshold = threshold
+        self.exit_history = []
+
+    def hidden_states(self, x_bert):
+        """yield (layer, hidden) after every encoder layer; no attention mask, like the scripts"""
+        bert = self.model.bert.bert
+        hidden = bert.embeddings(input_ids=x_bert)
+        for layer_id, layer in enumerate(bert.encoder.layer, 1):
+            out = layer(hidden)
+            hidden = out[0] if isinstance(out, tuple) else out
+            yield layer_id, hidden
+
+    def forward(self, x_bert, labels=None):
+        sel = x_bert == mask_id
+        hidden = None
+        for layer_id, hidden in self.hidden_states(x_bert):
+            if str(layer_id) not in self.heads:
+                continue
+            verb_logits = self.heads[str(layer_id)](hidden[sel])
+            confidence = F.softmax(verb_logits, dim=-1).max(-1)[0]
+            if bool((confidence >= self.threshold).all()):
+                self.exit_history.append(layer_id)
+                return None, expand_logits(verb_logits, sel)
+        self.exit_history.append(self.n_layers)
+        return None, self.model.bert.cls(hidden)
+
+    def save(self, path):
+        torch.save({'exit_layers': self.exit_layers, 'threshold': self.threshold,
+                    'state_dict': self.heads.state_dict()}, path)
+
+
+def attach(model, path, threshold=None):
+    """wrap a loaded fold model with the heads saved at path"""
+    state = torch.load(path, map_location='cpu')
+    ee = EarlyExitBert(model, state['exit_layers'], state['threshold'] if threshold is None else threshold)
+    ee.heads.load_state_dict(state['state_dict'])
+    device = next(model.parameters()).device
+    return ee.to(device)
+
+
+def verbalizer_targets(labels, sel):
+    lookup = torch.full((vocab_size,), -100, dtype=torch.long)
+    lookup[torch.tensor(verbalizer_ids)] = torch.arange(len(verbalizer_ids))
+    tokens = labels[sel].long()
+    return torch.where(tokens >= 0, lookup[tokens.clamp(min=0)], torch.full_like(tokens, -100))
+
+
+def train_heads(ee, loader, epochs=1, lr=1e-4, alpha=0.5):
+    """
+    fit the heads with the backbone frozen: cross entropy on the gold verbalizer plus KL towards
+    the final layer restricted to the verbalizers (weight alpha)
+    """
+    ee.model.eval()
+    for p in ee.model.parameters():
+        p.requires_grad_(False)
+    optimizer = torch.optim.AdamW(ee.heads.parameters(), lr=lr)
+    for epoch in range(epochs):
+        for index, batch in enumerate(loader):
+            x_bert = batch['input_ids']
+            sel = x_bert == mask_id
+            target = verbalizer_targets(batch['label'], sel)
+            states = {}
+            with torch.no_grad():
+                for layer_id, hidden in ee.hidden_states(x_bert):
+                    if str(layer_id) in ee.heads:
+                        states[layer_id] = hidden[sel]
+                teacher = F.softmax(ee.model.bert.cls(hidden[sel])[:, verbalizer_ids], dim=-1)
+            loss = 0
+            for layer_id, h in states.items():
+                head_logits = ee.heads[str(layer_id)](h)
+                loss = loss + (1 - alpha) * F.cross_entropy(head_logits, target, ignore_index=-100)
+                loss = loss + alpha * F.kl_div(F.log_softmax(head_logits, dim=-1), teacher, reduction='batchmean')
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            if index % 20 == 0:
+                print('epoch {} step {} head loss: {:.4f}'.format(epoch, index, loss.item()))
+
+
+def collect(ee, loader):
+    """
+    one full pass that keeps the mask scores of every exit head and of the last layer, so any
+    threshold can be simulated without running the model again
+    """
+    records = []
+    ee.eval()
+    with torch.no_grad():
+        for batch in loader:
+            x_bert = batch['input_ids']
+            sel = x_bert == mask_id
+            layers, confidence = {}, {}
+            hidden = None
+            for layer_id, hidden in ee.hidden_states(x_bert):
+                if str(layer_id) in ee.heads:
+                    probs = F.softmax(ee.heads[str(layer_id)](hidden[sel]), dim=-1)
+                    top = probs.argmax(-1)
+                    layers[layer_id] = (torch.tensor(verbalizer_ids)[top].numpy(), probs.numpy())
+                    confidence[layer_id] = probs.max(-1)[0].numpy()
+            full = F.softmax(ee.model.bert.cls(hidden[sel]).float(), dim=-1)
+            layers[ee.n_layers] = (full.argmax(-1).numpy(), full[:, verbalizer_ids].numpy())
+            prev = torch.cat([x_bert[:, :1], x_bert[:, :-1]], 1)[sel].numpy()
+            records.append({
+                'sizes': sel.sum(1).tolist(),
+                'layers': layers,
+                'confidence': confidence,
+                'prev': prev,
+                'gold': prompt_utils.label_tokens(batch['label'], x_bert),
+                'gt': [prompt_utils.batch_gt(batch, i) for i in range(len(x_bert))],
+            })
+    return records
+
+
+def simulate(task, records, exit_layers, n_layers, threshold, window_size=2):
+    """counters and mean executed layers if the batches of records had run with threshold"""
+    counts = prompt_utils.new_counts()
+    layers_run, n_docs = 0, 0
+    for rec in records:
+        exit_layer = n_layers
+        for layer_id in exit_layers:
+            if rec['confidence'][layer_id].size == 0 or rec['confidence'][layer_id].min() >= threshold:
+                exit_layer = layer_id
+                break
+        top1, verb = rec['layers'][exit_layer]
+        start = 0
+        for i, n in enumerate(rec['sizes']):
+            pred = prompt_utils.decode_slots(task, top1[start:start + n], verb[start:start + n],
+                                             rec['prev'][start:start + n], window_size)
+            gold = prompt_utils.decode_labels(task, rec['gold'][i])
+            prompt_utils.add_counts(counts, task, pred, gold, rec['gt'][i])
+            start += n
+        layers_run += exit_layer * len(rec['sizes'])
+        n_docs += len(rec['sizes'])
+    return counts, layers_run / max(n_docs, 1)
+
+
+def fold_list(folds):
+    return [int(f) for f in folds.split(',') if f]
+
+
+def load_fold(opt, fold, threshold=None):
+    model = prompt_utils.load_checkpoint(os.path.join(opt.checkpointpath, 'fold{}.pth'.format(fold)))
+    heads = os.path.join(opt.heads_path, 'fold{}.pth'.format(fold))
+    if os.path.exists(heads):
+        ee = attach(model, heads, threshold)
+    else:
+        ee = EarlyExitBert(model, [int(l) for l in opt.exit_layers.split(',')], 1.0 if threshold is None else threshold)
+    return ee.eval()
+
+
+def fold_dataset(opt, tokenizer, fold, split):
+    path = opt.dataset + 'fold{}_{}.txt'.format(fold, split)
+    return prompt_utils.PromptDataset(opt.task, prompt_utils.read_docs(path), tokenizer, num_for_M=opt.num_for_M)
+
+
+def read_thresholds(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def calibrated_threshold(task, path, threshold=0.):
+    """threshold when it is set (> 0), else the one calibrated for task in path, None when there is none"""
+    if threshold > 0:
+        return threshold
+    return read_thresholds(path).get(task, {}).get('threshold')
+
+
+def backbone(model):
+    """the fold model under the heads, the one to save as a checkpoint"""
+    return model.model if isinstance(model, EarlyExitBert) else model
+
+
+def run_train(opt, tokenizer):
+    for fold in fold_list(opt.folds):
+        print('############# fold {} heads ###############'.format(fold))
+        ee = load_fold(opt, fold)
+        loader = DataLoader(fold_dataset(opt, tokenizer, fold, 'train'), batch_size=opt.batch_size, shuffle=True)
+        train_heads(ee, loader, opt.training_iter, opt.learning_rate, opt.alpha)
+        if not os.path.exists(opt.heads_path):
+            os.makedirs(opt.heads_path)
+        ee.save(os.path.join(opt.heads_path, 'fold{}.pth'.format(fold)))
+
+
+def run_calibrate(opt, tokenizer):
+    grid = [round(t, 3) for t in np.arange(0.5, 0.99, 0.01)] + [0.99, 0.995, 0.999, 1.01]
+    target = prompt_utils.main_target[opt.task]
+    per_fold = []
+    for fold in fold_list(opt.folds):
+        ee = load_fold(opt, fold)
+        loader = DataLoader(fold_dataset(opt, tokenizer, fold, 'test'), batch_size=opt.batch_size, shuffle=False)
+        records = collect(ee, loader)
+        curve = []
+        for t in grid:
+            counts, layers = simulate(opt.task, records, ee.exit_layers, ee.n_layers, t, opt.window_size)
+            curve.append((prompt_utils.prf(opt.task, counts)[target][2], layers))
+        per_fold.append(curve)
+        print('fold {} full f {:.4f}'.format(fold, curve[-1][0]))
+    f_full = np.mean([curve[-1][0] for curve in per_fold])
+    n_layers = ee.n_layers
+    best = (grid[-1], f_full, float(n_layers))
+    print('threshold   {}_f   f_loss   mean_layers'.format(target))
+    for k, t in enumerate(grid):
+        f = np.mean([curve[k][0] for curve in per_fold])
+        layers = np.mean([curve[k][1] for curve in per_fold])
+        print('{:9.3f}   {:.4f}   {:+.4f}   {:.2f}'.format(t, f, f - f_full, layers))
+        if f_full - f <= opt.target_f1_loss and layers < best[2]:
+            best = (t, f, layers)
+    print('{}: threshold {} f {:.4f} (full {:.4f}) mean layers {:.2f}/{}'.format(
+        opt.task, best[0], best[1], f_full, best[2], n_layers))
+    thresholds = read_thresholds(opt.thresholds_file)
+    thresholds[opt.task] = {'threshold': best[0], 'f1': best[1], 'f1_full': f_full, 'mean_layers': best[2],
+                            'target_f1_loss': opt.target_f1_loss}
+    with open(opt.thresholds_file, 'w') as f:
+        json.dump(thresholds, f, indent=2)
+
+
+def timed_pass(task, model, loader, window_size):
+    counts = prompt_utils.new_counts()
+    latency = []
+    n_docs = 0
+    with torch.no_grad():
+        for batch in loader:
+            if not latency:
+                model(batch['input_ids'], None)  # warm up allocator and thread pool
+            start = time.perf_counter()
+            _, logits = model(batch['input_ids'], None)
+            latency.append(time.perf_counter() - start)
+            n_docs += len(batch['input_ids'])
+            prompt_utils.score_batch(task, counts, logits, batch, window_size)
+    latency = np.array(latency) * 1000
+    return {
+        'f': prompt_utils.prf(task, counts)[prompt_utils.main_target[task]][2],
+        'docs_per_sec': n_docs / (latency.sum() / 1000 + 1e-8),
+        'batch_ms_mean': float(latency.mean()),
+        'batch_ms_p50': float(np.percentile(latency, 50)),
+        'batch_ms_p95': float(np.percentile(latency, 95)),
+    }
+
+
+def run_report(opt, tokenizer):
+    threshold = calibrated_threshold(opt.task, opt.thresholds_file, opt.exit_threshold)
+    if threshold is None:
+        threshold = 1.01
+    report = {'task': opt.task, 'threshold': threshold, 'batch_size': opt.batch_size, 'folds': {}}
+    for fold in fold_list(opt.folds):
+        ee = load_fold(opt, fold, threshold)
+        loader = DataLoader(fold_dataset(opt, tokenizer, fold, 'test'), batch_size=opt.batch_size, shuffle=False)
+        full = timed_pass(opt.task, ee.model, loader, opt.window_size)
+        ee.exit_history = []
+        early = timed_pass(opt.task, ee, loader, opt.window_size)
+        history = ee.exit_history[1:]  # first entry is the warm-up batch
+        hist = {str(l): history.count(l) for l in ee.exit_layers + [ee.n_layers]}
+        report['folds'][fold] = {'full': full, 'early_exit': early, 'exit_layers': hist}
+        print('fold {} full: f {:.4f} {:.1f} ms/batch | early exit: f {:.4f} {:.1f} ms/batch ({:.2f}x) exits {}'.format(
+            fold, full['f'], full['batch_ms_mean'], early['f'], early['batch_ms_mean'],
+            full['batch_ms_mean'] / (early['batch_ms_mean'] + 1e-8), hist))
+    folds = list(report['folds'].values())
+    for name in ('full', 'early_exit'):
+        report[name] = {k: float(np.mean([f[name][k] for f in folds])) for k in folds[0][name]}
+    print('average full: f {:.4f} p50 {:.1f} ms p95 {:.1f} ms | '
+          'early exit: f {:.4f} p50 {:.1f} ms p95 {:.1f} ms'.format(
+        report['full']['f'], report['full']['batch_ms_p50'], report['full']['batch_ms_p95'],
+        report['early_exit']['f'], report['early_exit']['batch_ms_p50'], report['early_exit']['batch_ms_p95']))
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='early exit heads for prompt_bert')
+    parser.add_argument('--mode', type=str, default='report', choices=['train', 'calibrate', 'report'])
+    parser.add_argument('--task', type=str, default='ECPE', choices=prompt_utils.tasks)
+    parser.add_argument('--dataset', type=str, default='data_combine_ECPE/', help='path for dataset')
+    parser.add_argument('--checkpointpath', type=str, default='checkpoint/ECPE/', help='fold checkpoints')
+    parser.add_argument('--heads_path', type=str, default='checkpoint/ECPE_exit/', help='fold early exit heads')
+    parser.add_argument('--bert_path', type=str, default='./bert-base-chinese', help='tokenizer')
+    parser.add_argument('--folds', type=str, default='1,2,3,4,5,6,7,8,9,10', help='comma separated folds')
+    parser.add_argument('--exit_layers', type=str, default='4,6,8,10', help='layers that get a head')
+    parser.add_argument('--batch_size', type=int, default=8, help='number of example per batch')
+    parser.add_argument('--training_iter', type=int, default=1, help='epochs for the heads')
+    parser.add_argument('--learning_rate', type=float, default=0.0001, help='learning rate for the heads')
+    parser.add_argument('--alpha', type=float, default=0.5, help='weight of the distillation loss')
+    parser.add_argument('--window_size', type=int, default=2, help='size of the emotion cause pair window')
+    parser.add_argument('--num_for_M', type=int, default=2, help='for M2M module')
+    parser.add_argument('--target_f1_loss', type=float, default=0.005, help='allowed drop of the main F1')
+    parser.add_argument('--thresholds_file', type=str, default='early_exit_thresholds.json')
+    parser.add_argument('--exit_threshold', type=float, default=0., help='0 reads it from thresholds_file')
+    parser.add_argument('--output', type=str, default='', help='json file for the latency report')
+    opt = parser.parse_args()
+
+    tokenizer = BertTokenizer.from_pretrained(opt.bert_path)
+    {'train': run_train, 'calibrate': run_calibrate, 'report': run_report}[opt.mode](opt, tokenizer)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+ensemble of the fold checkpoints of one task.
+
+every block of documents is read, prompted and tokenized once and then run through all fold
+models; the full-vocabulary probabilities at the mask positions are averaged over the models and
+decoded as by a single Predictor (是 argmax for emotion / cause, window argmax for pairs). only the
+mask rows go through the MLM head.
+
+models are kept resident when the checkpoints fit in half of the available memory (--load auto),
+otherwise they are memory-mapped from the checkpoint files. with --layerwise (the default for
+mmap) a block of --block prompts goes through one encoder layer at a time, so each layer of each
+model is paged in once per block instead of once per batch.
+
+    python ensemble.py --task ECPE --checkpointpath checkpoint/ECPE/ --input news.jsonl --output news_pred.jsonl
+    # P/R/F of the ensemble on a labeled file
+    python ensemble.py --task ECPE --checkpointpath checkpoint/ECPE/ --evaluate data_combine_ECPE/fold1_test.txt
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+import torch
+from torch.utils.data import DataLoader
+from transformers import BertTokenizer
+import bulk_predict
+import pred_cache
+import prompt_utils
+from predictor import Predictor
+
+
+def available_memory():
+    """bytes of free physical memory, None where sysconf does not tell"""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def fits_in_memory(paths, fraction=0.5):
+    free = available_memory()
+    return free is None or sum(os.path.getsize(p) for p in paths) < fraction * free
+
+
+class FoldEnsemble(Predictor):
+    """Predictor over several fold models; mask_scores returns the averaged probabilities"""
+
+    def __init__(self, task, models, tokenizer, layerwise=False, micro_batch=8, **kwargs):
+        super(FoldEnsemble, self).__init__(task, models[0], tokenizer, **kwargs)
+        self.models = [m.eval() for m in models]
+        self.layerwise = layerwise
+        self.micro_batch = micro_batch
+
+    @classmethod
+    def from_checkpoints(cls, task, paths, bert_path='./bert-base-chinese', device='cpu', load='auto', **kwargs):
+        if load == 'auto':
+            load = 'resident' if device != 'cpu' or fits_in_memory(paths) else 'mmap'
+        models = [prompt_utils.load_checkpoint(p, map_location=device, mmap=load == 'mmap') for p in paths]
+        if kwargs.get('cache') is not None:
+            kwargs.setdefault('model_hash', hashlib.sha256('|'.join(
+                pred_cache.checkpoint_hash(p) for p in paths).encode('utf-8')).hexdigest())
+        kwargs.setdefault('layerwise', load == 'mmap')
+        ensemble = cls(task, models, BertTokenizer.from_pretrained(bert_path), **kwargs)
+        ensemble.load = load
+        return ensemble
+
+    def mask_rows(self, model, input_ids, sel):
+        """full-vocabulary probabilities of one model at the mask positions of input_ids"""
+        bert = model.bert.bert
+        chunks = [slice(s, s + self.micro_batch) for s in range(0, len(input_ids), self.micro_batch)]
+        if self.layerwise:
+            hidden = [bert.embeddings(input_ids=input_ids[c]) for c in chunks]
+            for layer in bert.encoder.layer:
+                hidden = [out[0] if isinstance(out, tuple) else out for out in (layer(h) for h in hidden)]
+        else:
+            hidden = [bert(input_ids[c])[0] for c in chunks]
+        rows = torch.cat([model.bert.cls(h[sel[c]]) for h, c in zip(hidden, chunks)])
+        return torch.softmax(rows.float(), dim=-1)
+
+    def mask_scores(self, input_ids):
+        input_ids = torch.as_tensor(input_ids).long().to(self.device)
+        sel = input_ids == prompt_utils.mask_id
+        probs = None
+        with torch.no_grad():
+            for model in self.models:
+                rows = self.mask_rows(model, input_ids, sel)
+                probs = rows if probs is None else probs.add_(rows)
+        return prompt_utils.row_scores(probs / len(self.models), input_ids)
+
+
+def evaluate(ensemble, path, block):
+    dataset = prompt_utils.PromptDataset(ensemble.task, prompt_utils.read_docs(path), ensemble.tokenizer,
+                                         num_for_M=ensemble.num_for_M)
+    counts = prompt_utils.new_counts()
+    for batch in DataLoader(dataset, batch_size=block, shuffle=False):
+        gold = prompt_utils.label_tokens(batch['label'], batch['input_ids'])
+        for i, s in enumerate(ensemble.mask_scores(batch['input_ids'])):
+            pred = prompt_utils.decode_slots(ensemble.task, *s, window_size=ensemble.window_size)
+            prompt_utils.add_counts(counts, ensemble.task, pred, prompt_utils.decode_labels(ensemble.task, gold[i]),
+                                    prompt_utils.batch_gt(batch, i))
+    return prompt_utils.prf(ensemble.task, counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fold ensemble inference')
+    parser.add_argument('--task', type=str, default='ECPE', choices=prompt_utils.tasks)
+    parser.add_argument('--checkpointpath', type=str, default='checkpoint/ECPE/', help='fold checkpoints')
+    parser.add_argument('--folds', type=str, default='1,2,3,4,5,6,7,8,9,10', help='comma separated folds')
+    parser.add_argument('--bert_path', type=str, default='./bert-base-chinese', help='tokenizer')
+    parser.add_argument('--input', type=str, default='', help='ECPE text file or JSONL to predict')
+    parser.add_argument('--format', type=str, default='auto', choices=['auto', 'ecpe', 'jsonl'])
+    parser.add_argument('--output', type=str, default='', help='JSONL predictions')
+    parser.add_argument('--evaluate', type=str, default='', help='labeled ECPE file, report P/R/F instead')
+    parser.add_argument('--load', type=str, default='auto', choices=['auto', 'resident', 'mmap'])
+    parser.add_argument('--layerwise', type=str, default='auto', choices=['auto', 'True', 'False'],
+                        help='run a block layer by layer, auto: with mmap')
+    parser.add_argument('--block', type=int, default=64, help='documents tokenized and run per block')
+    parser.add_argument('--batch_size', type=int, default=8, help='prompts per forward')
+    parser.add_argument('--max_length', type=int, default=512, help='tokens per prompt')
+    parser.add_argument('--overlap', type=int, default=4, help='clauses shared by chunk windows')
+    parser.add_argument('--window_size', type=int, default=2, help='size of the emotion cause pair window')
+    parser.add_argument('--num_for_M', type=int, default=2, help='for M2M module')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+    opt = parser.parse_args()
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    paths = [os.path.join(opt.checkpointpath, 'fold{}.pth'.format(f)) for f in opt.folds.split(',') if f]
+    kwargs = {} if opt.layerwise == 'auto' else {'layerwise': opt.layerwise == 'True'}
+    start = time.time()
+    ensemble = FoldEnsemble.from_checkpoints(opt.task, paths, opt.bert_path, load=opt.load,
+                                             micro_batch=opt.batch_size, window_size=opt.window_size,
+                                             max_length=opt.max_length, overlap=opt.overlap,
+                                             num_for_M=opt.num_for_M, **kwargs)
+    print('{} fold models, {}{}, loaded in {:.1f}s'.format(len(paths), ensemble.load,
+                                                         ' layerwise' if ensemble.layerwise else '',
+                                                         time.time() - start))
+    start = time.time()
+    if opt.evaluate:
+        print(prompt_utils.format_prf(opt.task, evaluate(ensemble, opt.evaluate, opt.block)))
+    else:
+        documents = (doc for _, doc in bulk_predict.read_corpus(opt.input, 0, opt.format))
+        n = 0
+        with open(opt.output, 'w', encoding='utf-8') as out:
+            for results in ensemble.predict_batches(documents, opt.block):
+                for result in results:
+                    out.write(json.dumps(result, ensure_ascii=False) + '\n')
+                n += len(results)
+        print('{} documents written to {}'.format(n, opt.output))
+    print('{:.1f}s'.format(time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+split a corpus into folds in one pass, the code of the divide_fold.py of the data_combine_* directories.
+
+the source is read once, keeping the byte offset, the length and the header of every document.
+every document gets a test fold (0: in no test split) and a position in the output order, and is
+written once as a line of the manifest (folds.tsv); prompt_utils.read_split reads a split from the
+manifest and the source. --materialize also writes the fold{k}_train.txt / fold{k}_test.txt files
+of the legacy layout (every train file holds the other folds, about ten copies of the corpus).
+
+    python divide_fold.py                                 # folds.tsv
+    python divide_fold.py --materialize                   # and the 20 fold files
+    python divide_fold.py --stratify label --group_size 5 --seed 1 --materialize --materialize_folds 1,2
+
+--order file keeps the documents in file order, --order shuffle shuffles them with --seed. as
+before, fold k then tests on the k-th tenth and the last len % folds documents are only trained
+on. --stratify deals the (shuffled) documents of every value of the stratum (label: the third
+header field, emotion: the emotion column of the first emotion clause) to the folds in turn, so
+every fold has the same share of each value and every document is tested once. --group_size keeps
+runs of consecutive documents (e.g. a document and its negative samples) in the same fold, a run
+is stratified by its first document. every divide_fold.py gives main the defaults of its directory
+(input, order, stratify and renumber).
+"""
+import argparse
+import collections
+import os
+import random
+
+
+def scan(path, stratify='none'):
+    """(offset, length, header fields, stratum) of every document of path, in one reading"""
+    docs = []
+    with open(path, 'rb') as f:
+        offset = 0
+        while True:
+            header = f.readline()
+            if not header.strip():
+                break
+            fields = header.decode('utf-8').split()
+            length = len(header)
+            key = fields[2] if stratify == 'label' else ''
+            for j in range(int(fields[1]) + 1):
+                line = f.readline()
+                length += len(line)
+                if stratify == 'emotion' and j > 0 and not key:
+                    emotion = line.decode('utf-8').split(',')[1]
+                    key = '' if emotion == 'null' else emotion
+            docs.append((offset, length, fields, key))
+            offset += length
+    return docs
+
+
+def assign(keys, folds=10, seed=0, order='file', stratified=False, group_size=1):
+    """the output order (document indices) and the test fold of every document"""
+    groups = [list(range(s, min(s + group_size, len(keys)))) for s in range(0, len(keys), group_size)]
+    rng = random.Random(seed)
+    if order == 'shuffle' or stratified:
+        rng.shuffle(groups)
+    fold = [0] * len(keys)
+    if stratified:
+        by_key = collections.defaultdict(list)
+        for group in groups:
+            by_key[keys[group[0]]].append(group)
+        turn = 0
+        for key in sorted(by_key):
+            for group in by_key[key]:
+                for index in group:
+                    fold[index] = turn % folds + 1
+                turn += 1
+    else:
+        fold_size = len(groups) // folds
+        for position, group in enumerate(groups[:fold_size * folds]):
+            for index in group:
+                fold[index] = position // fold_size + 1
+    return [index for group in groups for index in group], fold
+
+
+def header_line(position, fields, renumber):
+    if not renumber:
+        return None
+    return (' '.join([str(position + 1)] + fields[1:]) + '\n').encode('utf-8')
+
+
+def write_manifest(path, source, docs, order, fold, renumber, settings):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('# source={} {}\n'.format(source, ' '.join('{}={}'.format(k, v) for k, v in settings.items())))
+        f.write('position\tdoc_id\tfold\toffset\tlength\tstratum\n')
+        for position, index in enumerate(order):
+            offset, length, fields, key = docs[index]
+            doc_id = position + 1 if renumber else fields[0]
+            f.write('{}\t{}\t{}\t{}\t{}\t{}\n'.format(position, doc_id, fold[index], offset, length, key))
+
+
+def materialize(source, docs, order, fold, folds, renumber, output_dir='.', only=None):
+    """the legacy fold files, written in one pass over the documents in output order"""
+    only = set(only or range(1, folds + 1))
+    tests = {k: open(os.path.join(output_dir, 'fold{}_test.txt'.format(k)), 'wb') for k in only}
+    trains = {k: open(os.path.join(output_dir, 'fold{}_train.txt'.format(k)), 'wb') for k in only}
+    try:
+        with open(source, 'rb') as src:
+            for position, index in enumerate(order):
+                offset, length, fields, _ = docs[index]
+                src.seek(offset)
+                text = src.read(length)
+                header = header_line(position, fields, renumber)
+                if header is not None:
+                    text = header + text[text.index(b'\n') + 1:]
+                if fold[index] in tests:
+                    tests[fold[index]].write(text)
+                for k, f in trains.items():
+                    if k != fold[index]:
+                        f.write(text)
+    finally:
+        for f in list(tests.values()) + list(trains.values()):
+            f.close()
+
+
+def main(defaults):
+    parser = argparse.ArgumentParser(description='split the corpus into folds')
+    parser.add_argument('--input', type=str, default=defaults['input'])
+    parser.add_argument('--output_dir', type=str, default='.')
+    parser.add_argument('--manifest', type=str, default='folds.tsv', help='written to output_dir')
+    parser.add_argument('--folds', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--order', type=str, default=defaults['order'], choices=['file', 'shuffle'])
+    parser.add_argument('--stratify', type=str, default=defaults['stratify'], choices=['none', 'label', 'emotion'])
+    parser.add_argument('--group_size', type=int, default=1, help='consecutive documents kept in one fold')
+    parser.add_argument('--renumber', type=int, default=defaults['renumber'],
+                        help='1: the document ids become the positions in the output order')
+    parser.add_argument('--materialize', action='store_true', help='also write the legacy fold files')
+    parser.add_argument('--materialize_folds', type=str, default='', help='comma separated, default all')
+    opt = parser.parse_args()
+
+    docs = scan(opt.input, opt.stratify)
+    order, fold = assign([d[3] for d in docs], opt.folds, opt.seed, opt.order, opt.stratify != 'none',
+                         opt.group_size)
+    settings = collections.OrderedDict([('folds', opt.folds), ('seed', opt.seed), ('order', opt.order),
+                                        ('stratify', opt.stratify), ('group_size', opt.group_size),
+                                        ('renumber', opt.renumber)])
+    os.makedirs(opt.output_dir, exist_ok=True)
+    source = os.path.relpath(opt.input, opt.output_dir)
+    write_manifest(os.path.join(opt.output_dir, opt.manifest), source, docs, order, fold, opt.renumber, settings)
+    counts = collections.Counter(fold)
+    print('{} documents, test documents per fold {}'.format(
+        len(docs), ' '.join(str(counts[k]) for k in range(1, opt.folds + 1))))
+    if opt.materialize:
+        only = [int(k) for k in opt.materialize_folds.split(',') if k]
+        materialize(opt.input, docs, order, fold, opt.folds, opt.renumber, opt.output_dir, only)
+
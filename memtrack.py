@@ -0,0 +1,208 @@
+"""
+memory telemetry for the task scripts: peak RSS and allocator stats per fold and phase.
+
+    mem = MemoryTracker('memory/ECPE', budget_gb=32, top=10)
+    mem.set_fold(fold)
+    mem.phase('build')                         # closes the previous phase, starts sampling this one
+    ...
+    mem.phase('test', test_buffer_bytes(len(testloader.dataset)))   # warns when it would not fit
+    ...
+    model = NLP_Dataset = all_test_logits = None
+    mem.end_fold()                             # gc, malloc_trim, report to memory/ECPE.json / .csv
+
+a phase records the RSS at its start and end, the peak RSS sampled by autotune.RssSampler, the
+bytes in use by malloc (glibc mallinfo2) and, on cuda, the peak allocated / reserved bytes of the
+caching allocator. at the end of every phase the largest live storages (tensors and module
+parameters found with gc) are listed. the test buffers of the scripts (all_test_logits and the
+others) hold the vocabulary logits of every test example, 512 x 21128 float32 = 43 MB per example,
+and are grown by concatenation so their last torch.cat briefly holds them twice; test_buffer_bytes
+is that peak.
+"""
+import collections
+import csv
+import ctypes
+import ctypes.util
+import gc
+import itertools
+import json
+import os
+import time
+import torch
+import prompt_utils
+from autotune import RssSampler, current_rss
+
+_mb = float(1 << 20)
+
+
+class _MallInfo2(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_size_t) for name in
+                ('arena', 'ordblks', 'smblks', 'hblks', 'hblkhd', 'usmblks', 'fsmblks', 'uordblks', 'fordblks',
+                 'keepcost')]
+
+
+def _load_libc():
+    name = ctypes.util.find_library('c')
+    try:
+        return ctypes.CDLL(name) if name else None
+    except OSError:
+        return None
+
+
+_libc = _load_libc()
+
+
+def heap_stats():
+    """bytes in use and free in the malloc heap, empty where mallinfo2 is not available (non glibc)"""
+    if _libc is None or not hasattr(_libc, 'mallinfo2'):
+        return {}
+    _libc.mallinfo2.restype = _MallInfo2
+    info = _libc.mallinfo2()
+    return {'heap_in_use_mb': (info.uordblks + info.hblkhd) / _mb, 'heap_free_mb': info.fordblks / _mb}
+
+
+def cuda_stats():
+    if not torch.cuda.is_available():
+        return {}
+    return {'cuda_peak_allocated_mb': torch.cuda.max_memory_allocated() / _mb,
+            'cuda_peak_reserved_mb': torch.cuda.max_memory_reserved() / _mb}
+
+
+def test_buffer_bytes(n_examples, seq_len=512, vocab_size=prompt_utils.vocab_size):
+    """peak size of the all_test_* buffers: float32 logits plus four [seq_len] rows, twice for torch.cat"""
+    return 2 * n_examples * seq_len * (vocab_size + 4) * 4
+
+
+def _live_tensors():
+    for obj in gc.get_objects():
+        if isinstance(obj, torch.Tensor):
+            yield obj
+        elif isinstance(obj, torch.nn.Module):
+            # parameters and buffers are not tracked by gc on their own
+            for tensor in itertools.chain(obj.parameters(recurse=False), obj.buffers(recurse=False)):
+                yield tensor
+
+
+def largest_tensors(top=10):
+    """(shape, dtype, device, MB) of the top largest live tensors, a storage shared by views counted once"""
+    seen, found = set(), []
+    for obj in _live_tensors():
+        try:
+            if obj.is_meta:
+                continue
+            storage = obj.untyped_storage()
+            key = (storage.data_ptr(), obj.device)
+            if key in seen or storage.data_ptr() == 0:
+                continue
+            seen.add(key)
+            found.append({'shape': list(obj.shape), 'dtype': str(obj.dtype).replace('torch.', ''),
+                          'device': str(obj.device), 'mb': storage.nbytes() / _mb})
+        except (RuntimeError, ReferenceError):
+            continue
+    return sorted(found, key=lambda t: -t['mb'])[:top]
+
+
+def release():
+    """collect garbage and hand freed memory back to the system"""
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    if _libc is not None and hasattr(_libc, 'malloc_trim'):
+        _libc.malloc_trim(0)
+
+
+class MemoryTracker(object):
+    def __init__(self, report='', budget_gb=0., top=10, rank=0):
+        self.enabled = bool(report or budget_gb)
+        self.report = report + ('.rank{}'.format(rank) if rank and report else '')
+        self.budget = budget_gb * (1 << 30)
+        self.top = top
+        self.fold = 0
+        self.rows = collections.OrderedDict()
+        self.tensors = {}
+        self.folds = []
+        self.current = None
+        self.sampler = None
+
+    def set_fold(self, fold):
+        self.fold = fold
+
+    def check(self, what, nbytes):
+        if self.budget and nbytes > self.budget:
+            print('memory warning: fold {} {} {:.0f} MB, over the budget of {:.0f} MB'.format(
+                self.fold, what, nbytes / _mb, self.budget / _mb))
+            return False
+        return True
+
+    def phase(self, name, expected=0):
+        """
+        close the running phase and start name. expected: bytes the phase will add on top of the
+        current RSS, checked against the budget before anything is allocated
+        """
+        if not self.enabled:
+            return
+        self.close()
+        rss = current_rss()
+        if expected:
+            self.check('{} expects'.format(name), rss + expected)
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self.sampler = RssSampler(interval=0.05).__enter__()
+        self.current = {'fold': self.fold, 'phase': name, 'rss_start_mb': rss / _mb, 'expected_mb': expected / _mb,
+                        'start': time.time()}
+
+    def close(self):
+        if self.current is None:
+            return
+        self.sampler.__exit__(None, None, None)
+        row, self.current = self.current, None
+        row.update(rss_end_mb=current_rss() / _mb, peak_rss_mb=self.sampler.peak / _mb,
+                   seconds=time.time() - row.pop('start'))
+        row.update(heap_stats())
+        row.update(cuda_stats())
+        self.check('{} peak rss'.format(row['phase']), self.sampler.peak)
+        key = (row['fold'], row['phase'])
+        # a phase that repeats every epoch keeps its highest peak
+        if key not in self.rows or row['peak_rss_mb'] >= self.rows[key]['peak_rss_mb']:
+            self.rows[key] = row
+            if self.top:
+                self.tensors['{}/{}'.format(*key)] = largest_tensors(self.top)
+
+    def end_fold(self):
+        """close the last phase, release what the script dropped and write the report"""
+        if not self.enabled:
+            release()
+            return
+        self.close()
+        before = current_rss()
+        release()
+        after = current_rss()
+        self.folds.append({'fold': self.fold, 'rss_before_release_mb': before / _mb,
+                           'rss_after_release_mb': after / _mb,
+                           'peak_rss_mb': max([r['peak_rss_mb'] for r in self.rows.values() if r['fold'] == self.fold]
+                                              or [0.])})
+        for row in self.rows.values():
+            if row['fold'] == self.fold:
+                print('memory fold {fold} {phase:5s} peak rss {peak_rss_mb:.0f} MB (start {rss_start_mb:.0f} MB, '
+                      'end {rss_end_mb:.0f} MB)'.format(**row))
+        print('memory fold {} released {:.0f} MB, {:.0f} MB resident'.format(self.fold, (before - after) / _mb,
+                                                                             after / _mb))
+        self.write()
+
+    def write(self):
+        if not self.report:
+            return
+        directory = os.path.dirname(self.report)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        rows = list(self.rows.values())
+        with open(self.report + '.json', 'w') as f:
+            json.dump({'budget_mb': self.budget / _mb, 'phases': rows, 'folds': self.folds,
+                       'largest_tensors': self.tensors}, f, indent=2)
+        if rows:
+            columns = []
+            for row in rows:
+                columns.extend(k for k in row if k not in columns)
+            with open(self.report + '.csv', 'w', newline='') as f:
+                writer = csv.DictWriter(f, columns)
+                writer.writeheader()
+                writer.writerows(rows)
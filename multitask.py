@@ -0,0 +1,175 @@
+"""
+run any subset of ECE, ECPE, CCRC and M2M in one process.
+
+the tokenizer is loaded once, every fold file is parsed once (ECPE and M2M read the same files)
+and all prompts are tokenized through one prompt_utils.TokenStore, so a clause seen by an other
+task, fold or CCRC variant is not tokenized again. the datasets are those of MyDataset of the
+task scripts, metrics those of crf_prompt / prf_prompt.
+
+    # test pass of the fold checkpoints of all four tasks
+    python multitask.py --tasks ECE,ECPE,CCRC,M2M --test_only True
+    # train ECPE and M2M, keep the best epoch of each fold
+    python multitask.py --tasks ECPE,M2M --training_iter 20 --savecheckpoint True
+"""
+import argparse
+import os
+import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from transformers import BertTokenizer
+import corpus_store
+import prompt_utils
+
+datasets = {'ECE': 'data_combine_ECE/', 'ECPE': 'data_combine_ECPE/', 'CCRC': 'data_combine_CCRC/',
+            'M2M': 'data_combine_ECPE/'}
+checkpoints = {'ECE': 'checkpoint/ECE/', 'ECPE': 'checkpoint/ECPE/', 'CCRC': 'checkpoint/CCRC/',
+               'M2M': 'checkpoint/M2M/'}
+
+
+class SharedData(object):
+    """
+    fold files parsed once and prompts tokenized through one TokenStore; with a corpus store the
+    datasets are its fold views and only documents changed since the last run are tokenized
+    """
+
+    def __init__(self, tokenizer, max_length=512, num_for_M=2):
+        self.tokenizer = tokenizer
+        self.store = prompt_utils.TokenStore(tokenizer)
+        self.max_length = max_length
+        self.num_for_M = num_for_M
+        self.docs = {}
+        self.seconds = {'parse': 0., 'tokenize': 0.}
+        self.corpus_stores = {}
+
+    def read(self, path):
+        if path not in self.docs:
+            start = time.time()
+            self.docs[path] = list(prompt_utils.read_docs(path))
+            self.seconds['parse'] += time.time() - start
+        return self.docs[path]
+
+    def dataset(self, task, path, store_path=''):
+        if store_path:
+            if store_path not in self.corpus_stores:
+                self.corpus_stores[store_path] = corpus_store.CorpusStore(store_path)
+            start = time.time()
+            view = os.path.splitext(os.path.basename(path))[0]
+            dataset = self.corpus_stores[store_path].dataset(task, view, self.tokenizer, self.max_length,
+                                                             self.num_for_M, verbose=False, store=self.store)
+            self.seconds['tokenize'] += time.time() - start
+            return dataset
+        docs = self.read(path)
+        start = time.time()
+        dataset = prompt_utils.PromptDataset(task, docs, self.tokenizer, self.max_length, self.num_for_M,
+                                             verbose=False, store=self.store)
+        self.seconds['tokenize'] += time.time() - start
+        return dataset
+
+
+def evaluate(task, model, dataset, batch_size=8, window_size=2, device='cpu'):
+    """prompt_utils.prf of model on dataset"""
+    counts = prompt_utils.new_counts()
+    model.eval()
+    with torch.no_grad():
+        for batch in DataLoader(dataset, batch_size=batch_size, shuffle=False):
+            _, logits = model(batch['input_ids'].to(device), None)
+            prompt_utils.score_batch(task, counts, logits, batch, window_size)
+    return prompt_utils.prf(task, counts)
+
+
+def train_fold(task, model, train_set, test_set, training_iter=20, batch_size=8, learning_rate=1e-5,
+               weight_decay=0.01, window_size=2, grad_accum_steps=1, device='cpu', save_path='', on_epoch=None):
+    """
+    the training loop of the task scripts: AdamW on the mask_label loss, a test pass after every
+    epoch. the model of the best epoch (main target F1) is saved to save_path. on_epoch(epoch,
+    result) may return False to stop early. returns the best result and the results per epoch.
+    """
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
+    loader = DataLoader(train_set, batch_size=batch_size, shuffle=True, drop_last=True)
+    target = prompt_utils.main_target[task]
+    best, history = None, []
+    for epoch in range(training_iter):
+        model.train()
+        optimizer.zero_grad()
+        for index, batch in enumerate(loader):
+            loss, _ = model(batch['input_ids'].to(device), batch['mask_label'].to(device))
+            group_start = index - index % grad_accum_steps
+            (loss / min(grad_accum_steps, len(loader) - group_start)).backward()
+            if (index + 1) % grad_accum_steps == 0 or index + 1 == len(loader):
+                optimizer.step()
+                optimizer.zero_grad()
+        result = evaluate(task, model, test_set, batch_size, window_size, device)
+        history.append(result)
+        if best is None or result[target][2] > best[target][2]:
+            best = result
+            if save_path:
+                torch.save(model, save_path)
+        if on_epoch is not None and on_epoch(epoch, result) is False:
+            break
+    return best, history
+
+
+def main():
+    parser = argparse.ArgumentParser(description='several tasks in one process')
+    parser.add_argument('--tasks', type=str, default='ECE,ECPE,CCRC,M2M', help='comma separated tasks')
+    parser.add_argument('--folds', type=str, default='1,2,3,4,5,6,7,8,9,10', help='comma separated folds')
+    parser.add_argument('--test_only', type=bool, default=False, help='test the fold checkpoints, no training')
+    for task in prompt_utils.tasks:
+        parser.add_argument('--{}_dataset'.format(task), type=str, default=datasets[task])
+        parser.add_argument('--{}_checkpointpath'.format(task), type=str, default=checkpoints[task])
+        parser.add_argument('--{}_corpus_store'.format(task), type=str, default='',
+                            help='corpus_store.py store, read instead of the fold files')
+    parser.add_argument('--bert_path', type=str, default='./bert-base-chinese', help='bert and tokenizer')
+    parser.add_argument('--training_iter', type=int, default=20, help='number of train iterator')
+    parser.add_argument('--batch_size', type=int, default=8, help='number of example per batch')
+    parser.add_argument('--learning_rate', type=float, default=0.00001, help='learning rate')
+    parser.add_argument('--weight_decay', type=float, default=0.01, help='weight decay for bert')
+    parser.add_argument('--grad_accum_steps', type=int, default=1, help='number of batches per optimizer step')
+    parser.add_argument('--window_size', type=int, default=2, help='size of the emotion cause pair window')
+    parser.add_argument('--num_for_M', type=int, default=2, help='for M2M module')
+    parser.add_argument('--savecheckpoint', type=bool, default=False, help='save the best epoch of every fold')
+    parser.add_argument('--save_path', type=str, default='prompt_multitask', help='<save_path>/<task>/fold{k}.pth')
+    parser.add_argument('--usegpu', type=bool, default=True, help='gpu')
+    opt = parser.parse_args()
+
+    device = 'cuda' if opt.usegpu and torch.cuda.is_available() else 'cpu'
+    start = time.time()
+    tokenizer = BertTokenizer.from_pretrained(opt.bert_path)
+    shared = SharedData(tokenizer, num_for_M=opt.num_for_M)
+    folds = [int(f) for f in opt.folds.split(',') if f]
+    summary = {}
+    for task in opt.tasks.split(','):
+        dataset_path = getattr(opt, '{}_dataset'.format(task))
+        store_path = getattr(opt, '{}_corpus_store'.format(task))
+        task_start, results = time.time(), []
+        for fold in folds:
+            test_set = shared.dataset(task, dataset_path + 'fold{}_test.txt'.format(fold), store_path)
+            if opt.test_only:
+                path = os.path.join(getattr(opt, '{}_checkpointpath'.format(task)), 'fold{}.pth'.format(fold))
+                model = prompt_utils.load_checkpoint(path, map_location=device)
+                result = evaluate(task, model, test_set, opt.batch_size, opt.window_size, device)
+            else:
+                train_set = shared.dataset(task, dataset_path + 'fold{}_train.txt'.format(fold), store_path)
+                save_path = ''
+                if opt.savecheckpoint:
+                    save_dir = os.path.join(opt.save_path, task)
+                    os.makedirs(save_dir, exist_ok=True)
+                    save_path = os.path.join(save_dir, 'fold{}.pth'.format(fold))
+                model = prompt_utils.prompt_bert(opt.bert_path).to(device)
+                result, _ = train_fold(task, model, train_set, test_set, opt.training_iter, opt.batch_size,
+                                       opt.learning_rate, opt.weight_decay, opt.window_size, opt.grad_accum_steps,
+                                       device, save_path)
+            print('{} fold {} {}'.format(task, fold, prompt_utils.format_prf(task, result)))
+            results.append(result)
+        summary[task] = {t: tuple(float(np.mean([r[t][k] for r in results])) for k in range(3))
+                         for t in prompt_utils.targets[task]}
+        print('{} average {} ({:.1f}s)'.format(task, prompt_utils.format_prf(task, summary[task]),
+                                               time.time() - task_start))
+    print('parse {:.1f}s, tokenize {:.1f}s ({} distinct pieces, {} reused), total {:.1f}s'.format(
+        shared.seconds['parse'], shared.seconds['tokenize'], len(shared.store.pieces), shared.store.hits,
+        time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+performance regression gate for the task scripts, against a committed baseline.
+
+a fixed profile runs on the tiny random BERT and the seeded synthetic corpus of bench.py, for
+every task: MyDataset of the script (docs/sec), its train_epoch over --train_steps batches (ms per
+step) and its test_pass followed by its crf_prompt / prf_prompt, with the peak RSS. train_epoch and
+test_pass are the loops run() calls, here on prompt_bert, so the gate covers changes to them
+(gradient accumulation, profiling marks, the distributed no_sync). every timing is the best of
+--repeat runs.
+
+    python perf_gate.py                # compare with perf_baseline.json, exit 1 on a regression
+    python perf_gate.py --update       # measure and write the baseline
+
+a metric regresses when it is worse than the baseline by more than --tolerance (timings and
+rates) or --rss_tolerance (peak RSS), relative. timings depend on the host: the baseline records
+it and the gate says so when the host, torch or the thread count differ; refresh the baseline
+with --update on the machine that runs the gate.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import torch
+from torch.utils.data import DataLoader
+from transformers import BertTokenizer
+import bench
+import profiling
+import prompt_utils
+from autotune import RssSampler, current_rss
+
+profile_version = 2
+# the scoring function of each script and its arguments, from the columns its test_pass returns
+scoring = {
+    'ECE': ('prf_prompt', lambda cols: (cols[0], cols[1], cols[4], cols[5])),
+    'ECPE': ('crf_prompt', lambda cols: (cols[0], cols[1], cols[4], cols[5], cols[6], cols[7])),
+    'CCRC': ('prf_prompt', lambda cols: (cols[0], cols[1], cols[6], cols[4], cols[5].int())),
+    'M2M': ('prf_prompt', lambda cols: (cols[0], cols[1], cols[4], cols[5], cols[6], cols[7])),
+}
+# metric suffix -> True when higher is better
+higher_is_better = {'docs_per_sec': True, 'train_step_ms': False, 'eval_seconds': False, 'eval_peak_rss_mb': False}
+
+
+def best_of(fn, repeat):
+    """fastest of repeat runs of fn in seconds, and the peak RSS growth over all of them"""
+    seconds, start_rss = [], current_rss()
+    with RssSampler() as rss:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            seconds.append(time.perf_counter() - start)
+    return min(seconds), (rss.peak - start_rss) / (1 << 20)
+
+
+def quiet(fn, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+
+def measure_task(task, path, n_docs, bert_path, tokenizer, opt):
+    """metrics of one script: its MyDataset, and its train_epoch and test_pass on prompt_bert"""
+    module = bench.import_script(task)
+    metrics = {}
+    seconds, _ = best_of(lambda: quiet(module.MyDataset, path, test=True, tokenizer=tokenizer), opt.repeat)
+    metrics['docs_per_sec'] = n_docs / seconds
+
+    dataset = quiet(module.MyDataset, path, test=True, tokenizer=tokenizer)
+    torch.manual_seed(opt.seed)
+    model = prompt_utils.prompt_bert(bert_path)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5, weight_decay=0.01)
+    prof = profiling.StageProfiler()
+    train = torch.utils.data.Subset(dataset, range(min(opt.train_steps * opt.batch_size, len(dataset))))
+    trainloader = DataLoader(train, batch_size=opt.batch_size, shuffle=False)
+    quiet(module.train_epoch, model, optimizer, trainloader, prof)
+    seconds, _ = best_of(lambda: quiet(module.train_epoch, model, optimizer, trainloader, prof), opt.repeat)
+    metrics['train_step_ms'] = 1000 * seconds / len(trainloader)
+
+    name, score_args = scoring[task]
+    score = getattr(module, name)
+    test = torch.utils.data.Subset(dataset, range(min(opt.eval_docs, len(dataset))))
+    testloader = DataLoader(test, batch_size=opt.batch_size, shuffle=False)
+
+    def test_pass():
+        columns = module.test_pass(model, testloader, prof)
+        quiet(score, *score_args(columns))
+    seconds, peak = best_of(test_pass, opt.repeat)
+    metrics['eval_seconds'] = seconds
+    metrics['eval_peak_rss_mb'] = peak
+    return {'{}/{}'.format(task, k): v for k, v in metrics.items()}
+
+
+def run_profile(opt):
+    metrics = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        bert_path = bench.tiny_bert(workdir, opt.vocab, seed=opt.seed)
+        tokenizer = BertTokenizer.from_pretrained(bert_path)
+        docs = bench.synthetic_docs(tokenizer, opt.docs, opt.seed)
+        path = os.path.join(workdir, 'gate_fold.txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            for doc in docs:
+                f.write(prompt_utils.format_doc(doc))
+        for task in opt.tasks.split(','):
+            metrics.update(measure_task(task, path, len(docs), bert_path, tokenizer, opt))
+            print('measured {}'.format(task))
+    return metrics
+
+
+def environment():
+    return {'host': platform.node(), 'python': platform.python_version(), 'torch': torch.__version__,
+            'threads': torch.get_num_threads(), 'cpu_count': os.cpu_count()}
+
+
+def compare(baseline, metrics, tolerance, rss_tolerance):
+    """rows of (metric, baseline, current, relative change, status); status is ok, improved, regression or new"""
+    rows = []
+    for name in sorted(set(baseline) | set(metrics)):
+        old, new = baseline.get(name), metrics.get(name)
+        if old is None or new is None:
+            rows.append((name, old, new, None, 'new' if old is None else 'missing'))
+            continue
+        suffix = name.split('/', 1)[1]
+        better = higher_is_better[suffix]
+        change = (new - old) / old if old else 0.
+        worse = -change if better else change
+        limit = rss_tolerance if suffix.endswith('rss_mb') else tolerance
+        if suffix.endswith('rss_mb'):
+            # small growths are noise whatever their relative size
+            worse = worse if abs(new - old) > 8 else 0.
+        status = 'regression' if worse > limit else 'improved' if worse < -limit else 'ok'
+        rows.append((name, old, new, change, status))
+    return rows
+
+
+def print_table(rows):
+    print('{:32s} {:>12s} {:>12s} {:>8s}  {}'.format('metric', 'baseline', 'current', 'change', 'status'))
+    for name, old, new, change, status in rows:
+        print('{:32s} {:>12s} {:>12s} {:>8s}  {}'.format(
+            name, '-' if old is None else '{:.4g}'.format(old), '-' if new is None else '{:.4g}'.format(new),
+            '-' if change is None else '{:+.1%}'.format(change), status.upper() if status == 'regression' else status))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='performance regression gate')
+    parser.add_argument('--baseline', type=str, default='perf_baseline.json', help='committed baseline')
+    parser.add_argument('--update', action='store_true', help='write the measurements as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown')
+    parser.add_argument('--rss_tolerance', type=float, default=0.15, help='allowed relative peak RSS growth')
+    parser.add_argument('--tasks', type=str, default='ECE,ECPE,CCRC,M2M', help='task scripts in the profile')
+    parser.add_argument('--vocab', type=str, default='', help='local vocab.txt, default generates one')
+    parser.add_argument('--docs', type=int, default=64, help='synthetic documents')
+    parser.add_argument('--eval_docs', type=int, default=16, help='documents of the test pass (43 MB each)')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--train_steps', type=int, default=4, help='timed training steps')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the best counts')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads, fixed for comparable timings')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='', help='also write the measurements here')
+    opt = parser.parse_args()
+    torch.set_num_threads(opt.threads)
+
+    settings = {k: getattr(opt, k) for k in ('tasks', 'docs', 'eval_docs', 'batch_size', 'train_steps', 'repeat',
+                                             'threads', 'seed')}
+    report = {'profile': profile_version, 'env': environment(), 'settings': settings, 'metrics': run_profile(opt)}
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if opt.update:
+        with open(opt.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('baseline written to {}'.format(opt.baseline))
+        return 0
+    if not os.path.exists(opt.baseline):
+        print('no baseline at {}, run with --update first'.format(opt.baseline))
+        return 2
+    with open(opt.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('profile') != profile_version or baseline.get('settings') != settings:
+        print('warning: the baseline was measured with an other profile or settings, refresh it with --update')
+    for key in ('host', 'torch', 'threads'):
+        if baseline['env'].get(key) != report['env'][key]:
+            print('warning: baseline {} {} differs from {}'.format(key, baseline['env'].get(key), report['env'][key]))
+    rows = compare(baseline['metrics'], report['metrics'], opt.tolerance, opt.rss_tolerance)
+    print_table(rows)
+    regressions = [r for r in rows if r[4] == 'regression']
+    if regressions:
+        print('{} regressions beyond the tolerance'.format(len(regressions)))
+        return 1
+    print('no regressions')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
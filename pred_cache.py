@@ -0,0 +1,105 @@
+"""
+LRU cache of decoded predictions, optionally backed by an on-disk sqlite key-value store.
+
+a prompt is identified by (checkpoint hash, task, window_size, token ids), so a document sent
+again, or a CCRC variant whose prompt is unchanged, skips the BERT forward. entries are the decoded
+mask slots of one prompt (see prompt_utils.decode_slots). the in-memory part keeps the capacity
+most recently used entries; with a path, every entry is also written to sqlite and entries evicted
+from memory are read back from there.
+
+    cache = PredictionCache(capacity=100000, path='cache/ECPE_fold1.sqlite')
+    predictor = Predictor.from_checkpoint('ECPE', 'checkpoint/ECPE/fold1.pth', cache=cache)
+    ...
+    print(cache.stats())
+"""
+import collections
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import numpy as np
+
+_file_hashes = {}
+
+
+def checkpoint_hash(path, block_size=1 << 20):
+    """sha256 of the checkpoint file, remembered per (path, size, mtime)"""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime)
+    if key not in _file_hashes:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                h.update(block)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+
+def prompt_key(model_hash, task, window_size, input_ids):
+    h = hashlib.sha1('{}|{}|{}|'.format(model_hash, task, window_size).encode('utf-8'))
+    h.update(np.asarray(input_ids, dtype=np.int32).tobytes())
+    return h.hexdigest()
+
+
+class PredictionCache(object):
+    def __init__(self, capacity=10000, path=None):
+        self.capacity = capacity
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        self.db = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, value BLOB)')
+            self.db.commit()
+
+    def get(self, key):
+        """the cached value or None; counts a hit or a miss"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return self.entries[key]
+            if self.db is not None:
+                row = self.db.execute('SELECT value FROM predictions WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    value = pickle.loads(row[0])
+                    self._insert(key, value)
+                    self.counters['disk_hits'] += 1
+                    return value
+            self.counters['misses'] += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self._insert(key, value)
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?)',
+                                (key, sqlite3.Binary(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))))
+                self.db.commit()
+
+    def _insert(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self.entries)
+            stats['capacity'] = self.capacity
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['disk_hits']) / lookups if lookups else 0.
+        return stats
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,143 @@
+"""
+importable prediction API for the fold checkpoints.
+
+    from predictor import Predictor
+    predictor = Predictor.from_checkpoint('ECPE', 'checkpoint/ECPE/fold1.pth')
+    predictor.predict([['当 我 看到 建议 被 采纳', '部委 领导 写给 我 的 回信 时', '激动 地 对 中新网 记者 说']])
+    # [{'doc_id': '0', 'emotions': [...], 'causes': [...], 'pairs': [[emotion, cause], ...]}]
+
+prompts are built by prompt_utils exactly as MyDataset of the task script and the masks are
+decoded with the window logic of prf_prompt / crf_prompt. a document is a list of clauses, a dict
+{"clauses": [...], "emotions": [...], "pairs": [...], "doc_id": ...} or a document parsed by
+prompt_utils.read_docs. ECE needs the emotion clauses, CCRC the candidate pairs of one emotion.
+documents whose prompt does not fit max_length are chunked and stitched (see chunking.py).
+with a pred_cache.PredictionCache, prompts seen before are answered without the model.
+"""
+import itertools
+import torch
+from transformers import BertTokenizer
+import chunking
+import pred_cache
+import prompt_utils
+
+
+def to_doc(task, document, index=0):
+    """parsed document of a list of clauses, a dict or a document of prompt_utils.read_docs"""
+    if isinstance(document, dict) and 'lines' in document:
+        return document
+    if isinstance(document, (list, tuple)):
+        document = {'clauses': document}
+    if task == 'CCRC' and not document.get('pairs'):
+        raise ValueError('CCRC documents need the candidate "pairs" of one emotion')
+    if task == 'ECE' and not document.get('emotions'):
+        raise ValueError('ECE documents need their 1-based "emotions" clauses')
+    return prompt_utils.raw_doc(document['clauses'], document.get('pairs', ()), document.get('emotions', ()),
+                                document.get('doc_id', index))
+
+
+def build_prompts(task, docs, tokenizer, max_length=512, overlap=4, num_for_M=2):
+    """(input_ids of every window, windows per document) of parsed documents"""
+    windows, plans = chunking.chunk_docs(task, docs, tokenizer, max_length, overlap, num_for_M)
+    input_ids = [prompt_utils.encode(tokenizer, prompt_utils.build_texts(task, w, num_for_M)[0], max_length)
+                 for w in windows]
+    return input_ids, plans
+
+
+class Predictor(object):
+    def __init__(self, task, model, tokenizer, window_size=2, max_length=512, overlap=4, num_for_M=2, cache=None,
+                 model_hash=''):
+        if task not in prompt_utils.tasks:
+            raise ValueError('unknown task {}, expected one of {}'.format(task, prompt_utils.tasks))
+        self.task = task
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.window_size = window_size
+        self.max_length = max_length
+        self.overlap = overlap
+        self.num_for_M = num_for_M
+        self.device = next(model.parameters()).device
+        self.cache = cache
+        self.model_hash = model_hash
+
+    @classmethod
+    def from_checkpoint(cls, task, path, bert_path='./bert-base-chinese', device='cpu', **kwargs):
+        """load a fold{k}.pth written by the task scripts"""
+        model = prompt_utils.load_checkpoint(path, map_location=device)
+        if kwargs.get('cache') is not None:
+            kwargs.setdefault('model_hash', pred_cache.checkpoint_hash(path))
+        return cls(task, model, BertTokenizer.from_pretrained(bert_path), **kwargs)
+
+    def to_doc(self, document, index=0):
+        return to_doc(self.task, document, index)
+
+    def prompts(self, docs):
+        return build_prompts(self.task, docs, self.tokenizer, self.max_length, self.overlap, self.num_for_M)
+
+    def mask_scores(self, input_ids):
+        """run the model on one padded batch, return prompt_utils.mask_scores"""
+        input_ids = torch.tensor(input_ids).to(self.device)
+        with torch.no_grad():
+            _, logits = self.model(input_ids, None)
+        return prompt_utils.mask_scores(logits, input_ids)
+
+    def run_slots(self, input_ids):
+        """decoded slots of one padded batch of prompts"""
+        return [prompt_utils.decode_slots(self.task, *s, window_size=self.window_size)
+                for s in self.mask_scores(input_ids)]
+
+    def cache_key(self, input_ids):
+        return pred_cache.prompt_key(self.model_hash, self.task, self.window_size, input_ids)
+
+    def cached_slots(self, input_ids, run):
+        """
+        slots of every prompt, from the cache where possible; run(list of input_ids) returns the
+        slots of the misses, which are then added to the cache
+        """
+        if self.cache is None:
+            return run(input_ids)
+        keys = [self.cache_key(ids) for ids in input_ids]
+        slots = [self.cache.get(key) for key in keys]
+        missing = [i for i, s in enumerate(slots) if s is None]
+        if missing:
+            for i, s in zip(missing, run([input_ids[i] for i in missing])):
+                slots[i] = s
+                self.cache.put(keys[i], s)
+        return slots
+
+    def results(self, docs, plans, window_slots):
+        """stitch the slots of the windows of docs into structured predictions"""
+        results, k = [], 0
+        for doc, plan in zip(docs, plans):
+            slots = chunking.stitch(self.task, doc['d_len'], plan, window_slots[k:k + len(plan)])
+            k += len(plan)
+            emotion_index = doc['pairs'][0][0] if doc['pairs'] else 0
+            result = {'doc_id': doc['doc_id']}
+            result.update(prompt_utils.slots_to_result(self.task, slots, emotion_index))
+            results.append(result)
+        return results
+
+    def predict(self, documents, batch_size=8):
+        """predictions of a list of documents, in input order"""
+        return list(itertools.chain.from_iterable(self.predict_batches(documents, batch_size)))
+
+    def predict_batches(self, documents, batch_size=8):
+        """
+        generator over any iterable of documents, yields the predictions of batch_size documents at a
+        time so that only one batch of prompts and logits is held in memory
+        """
+        def run(input_ids):
+            slots = []
+            for start in range(0, len(input_ids), batch_size):
+                slots.extend(self.run_slots(input_ids[start:start + batch_size]))
+            return slots
+
+        documents = iter(documents)
+        index = 0
+        while True:
+            chunk = list(itertools.islice(documents, batch_size))
+            if not chunk:
+                return
+            docs = [self.to_doc(d, index + i) for i, d in enumerate(chunk)]
+            index += len(chunk)
+            input_ids, plans = self.prompts(docs)
+            yield self.results(docs, plans, self.cached_slots(input_ids, run))
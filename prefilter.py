@@ -0,0 +1,321 @@
+"""
+two-stage cascade for pair extraction (ECPE / M2M).
+
+stage 1 scores every clause with a linear model over hashed keyword features (emotion keyword
+lexicon of data_combine_CCRC/clause_keywords.csv, distance to the nearest keyword clause, words,
+position). documents without a candidate clause are answered "no pair" without BERT, the others
+are cropped to the clauses within --window_size of the first and last candidate and only that
+window is sent to the fine-tuned prompt model.
+
+    python prefilter.py --task ECPE --dataset data_combine_ECPE/ --checkpointpath checkpoint/ECPE/ \
+        --target_recall 0.98 --output prefilter_ECPE.json
+
+for every fold the prefilter is trained on foldk_train.txt, then the test documents are run through
+the full model and through the cascade; the table shows stage-1 recall, F1 of both and throughput.
+"""
+import argparse
+import csv
+import json
+import os
+import time
+import zlib
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from transformers import BertTokenizer
+import prompt_utils
+
+
+def read_keywords(path):
+    """doc_id -> emotion keyword"""
+    keywords = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            keywords[row[0]] = row[2]
+    return keywords
+
+
+def clause_features(doc, lexicon):
+    """list of string features for every clause of doc"""
+    clauses = doc['clauses']
+    n = len(clauses)
+    hits = [[w for w in clause.split() if w in lexicon] for clause in clauses]
+    anchors = [i for i, h in enumerate(hits) if h]
+    features = []
+    for i, clause in enumerate(clauses):
+        words = clause.split()
+        feats = ['bias', 'pos={}'.format(min(i, 10)), 'rpos={}'.format(min(n - 1 - i, 10)),
+                 'len={}'.format(min(len(words) // 3, 8))]
+        feats.extend('w=' + w for w in words)
+        if hits[i]:
+            feats.append('kw')
+            feats.extend('kw=' + w for w in hits[i])
+        if anchors:
+            dist = min((a - i for a in anchors), key=abs)
+            feats.append('d={}'.format(max(-4, min(4, dist))))
+            feats.append('dist={}'.format(min(abs(dist), 5)))
+        else:
+            feats.append('d=none')
+        features.append(feats)
+    return features
+
+
+class ClauseFilter(torch.nn.Module):
+    """logistic regression on hashed features, outputs (emotion, cause) logits per clause"""
+
+    def __init__(self, lexicon, n_features=1 << 18):
+        super(ClauseFilter, self).__init__()
+        self.lexicon = sorted(lexicon)
+        self.lexicon_set = set(self.lexicon)
+        self.n_features = n_features
+        self.linear = torch.nn.EmbeddingBag(n_features, 2, mode='sum')
+        torch.nn.init.zeros_(self.linear.weight)
+        self.thresholds = [0.5, 0.5]
+
+    def encode(self, docs):
+        """flattened feature ids, bag offsets and the number of clauses of every document"""
+        ids, offsets, sizes = [], [], []
+        for doc in docs:
+            features = clause_features(doc, self.lexicon_set)
+            sizes.append(len(features))
+            for feats in features:
+                offsets.append(len(ids))
+                ids.extend(zlib.crc32(f.encode('utf-8')) % self.n_features for f in feats)
+        return torch.tensor(ids, dtype=torch.long), torch.tensor(offsets, dtype=torch.long), sizes
+
+    def forward(self, ids, offsets):
+        return self.linear(ids, offsets)
+
+    def scores(self, docs):
+        """per document a [n_clause, 2] array of emotion / cause probabilities"""
+        ids, offsets, sizes = self.encode(docs)
+        with torch.no_grad():
+            probs = torch.sigmoid(self(ids, offsets)).numpy()
+        return np.split(probs, np.cumsum(sizes)[:-1]) if sizes else []
+
+    def candidates(self, probs, emotion_only=False):
+        """
+        clauses that may take part in a pair. emotion_only gives smaller windows, causes outside
+        window_size of an emotion clause cannot be decoded anyway, but stage-1 recall is lower
+        """
+        keep = probs[:, 0] >= self.thresholds[0]
+        if not emotion_only:
+            keep |= probs[:, 1] >= self.thresholds[1]
+        return np.nonzero(keep)[0]
+
+    def save(self, path):
+        torch.save({'lexicon': self.lexicon, 'n_features': self.n_features, 'thresholds': self.thresholds,
+                    'state_dict': self.state_dict()}, path)
+
+    @classmethod
+    def load(cls, path):
+        state = torch.load(path, map_location='cpu')
+        model = cls(state['lexicon'], state['n_features'])
+        model.load_state_dict(state['state_dict'])
+        model.thresholds = state['thresholds']
+        return model
+
+
+def clause_labels(doc):
+    labels = np.zeros((doc['d_len'], 2), dtype=np.float32)
+    for emotion, cause in doc['pairs']:
+        if emotion <= doc['d_len']:
+            labels[emotion - 1, 0] = 1
+        if cause <= doc['d_len']:
+            labels[cause - 1, 1] = 1
+    return labels
+
+
+def pick_threshold(probs, labels, target_recall):
+    """largest threshold whose clause recall on labels stays at or above target_recall"""
+    positive = np.sort(probs[labels == 1])[::-1]
+    if len(positive) == 0:
+        return 0.5
+    keep = int(np.ceil(target_recall * len(positive)))
+    return float(positive[max(keep, 1) - 1])
+
+
+def train_filter(docs, keywords, epochs=30, lr=0.05, l2=1e-6, target_recall=0.98, dev_ratio=0.1, seed=42):
+    """
+    fit the clause filter on docs; the thresholds are set on a held-out part of docs so that
+    target_recall of the emotion and of the cause clauses stay candidates
+    """
+    lexicon = set(keywords[d['doc_id']] for d in docs if d['doc_id'] in keywords)
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(len(docs))
+    n_dev = int(len(docs) * dev_ratio)
+    dev = [docs[i] for i in order[:n_dev]]
+    train = [docs[i] for i in order[n_dev:]]
+    model = ClauseFilter(lexicon)
+    ids, offsets, _ = model.encode(train)
+    labels = torch.tensor(np.concatenate([clause_labels(d) for d in train]))
+    # the positive classes are rare, weight them to the negatives
+    pos_weight = (len(labels) - labels.sum(0)) / labels.sum(0).clamp(min=1)
+    optimizer = torch.optim.Adagrad(model.parameters(), lr=lr)
+    for epoch in range(epochs):
+        logits = model(ids, offsets)
+        loss = F.binary_cross_entropy_with_logits(logits, labels, pos_weight=pos_weight)
+        loss = loss + l2 * model.linear.weight.pow(2).sum()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    print('prefilter loss: {:.4f}'.format(loss.item()))
+    dev = dev or train
+    probs = np.concatenate(model.scores(dev))
+    dev_labels = np.concatenate([clause_labels(d) for d in dev])
+    model.thresholds = [pick_threshold(probs[:, k], dev_labels[:, k], target_recall) for k in range(2)]
+    return model
+
+
+def crop_window(doc, candidates, window_size):
+    """
+    sub-document covering candidates +- window_size, renumbered from 1. returns (sub_doc, offset)
+    where offset is added to the clause numbers predicted on sub_doc.
+    """
+    start = max(0, int(candidates.min()) - window_size)
+    end = min(doc['d_len'], int(candidates.max()) + window_size + 1)
+    return prompt_utils.sub_doc(doc, start, end), start
+
+
+def gold_sets(doc):
+    pairs = set(doc['pairs'])
+    return set(p[0] for p in pairs), set(p[1] for p in pairs), pairs
+
+
+def add_doc_counts(counts, result, doc):
+    """document level counters of emotion / cause / pair predictions against the annotation"""
+    emotions, causes, pairs = gold_sets(doc)
+    predicted = {'emo': set(result.get('emotions', [])), 'cause': set(result.get('causes', [])),
+                 'pair': set(tuple(p) for p in result.get('pairs', []))}
+    for key, gold in (('emo', emotions), ('cause', causes), ('pair', pairs)):
+        counts[key + '_gt'] += len(gold)
+        counts[key + '_pre'] += len(predicted[key])
+        counts[key + '_acc'] += len(predicted[key] & gold)
+    return counts
+
+
+def empty_result():
+    return {'emotions': [], 'causes': [], 'pairs': []}
+
+
+def predict_docs(task, model, tokenizer, docs, offsets, batch_size, window_size, max_length=512, num_for_M=2):
+    """structured predictions of the prompt model for docs, clause numbers shifted by offsets"""
+    if not docs:
+        return []
+    dataset = prompt_utils.PromptDataset(task, docs, tokenizer, max_length, num_for_M, verbose=False)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    results = []
+    with torch.no_grad():
+        for batch in loader:
+            _, logits = model(batch['input_ids'], None)
+            for top1, verb, prev in prompt_utils.mask_scores(logits, batch['input_ids']):
+                slots = prompt_utils.decode_slots(task, top1, verb, prev, window_size)
+                results.append(prompt_utils.slots_to_result(task, slots, offset=offsets[len(results)]))
+    return results
+
+
+def run_fold(opt, tokenizer, keywords, fold):
+    train_docs = list(prompt_utils.read_docs(opt.dataset + 'fold{}_train.txt'.format(fold)))
+    test_docs = list(prompt_utils.read_docs(opt.dataset + 'fold{}_test.txt'.format(fold)))
+    prefilter = train_filter(train_docs, keywords, opt.epochs, opt.filter_lr, target_recall=opt.target_recall)
+    if opt.save_path:
+        if not os.path.exists(opt.save_path):
+            os.makedirs(opt.save_path)
+        prefilter.save(os.path.join(opt.save_path, 'fold{}.pth'.format(fold)))
+    model = prompt_utils.load_checkpoint(os.path.join(opt.checkpointpath, 'fold{}.pth'.format(fold))).eval()
+
+    # full model on every document
+    start = time.perf_counter()
+    full = predict_docs(opt.task, model, tokenizer, test_docs, [0] * len(test_docs), opt.batch_size,
+                        opt.window_size, opt.max_length, opt.num_for_M)
+    full_time = time.perf_counter() - start
+
+    # cascade
+    start = time.perf_counter()
+    crops, offsets, kept = [], [], []
+    kept_pairs, n_pairs = 0, 0
+    for index, (doc, probs) in enumerate(zip(test_docs, prefilter.scores(test_docs))):
+        candidates = prefilter.candidates(probs, opt.emotion_only)
+        n_pairs += len(set(doc['pairs']))
+        if len(candidates) == 0:
+            continue
+        crop, offset = crop_window(doc, candidates, opt.window_size)
+        kept_pairs += sum(1 for e, c in set(crop['pairs']) if 0 < e <= crop['d_len'] and 0 < c <= crop['d_len'])
+        crops.append(crop)
+        offsets.append(offset)
+        kept.append(index)
+    cascade = [empty_result() for _ in test_docs]
+    for index, result in zip(kept, predict_docs(opt.task, model, tokenizer, crops, offsets, opt.batch_size,
+                                                opt.window_size, opt.max_length, opt.num_for_M)):
+        cascade[index] = result
+    cascade_time = time.perf_counter() - start
+
+    full_counts, cascade_counts = prompt_utils.new_counts(), prompt_utils.new_counts()
+    for doc, a, b in zip(test_docs, full, cascade):
+        add_doc_counts(full_counts, a, doc)
+        add_doc_counts(cascade_counts, b, doc)
+    full_prf, cascade_prf = prompt_utils.prf('ECPE', full_counts), prompt_utils.prf('ECPE', cascade_counts)
+    return {
+        'docs': len(test_docs),
+        'docs_to_bert': len(crops),
+        'clauses_to_bert': sum(c['d_len'] for c in crops),
+        'clauses': sum(d['d_len'] for d in test_docs),
+        'thresholds': prefilter.thresholds,
+        'stage1_pair_recall': kept_pairs / max(n_pairs, 1),
+        'full_pair_f': full_prf['pair'][2],
+        'cascade_pair_f': cascade_prf['pair'][2],
+        'full_pair_r': full_prf['pair'][1],
+        'cascade_pair_r': cascade_prf['pair'][1],
+        'full': {k: list(v) for k, v in full_prf.items()},
+        'cascade': {k: list(v) for k, v in cascade_prf.items()},
+        'full_docs_per_sec': len(test_docs) / full_time,
+        'cascade_docs_per_sec': len(test_docs) / cascade_time,
+        'speedup': full_time / cascade_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='keyword prefilter cascade for pair extraction')
+    parser.add_argument('--task', type=str, default='ECPE', choices=['ECPE', 'M2M'])
+    parser.add_argument('--dataset', type=str, default='data_combine_ECPE/', help='path for dataset')
+    parser.add_argument('--keywords', type=str, default='data_combine_CCRC/clause_keywords.csv',
+                        help='doc_id,clause_id,keyword,... rows')
+    parser.add_argument('--checkpointpath', type=str, default='checkpoint/ECPE/', help='fold checkpoints')
+    parser.add_argument('--bert_path', type=str, default='./bert-base-chinese', help='tokenizer')
+    parser.add_argument('--save_path', type=str, default='', help='save the fold prefilters here')
+    parser.add_argument('--folds', type=str, default='1,2,3,4,5,6,7,8,9,10', help='comma separated folds')
+    parser.add_argument('--batch_size', type=int, default=8, help='number of example per batch')
+    parser.add_argument('--window_size', type=int, default=2, help='size of the emotion cause pair window')
+    parser.add_argument('--num_for_M', type=int, default=2, help='for M2M module')
+    parser.add_argument('--max_length', type=int, default=512,
+                        help='padded length; the checkpoints were trained on 512 without attention mask')
+    parser.add_argument('--target_recall', type=float, default=0.98, help='clause recall kept by stage 1')
+    parser.add_argument('--emotion_only', type=bool, default=False, help='crop around emotion candidates only')
+    parser.add_argument('--epochs', type=int, default=30, help='training epochs of the prefilter')
+    parser.add_argument('--filter_lr', type=float, default=0.05, help='learning rate of the prefilter')
+    parser.add_argument('--output', type=str, default='', help='json file for the per fold report')
+    opt = parser.parse_args()
+
+    tokenizer = BertTokenizer.from_pretrained(opt.bert_path)
+    keywords = read_keywords(opt.keywords)
+    report = {}
+    print('fold  stage1_recall  docs_to_bert  clauses_to_bert  full_pair_f  cascade_pair_f  speedup')
+    for fold in [int(f) for f in opt.folds.split(',') if f]:
+        r = run_fold(opt, tokenizer, keywords, fold)
+        report[fold] = r
+        print('{:4d}  {:13.4f}  {:5d}/{:<6d}  {:6d}/{:<8d}  {:11.4f}  {:14.4f}  {:6.2f}x'.format(
+            fold, r['stage1_pair_recall'], r['docs_to_bert'], r['docs'], r['clauses_to_bert'], r['clauses'],
+            r['full_pair_f'], r['cascade_pair_f'], r['speedup']))
+    folds = list(report.values())
+    average = {k: float(np.mean([r[k] for r in folds])) for k in
+               ('stage1_pair_recall', 'full_pair_f', 'cascade_pair_f', 'full_pair_r', 'cascade_pair_r', 'speedup')}
+    print('average stage1 recall {stage1_pair_recall:.4f} pair f {full_pair_f:.4f} -> {cascade_pair_f:.4f} '
+          'pair r {full_pair_r:.4f} -> {cascade_pair_r:.4f} speedup {speedup:.2f}x'.format(**average))
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump({'task': opt.task, 'folds': report, 'average': average}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
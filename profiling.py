@@ -0,0 +1,125 @@
+"""
+stage timers for the training and test loops of the task scripts.
+
+    prof = StageProfiler('profile/ECPE', trace_dir='profile/trace', window='5,2,5')
+    prof.set_fold(fold)
+    for index, data in enumerate(prof.iterate(trainloader, 'train')):   # time of next() is 'data'
+        ...
+        prof.mark('to_device')
+        loss, logits = model(x_bert, mask_label)
+        prof.mark('forward')                                            # time since the last mark
+    ...
+    prof.write()   # profile/ECPE.json and profile/ECPE.csv
+
+a mark is one perf_counter call and a list append. the report holds, per fold, phase and stage,
+the number of steps, total / mean / p50 / p95 seconds, and the steps/sec of each phase. with a
+trace_dir, torch.profiler records the steps of the window (wait, warmup, active) of the first
+training epoch and writes a chrome trace there; the window must fit in that epoch. a disabled
+profiler does nothing.
+"""
+import collections
+import csv
+import json
+import os
+import time
+import numpy as np
+import torch
+
+
+class StageProfiler(object):
+    def __init__(self, report='', trace_dir='', window='5,2,5', rank=0):
+        self.enabled = bool(report or trace_dir)
+        self.report = report + ('.rank{}'.format(rank) if rank and report else '')
+        self.trace_dir = trace_dir if rank == 0 else ''
+        self.window = [int(w) for w in window.split(',')]
+        self.times = collections.defaultdict(list)
+        self.walls = collections.defaultdict(float)
+        self.steps = collections.defaultdict(int)
+        self.fold, self.phase = 0, ''
+        self.last = time.perf_counter()
+        self.trace = None
+        self.traced = False
+
+    def set_fold(self, fold):
+        self.fold = fold
+
+    def mark(self, stage):
+        """charge the time since the previous mark (or step) to stage"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.times[(self.fold, self.phase, stage)].append(now - self.last)
+        self.last = now
+
+    def iterate(self, loader, phase):
+        """yield the batches of loader, timing next() as the 'data' stage and counting steps"""
+        if not self.enabled:
+            yield from loader
+            return
+        self.phase = phase
+        self.start_trace(phase)
+        start = time.perf_counter()
+        iterator = iter(loader)
+        while True:
+            before = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            self.last = time.perf_counter()
+            self.times[(self.fold, phase, 'data')].append(self.last - before)
+            self.steps[(self.fold, phase)] += 1
+            if self.trace is not None:
+                self.trace.step()
+            yield item
+        self.last = time.perf_counter()
+        self.walls[(self.fold, phase)] += self.last - start
+        self.stop_trace()
+
+    def start_trace(self, phase):
+        if not self.trace_dir or self.traced or phase != 'train':
+            return
+        wait, warmup, active = self.window
+        self.trace = torch.profiler.profile(
+            activities=[torch.profiler.ProfilerActivity.CPU],
+            schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir), record_shapes=True)
+        self.trace.__enter__()
+        self.traced = True
+
+    def stop_trace(self):
+        if self.trace is not None:
+            self.trace.__exit__(None, None, None)
+            self.trace = None
+
+    def summary(self):
+        rows = []
+        for (fold, phase, stage), values in sorted(self.times.items()):
+            values = np.array(values)
+            wall = self.walls.get((fold, phase), 0.)
+            steps = self.steps.get((fold, phase), 0)
+            rows.append({'fold': fold, 'phase': phase, 'stage': stage, 'count': len(values),
+                         'total': float(values.sum()), 'mean': float(values.mean()),
+                         'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)),
+                         'phase_seconds': wall, 'steps_per_sec': steps / wall if wall else 0.})
+        return rows
+
+    def write(self):
+        """write the report so far, called after every fold"""
+        if not self.report:
+            return
+        directory = os.path.dirname(self.report)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        rows = self.summary()
+        with open(self.report + '.json', 'w') as f:
+            json.dump(rows, f, indent=2)
+        if rows:
+            with open(self.report + '.csv', 'w', newline='') as f:
+                writer = csv.DictWriter(f, list(rows[0]))
+                writer.writeheader()
+                writer.writerows(rows)
+        for row in rows:
+            if row['fold'] == self.fold:
+                print('profile fold {fold} {phase:5s} {stage:10s} mean {mean:.4f}s p50 {p50:.4f}s p95 {p95:.4f}s '
+                      'total {total:.1f}s ({steps_per_sec:.2f} steps/s)'.format(**row))
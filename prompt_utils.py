@@ -0,0 +1,640 @@
+"""
+prompt construction and mask decoding shared by the tools around the task scripts.
+
+the templates are ports of MyDataset in ECE.py, ECPE.py, ECPE_M2M.py and CCRC.py and the
+decoding reproduces prf_prompt / crf_prompt, so numbers computed here match the scripts.
+nothing in this module parses command line arguments, it can be imported from anywhere.
+"""
+import ast
+import os
+import sys
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from transformers import BertTokenizer, BertForMaskedLM
+
+label_index = [122, 123, 124, 125, 126, 127, 128, 129, 130, 8108, 8111, 8110, 8124, 8122, 8115, 8121, 8126, 8123,
+               8131, 8113, 8128, 8130, 8133, 8125, 8132, 8153, 8149, 8143, 8162, 8114, 8176, 8211, 8226, 8229, 8198,
+               8216, 8234, 8218, 8240, 8164, 8245, 8239, 8250, 8252, 8208, 8248, 8264, 8214, 8249, 8145, 8246, 8247,
+               8251, 8267, 8222, 8259, 8272, 8255, 8257, 8183, 8398, 8356, 8381, 8308, 8284, 8347, 8369, 8360, 8419,
+               8203, 8459, 8325, 8454, 8473, 8273]
+pad_id = 0
+cls_id = 101
+sep_id = 102
+mask_id = 103
+yes_id = 3221  # 是
+no_id = 7478  # 非
+none_id = 3187  # 无
+vocab_size = 21128
+max_clause = len(label_index)
+
+# every token a mask position is trained to produce; index 0/1/2 are 是/非/无, index 2 + k is clause number k
+verbalizer_ids = [yes_id, no_id, none_id] + label_index
+verb_none = 2
+
+tasks = ('ECE', 'ECPE', 'CCRC', 'M2M')
+# mask slots per clause, in prompt order
+slot_names = {
+    'ECE': ('cause', 'pair'),
+    'ECPE': ('emotion', 'cause', 'pair'),
+    'M2M': ('emotion', 'cause', 'pair', 'pair'),
+    'CCRC': ('pair',),
+}
+# metrics printed by each script
+targets = {
+    'ECE': ('cause',),
+    'ECPE': ('emotion', 'cause', 'pair'),
+    'M2M': ('emotion', 'cause', 'pair'),
+    'CCRC': ('conditional',),
+}
+# the metric used to pick the best epoch
+main_target = {'ECE': 'cause', 'ECPE': 'pair', 'M2M': 'pair', 'CCRC': 'conditional'}
+
+
+class prompt_bert(torch.nn.Module):
+    def __init__(self, bert_path='./bert-base-chinese'):
+        super(prompt_bert, self).__init__()
+        self.bert = BertForMaskedLM.from_pretrained(bert_path)
+        self.tokenizer = BertTokenizer.from_pretrained(bert_path)
+        self.bert.resize_token_embeddings(len(self.tokenizer))
+
+    def forward(self, x_bert, labels):
+        output = self.bert(x_bert, labels=labels)
+        loss, logits = output.loss, output.logits
+        return loss, logits
+
+
+def load_checkpoint(path, map_location='cpu', mmap=False):
+    """
+    torch.load a fold{k}.pth written by one of the task scripts. they pickle the whole model,
+    whose class lives in the __main__ of that script, so provide it when loading from elsewhere.
+    with mmap the weights stay in the file and are paged in when used (cpu only).
+    """
+    main = sys.modules['__main__']
+    if not hasattr(main, 'prompt_bert'):
+        main.prompt_bert = prompt_bert
+    kwargs = {'mmap': True} if mmap else {}
+    try:
+        return torch.load(path, map_location=map_location, weights_only=False, **kwargs)
+    except TypeError:
+        return torch.load(path, map_location=map_location, **kwargs)
+
+
+def parse_pairs(line):
+    pairs = ast.literal_eval('[' + line.strip() + ']')
+    return [tuple(p) for p in pairs]
+
+
+def make_doc(header, pairs, lines):
+    return {
+        'doc_id': header[0],
+        'd_len': int(header[1]),
+        'header': header,
+        'pairs': pairs,
+        'clauses': [line.split(',')[-1] for line in lines],
+        'lines': lines,
+    }
+
+
+def raw_doc(clauses, pairs=(), emotions=(), doc_id='0', conditional=0):
+    """
+    document without annotation file, for prediction. ECE needs the emotion clauses and CCRC the
+    candidate pairs, the other tasks only need the clause texts.
+    """
+    clauses = [' '.join(str(c).split()) for c in clauses]
+    pairs = [tuple(int(x) for x in p) for p in pairs]
+    header = [str(doc_id), str(len(clauses)), str(conditional), '0']
+    doc = make_doc(header, pairs, ['{},null,null,{}'.format(i + 1, c) for i, c in enumerate(clauses)])
+    doc['emotions'] = sorted(set(int(e) for e in emotions))
+    return doc
+
+
+def read_docs(input_file):
+    """yield the documents of a file in the ECPE text format (or its binary corpus), one at a time"""
+    import corpus_bin
+    input_file = corpus_bin.resolve(input_file)
+    if corpus_bin.is_binary(input_file):
+        for doc in corpus_bin.Corpus(input_file):
+            yield doc
+        return
+    with open(input_file, 'r', encoding='utf-8') as inputFile:
+        while True:
+            line = inputFile.readline()
+            if line == '' or line.strip() == '':
+                break
+            header = line.strip().split()
+            d_len = int(header[1])
+            pairs = parse_pairs(inputFile.readline())
+            lines = [inputFile.readline().strip() for _ in range(d_len)]
+            yield make_doc(header, pairs, lines)
+
+
+def read_split(manifest, fold, split='test'):
+    """
+    yield the documents of one split of a folds.tsv manifest written by divide_fold.py, read from
+    its source file by offset; the same documents, in the same order, as the fold file it would
+    materialize
+    """
+    with open(manifest, encoding='utf-8') as f:
+        settings = dict(item.split('=', 1) for item in f.readline()[1:].split())
+        rows = [line.rstrip('\n').split('\t') for line in f][1:]
+    source = os.path.join(os.path.dirname(manifest), settings['source'])
+    with open(source, 'rb') as src:
+        for position, doc_id, row_fold, offset, length, _ in rows:
+            if (int(row_fold) == fold) != (split == 'test'):
+                continue
+            src.seek(int(offset))
+            lines = src.read(int(length)).decode('utf-8').split('\n')
+            header = lines[0].split()
+            header[0] = doc_id
+            d_len = int(header[1])
+            yield make_doc(header, parse_pairs(lines[1]), [line.strip() for line in lines[2:2 + d_len]])
+
+
+def format_doc(doc):
+    """inverse of read_docs for one document"""
+    out = [' '.join(doc['header']), ', '.join('({}, {})'.format(e, c) for e, c in doc['pairs'])]
+    out.extend(doc['lines'])
+    return '\n'.join(out) + '\n'
+
+
+def sub_doc(doc, start, end):
+    """
+    clauses start+1 .. end of doc (1-based, inclusive) as a document renumbered from 1. pairs with at
+    least one clause inside are kept, the other end may fall outside 1..d_len so the emotion / cause
+    marks of ECE and CCRC stay in place; answers pointing outside the window become 无.
+    """
+    lines = ['{},{}'.format(i + 1, line.split(',', 1)[1]) for i, line in enumerate(doc['lines'][start:end])]
+    pairs = [(e - start, c - start) for e, c in doc['pairs'] if start < e <= end or start < c <= end]
+    header = [doc['doc_id'], str(end - start)] + doc['header'][2:]
+    out = make_doc(header, pairs, lines)
+    if 'emotions' in doc:
+        out['emotions'] = [e - start for e in doc['emotions'] if start < e <= end]
+    return out
+
+
+def _number(n, d_len):
+    return str(n) if 1 <= n <= d_len else '无'
+
+
+def _pos_cause(doc):
+    if doc['pairs']:
+        pos, cause = zip(*doc['pairs'])
+        return pos, cause
+    return tuple(doc.get('emotions', ())), ()
+
+
+def build_texts(task, doc, num_for_M=2):
+    """
+    return (x_text, y_text, train_mask_text): the model input, the filled-in answer and the
+    input used to pick the training targets, exactly as the MyDataset of the task script
+    """
+    pos, cause = _pos_cause(doc)
+    pairs = doc['pairs']
+    part_sentence = doc['clauses']
+    full_document = ""
+    x_document = ""
+    mask_label_document = ""
+    if task == 'M2M':
+        diction = {}
+        for i in set(pairs):
+            if i[1] in diction.keys():
+                diction[i[1]].append(i[0])
+            else:
+                diction[i[1]] = [i[0]]
+    result_label = int(doc['header'][2]) if task == 'CCRC' else 1
+    for i in range(1, doc['d_len'] + 1):
+        full_document = full_document + ' ' + str(i) + ' ' + part_sentence[i - 1]
+        if task == 'ECE':
+            x_document = x_document + ' ' + str(i) + ' ' + part_sentence[i - 1]
+            mask_label_document = mask_label_document + ' [MASK] ' + part_sentence[i - 1]
+            full_document = full_document + ('是 ' if i in pos else '非 ')
+            x_document = x_document + ('是 ' if i in pos else '非 ')
+            mask_label_document = mask_label_document + ('是 ' if i in pos else '非 ')
+            if i in cause:
+                full_document = full_document + '是 ' + ' ' + _number(pos[cause.index(i)], doc['d_len']) + ' '
+            else:
+                full_document = full_document + '非 ' + ' 无 '
+            full_document = full_document + '[SEP]'
+            x_document = x_document + "[MASK] [MASK][SEP]"
+            mask_label_document = mask_label_document + "[MASK] [MASK][SEP]"
+        elif task == 'ECPE':
+            x_document = x_document + ' ' + str(i) + ' ' + part_sentence[i - 1]
+            mask_label_document = mask_label_document + ' [MASK] ' + part_sentence[i - 1]
+            full_document = full_document + ('是 ' if i in pos else '非 ')
+            if i in cause:
+                full_document = full_document + '是 ' + ' ' + _number(pos[cause.index(i)], doc['d_len']) + ' '
+            else:
+                full_document = full_document + '非 ' + ' 无 '
+            full_document = full_document + '[SEP]'
+            x_document = x_document + "[MASK] [MASK] [MASK][SEP]"
+            mask_label_document = mask_label_document + "[MASK] [MASK] [MASK][SEP]"
+        elif task == 'M2M':
+            x_document = x_document + ' ' + str(i) + ' ' + part_sentence[i - 1]
+            mask_label_document = mask_label_document + ' [MASK] ' + part_sentence[i - 1]
+            if i in pos:
+                full_document = full_document + '是 '
+                if i in cause:
+                    full_document = full_document + '是 '
+                    for j in range(2):
+                        if j < len(diction[i]):
+                            full_document = full_document + ' ' + _number(diction[i][j], doc['d_len']) + ' '
+                        else:
+                            full_document = full_document + ' 无 '
+                else:
+                    full_document = full_document + '非 ' + ' 无 无 '
+            else:
+                full_document = full_document + '非 '
+                if i in cause:
+                    full_document = full_document + '是 '
+                    for j in range(num_for_M):
+                        if j < len(diction[i]):
+                            full_document = full_document + ' ' + _number(diction[i][j], doc['d_len']) + ' '
+                        else:
+                            full_document = full_document + ' 无 '
+                else:
+                    full_document = full_document + '非 ' + ' 无 无'
+            full_document = full_document + '[SEP]'
+            x_document = x_document + "[MASK] [MASK] [MASK][MASK][SEP]"
+            mask_label_document = mask_label_document + "[MASK] [MASK] [MASK][MASK][SEP]"
+        elif task == 'CCRC':
+            x_document = x_document + ' ' + str(i) + ' ' + part_sentence[i - 1]
+            mask_label_document = mask_label_document + ' [MASK] ' + part_sentence[i - 1]
+            marks = ('是 ' if i in pos else '非 ') + ('是 ' if i in cause else '非 ')
+            full_document = full_document + marks
+            x_document = x_document + marks
+            mask_label_document = mask_label_document + marks
+            if i in cause and result_label == 1:
+                full_document = full_document + ' ' + _number(pos[cause.index(i)], doc['d_len']) + ' '
+            else:
+                full_document = full_document + ' 无 '
+            full_document = full_document + '[SEP]'
+            x_document = x_document + "[MASK][SEP]"
+            mask_label_document = mask_label_document + "[MASK][SEP]"
+        else:
+            raise ValueError('unknown task {}'.format(task))
+    return x_document, full_document, mask_label_document
+
+
+def encode(tokenizer, text, max_length=512):
+    """padded to max_length like the scripts, or the untruncated ids when max_length is None"""
+    if max_length is None:
+        return tokenizer(text)['input_ids']
+    return tokenizer(text, max_length=max_length, truncation=True, padding='max_length')['input_ids']
+
+
+class TokenStore(object):
+    """
+    tokenization shared by all prompts: every clause and every template fragment between clauses
+    is tokenized once, the ids of a prompt are joined from them. a fragment ends in a space before
+    a clause and a clause is followed by 是/非/无 or [MASK], all word boundaries of BertTokenizer,
+    so the ids equal those of tokenizer(text).
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.pieces = {}
+        self.hits = 0
+
+    def piece(self, text):
+        ids = self.pieces.get(text)
+        if ids is None:
+            ids = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(text))
+            self.pieces[text] = ids
+        else:
+            self.hits += 1
+        return ids
+
+    def ids(self, text, clauses):
+        """ids of text without [CLS] / [SEP], cut at the clauses, which occur in order"""
+        out, pos = [], 0
+        for clause in clauses:
+            at = text.find(clause, pos) if clause else -1
+            if at < 0:
+                continue
+            out.extend(self.piece(text[pos:at]))
+            out.extend(self.piece(clause))
+            pos = at + len(clause)
+        out.extend(self.piece(text[pos:]))
+        return out
+
+    def encode(self, text, clauses, max_length=512):
+        """same as encode(tokenizer, text, max_length)"""
+        ids = self.ids(text, clauses)
+        if max_length is None:
+            return [cls_id] + ids + [sep_id]
+        ids = [cls_id] + ids[:max_length - 2] + [sep_id]
+        return ids + [pad_id] * (max_length - len(ids))
+
+
+def variant_groups(pairs, clauses):
+    """
+    group of every CCRC document (pairs and clause texts of each): the negatives gen_nega_samples.py
+    makes of a document keep its pairs and either its emotion clause (context negatives) or all its
+    other clauses (emotion negatives), so documents sharing one of the two are one group
+    """
+    parent = list(range(len(pairs)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    first = {}
+    for i, (doc_pairs, doc_clauses) in enumerate(zip(pairs, clauses)):
+        e = doc_pairs[0][0] - 1
+        key = tuple(sorted(doc_pairs))
+        others = tuple(doc_clauses[:e] + doc_clauses[e + 1:])
+        for shared in (('emotion', key, doc_clauses[e]), ('context', key, others)):
+            j = first.setdefault(shared, i)
+            parent[find(i)] = find(j)
+    roots = {}
+    return [roots.setdefault(find(i), len(roots)) for i in range(len(pairs))]
+
+
+def doc_targets(task, doc):
+    """ground truth counters of one document, as collected by MyDataset"""
+    pos, cause = _pos_cause(doc)
+    pairs = doc['pairs']
+    gt = {'gt_emotion': len(set(pos)), 'gt_cause': len(set(cause)), 'gt_pair': len(set(pairs)),
+          'gt_conditional': 0, 'emotion_index': 0}
+    if task == 'CCRC':
+        gt['gt_conditional'] = int(doc['header'][2])
+        gt['emotion_index'] = pos[0] if pos else 0
+    return gt
+
+
+def build_example(task, doc, tokenizer, max_length=512, num_for_M=2, store=None):
+    """one example of MyDataset; with a TokenStore the clauses are not tokenized again"""
+    x_text, y_text, train_text = build_texts(task, doc, num_for_M)
+    if store is None:
+        n_tokens = len(tokenizer(x_text)['input_ids'])
+        encode_text = lambda text: encode(tokenizer, text, max_length)
+    else:
+        n_tokens = len(store.ids(x_text, doc['clauses'])) + 2
+        encode_text = lambda text: store.encode(text, doc['clauses'], max_length)
+    x_bert = np.array(encode_text(x_text), dtype=np.int64)
+    y_bert = np.array(encode_text(y_text), dtype=np.int64)
+    train_mask = np.array(encode_text(train_text), dtype=np.int64)
+    if max_length is None:
+        # the three texts tokenize to the same length, guard against stray whitespace tokens anyway
+        y_bert = np.resize(y_bert, len(x_bert))
+        train_mask = np.resize(train_mask, len(x_bert))
+    example = {
+        'input_ids': x_bert,
+        'y_bert': y_bert,
+        'label': np.where(x_bert == mask_id, y_bert, -100),
+        'mask_label': np.where(train_mask == mask_id, y_bert, -100),
+        'n_tokens': n_tokens,
+    }
+    example.update(doc_targets(task, doc))
+    return example
+
+
+class PromptDataset(Dataset):
+    """MyDataset of any task, built from documents instead of a fold file. max_length=None keeps whole documents"""
+
+    def __init__(self, task, docs, tokenizer, max_length=512, num_for_M=2, verbose=True, store=None):
+        doc_ids, examples = [], []
+        for doc in docs:
+            doc_ids.append(doc['doc_id'])
+            examples.append(build_example(task, doc, tokenizer, max_length, num_for_M, store))
+        self.collect(task, doc_ids, examples, max_length, verbose)
+
+    @classmethod
+    def from_examples(cls, task, doc_ids, examples, max_length=512, verbose=True):
+        """the dataset of examples made by build_example, e.g. kept by corpus_store"""
+        dataset = cls.__new__(cls)
+        dataset.collect(task, list(doc_ids), examples, max_length, verbose)
+        return dataset
+
+    def collect(self, task, doc_ids, examples, max_length, verbose):
+        self.task = task
+        self.doc_id = doc_ids
+        cnt_over_limit = 0
+        if max_length is not None:
+            cnt_over_limit = sum(e['n_tokens'] > max_length for e in examples)
+        if max_length is None:
+            # variable length, input_ids / label / ... stay a list of arrays
+            self.data = {k: [e[k] for e in examples] for k in examples[0]} if examples else {}
+        else:
+            self.data = {k: np.array([e[k] for e in examples]) for k in examples[0]} if examples else {}
+        self.cnt_over_limit = cnt_over_limit
+        if verbose:
+            print('{} documents, num_for_over_limit {}'.format(len(examples), cnt_over_limit))
+
+    def __getitem__(self, index):
+        return {k: v[index] for k, v in self.data.items()}
+
+    def __len__(self):
+        return len(self.doc_id)
+
+
+def mask_scores(logits, input_ids, normalized=False):
+    """
+    gather what the decoder needs at the mask positions of a batch: the full-vocabulary argmax and
+    the probabilities of the verbalizer tokens. returns one (top1, verb, prev) tuple of numpy arrays
+    per document, prev being the token in front of each mask (CCRC reads the cause mark from it).
+    """
+    input_ids = input_ids.to(logits.device)
+    rows = logits[input_ids == mask_id].float()
+    if not normalized:
+        rows = torch.softmax(rows, dim=-1)
+    return row_scores(rows, input_ids)
+
+
+def row_scores(rows, input_ids):
+    """mask_scores of the full-vocabulary probabilities at the mask positions, in row-major order"""
+    sel = input_ids == mask_id
+    top1 = rows.argmax(-1).cpu().numpy()
+    verb = rows[:, verbalizer_ids].cpu().numpy()
+    prev_ids = torch.cat([input_ids[:, :1], input_ids[:, :-1]], 1)
+    prev = prev_ids[sel].cpu().numpy()
+    sizes = sel.sum(1).tolist()
+    out = []
+    start = 0
+    for n in sizes:
+        out.append((top1[start:start + n], verb[start:start + n], prev[start:start + n]))
+        start += n
+    return out
+
+
+def label_tokens(labels, input_ids):
+    """label token at every mask position, one array per document"""
+    sel = input_ids == mask_id
+    values = labels[sel].long().cpu().numpy()
+    out = []
+    start = 0
+    for n in sel.sum(1).tolist():
+        out.append(values[start:start + n])
+        start += n
+    return out
+
+
+def _clause_number(token):
+    try:
+        return label_index.index(int(token)) + 1
+    except ValueError:
+        return 0
+
+
+def pair_candidates(clause, window_size):
+    """verbalizer columns a pair mask of the 0-based clause may pick, as in crf_prompt"""
+    cols = [3 + k for k in range(max(0, clause - window_size), min(max_clause, clause + window_size + 1))]
+    cols.append(verb_none)
+    return np.array(cols)
+
+
+def decode_slots(task, top1, verb, prev=None, window_size=2):
+    """
+    turn mask scores of one document into per-clause predictions.
+    emotion/cause: 1 if the full-vocabulary argmax is 是, pair: the clause number chosen among
+    the window candidates or 0 for 无. missing slots of a truncated last clause are -1.
+    """
+    names = slot_names[task]
+    n_slots = len(names)
+    n_mask = len(top1)
+    n_clause = -(-n_mask // n_slots)
+    n_pair = names.count('pair')
+    slots = {'pair': np.full((n_clause, n_pair), -1, dtype=np.int16)}
+    for name in ('emotion', 'cause'):
+        if name in names:
+            slots[name] = np.full(n_clause, -1, dtype=np.int8)
+    if task == 'CCRC':
+        slots['given_cause'] = np.zeros(n_clause, dtype=bool)
+    for k in range(n_mask):
+        clause, slot = divmod(k, n_slots)
+        name = names[slot]
+        if name == 'pair':
+            cols = pair_candidates(clause, window_size)
+            scores = verb[k, cols]
+            best = cols[int(np.argmax(scores))]
+            number = 0 if best == verb_none or scores.max() <= 0 else best - 2
+            slots['pair'][clause, names[:slot].count('pair')] = number
+            if task == 'CCRC' and prev is not None:
+                slots['given_cause'][clause] = prev[k] == yes_id
+        else:
+            slots[name][clause] = int(top1[k] == yes_id)
+    return slots
+
+
+def decode_labels(task, tokens):
+    """the same structure as decode_slots, read from the label tokens"""
+    names = slot_names[task]
+    n_slots = len(names)
+    n_clause = -(-len(tokens) // n_slots)
+    slots = {'pair': np.full((n_clause, names.count('pair')), -1, dtype=np.int16)}
+    for name in ('emotion', 'cause'):
+        if name in names:
+            slots[name] = np.full(n_clause, -1, dtype=np.int8)
+    for k, token in enumerate(tokens):
+        clause, slot = divmod(k, n_slots)
+        name = names[slot]
+        if name == 'pair':
+            slots['pair'][clause, names[:slot].count('pair')] = _clause_number(token)
+        else:
+            slots[name][clause] = int(token == yes_id)
+    return slots
+
+
+def conditional(slots, emotion_index):
+    """CCRC decision: more than half of the given cause clauses point at the emotion clause"""
+    given = slots['given_cause']
+    count_pridict = int(given.sum())
+    count_positive = int(((slots['pair'][:, 0] == emotion_index) & given).sum())
+    return int(count_positive / (count_pridict + 1e-8) > 0.5)
+
+
+def new_counts():
+    return {k: 0 for k in ['emo_gt', 'emo_pre', 'emo_acc', 'cause_gt', 'cause_pre', 'cause_acc',
+                           'pair_gt', 'pair_pre', 'pair_acc', 'cond_gt', 'cond_pre', 'cond_acc']}
+
+
+def add_counts(counts, task, pred, gold, gt):
+    """accumulate the counters of prf_prompt / crf_prompt for one document"""
+    if task == 'CCRC':
+        counts['cond_gt'] += gt['gt_conditional']
+        if conditional(pred, gt['emotion_index']):
+            counts['cond_pre'] += 1
+            counts['cond_acc'] += int(gt['gt_conditional'] == 1)
+        return counts
+    for name, key in (('emotion', 'emo'), ('cause', 'cause')):
+        if name in pred:
+            yes = pred[name] == 1
+            counts[key + '_pre'] += int(yes.sum())
+            counts[key + '_acc'] += int((yes & (gold[name] == 1)).sum())
+    counts['emo_gt'] += gt['gt_emotion']
+    counts['cause_gt'] += gt['gt_cause']
+    if task == 'ECE':
+        return counts
+    counts['pair_gt'] += gt['gt_pair']
+    if task == 'M2M':
+        for clause in range(len(pred['pair'])):
+            gold_set = set(gold['pair'][clause].tolist())
+            for number in set(pred['pair'][clause].tolist()):
+                if number > 0:
+                    counts['pair_pre'] += 1
+                    counts['pair_acc'] += int(number in gold_set)
+    else:
+        p, g = pred['pair'][:, 0], gold['pair'][:, 0]
+        counts['pair_pre'] += int((p > 0).sum())
+        counts['pair_acc'] += int(((g > 0) & (p == g)).sum())
+    return counts
+
+
+def merge_counts(a, b):
+    return {k: a[k] + b[k] for k in a}
+
+
+def prf(task, counts):
+    """{'emotion': (p, r, f), ...} for the targets of the task"""
+    keys = {'emotion': 'emo', 'cause': 'cause', 'pair': 'pair', 'conditional': 'cond'}
+    out = {}
+    for target in targets[task]:
+        key = keys[target]
+        p = counts[key + '_acc'] / (counts[key + '_pre'] + 1e-8)
+        r = counts[key + '_acc'] / (counts[key + '_gt'] + 1e-8)
+        out[target] = (p, r, 2 * p * r / (p + r + 1e-8))
+    return out
+
+
+def format_prf(task, result):
+    short = {'emotion': 'e', 'cause': 'c', 'pair': 'pair', 'conditional': 'c'}
+    return ' '.join('{0}_p: {1:.4f} {0}_r: {2:.4f} {0}_f: {3:.4f}'.format(short[t], *result[t])
+                    for t in targets[task])
+
+
+def batch_gt(batch, index):
+    return {k: int(batch[k][index]) for k in ('gt_emotion', 'gt_cause', 'gt_pair', 'gt_conditional',
+                                              'emotion_index')}
+
+
+def score_batch(task, counts, logits, batch, window_size=2, normalized=False):
+    """decode one batch of model output and add it to counts"""
+    scores = mask_scores(logits, batch['input_ids'], normalized)
+    gold = label_tokens(batch['label'], batch['input_ids'])
+    for i, (top1, verb, prev) in enumerate(scores):
+        pred = decode_slots(task, top1, verb, prev, window_size)
+        add_counts(counts, task, pred, decode_labels(task, gold[i]), batch_gt(batch, i))
+    return counts
+
+
+def slots_to_result(task, slots, emotion_index=0, offset=0):
+    """structured prediction of one document; clause numbers are 1-based and shifted by offset"""
+    result = {}
+    if 'emotion' in slots:
+        result['emotions'] = [c + 1 + offset for c in np.nonzero(slots['emotion'] == 1)[0].tolist()]
+    if 'cause' in slots:
+        result['causes'] = [c + 1 + offset for c in np.nonzero(slots['cause'] == 1)[0].tolist()]
+    pairs = []
+    for clause, numbers in enumerate(slots['pair'].tolist()):
+        if task == 'CCRC' and not slots['given_cause'][clause]:
+            continue
+        for number in sorted(set(numbers)):
+            if number > 0:
+                pairs.append([number + offset, clause + 1 + offset])
+    result['pairs'] = sorted(pairs)
+    if task == 'CCRC':
+        result['conditional'] = conditional(slots, emotion_index)
+    return result
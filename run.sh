@@ -40,4 +40,17 @@
 #--dataset 'data_combine_ECPE/' \
 #--batch_size 8 \
 #--learning_rate 1e-5\
-#--device '2'
\ No newline at end of file
+#--device '2'
+# effective batch of 32 on a 16 GB CPU node
+#python ECPE.py \
+#--dataset 'data_combine_ECPE/' \
+#--batch_size 8 \
+#--grad_accum_steps 4 \
+#--gradient_checkpointing True \
+#--learning_rate 1e-5
+
+# data-parallel training, two processes on one box
+#OMP_NUM_THREADS=16 torchrun --nproc_per_node 2 ECPE.py \
+#--dataset 'data_combine_ECPE_balance/' \
+#--batch_size 8 \
+#--learning_rate 1e-5
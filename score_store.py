@@ -0,0 +1,185 @@
+"""
+per-fold store of the mask scores of a test pass, and re-scoring without the model.
+
+for every mask position of foldk_test.txt the store keeps the probabilities of the 78 verbalizer
+tokens (是/非/无 and the clause numbers, float16), the full-vocabulary argmax, the token in front of
+the mask and the gold token; per document the mask offsets and the ground truth counters. the
+arrays are .npy files read back with mmap, so re-scoring 10 folds takes seconds.
+
+    # write the store from the fold checkpoints (or run a task script with --test_only True --dump_scores)
+    python score_store.py dump --task ECPE --dataset data_combine_ECPE/ --checkpointpath checkpoint/ECPE/ \
+        --store scores/ECPE
+    # P/R/F for other decoding settings
+    python score_store.py rescore --store scores/ECPE --window_size 1,2,3,75 --none_margin 0,0.1 \
+        --yes_rule argmax,verbalizer
+
+decoding variants: --window_size is the pair window of crf_prompt / prf_prompt (75 = every clause),
+--none_margin is added to the probability of 无 before the pair argmax, --yes_rule argmax is the
+rule of the scripts (full-vocabulary argmax is 是), verbalizer compares p(是) with p(非) only.
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from transformers import BertTokenizer
+import prompt_utils
+
+gt_keys = ('gt_emotion', 'gt_cause', 'gt_pair', 'gt_conditional', 'emotion_index')
+
+
+def fold_dir(store, fold):
+    return os.path.join(store, 'fold{}'.format(fold))
+
+
+class FoldWriter(object):
+    """write the store of one fold batch by batch; the number of masks must be known up front"""
+
+    def __init__(self, store, fold, n_masks, n_docs, meta):
+        self.path = fold_dir(store, fold)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        open_memmap = np.lib.format.open_memmap
+        self.verb = open_memmap(os.path.join(self.path, 'verb.npy'), 'w+', np.float16,
+                                (n_masks, len(prompt_utils.verbalizer_ids)))
+        self.top1 = open_memmap(os.path.join(self.path, 'top1.npy'), 'w+', np.int32, (n_masks,))
+        self.prev = open_memmap(os.path.join(self.path, 'prev.npy'), 'w+', np.int32, (n_masks,))
+        self.gold = open_memmap(os.path.join(self.path, 'gold.npy'), 'w+', np.int32, (n_masks,))
+        self.offsets = np.zeros(n_docs + 1, dtype=np.int64)
+        self.gt = np.zeros((n_docs, len(gt_keys)), dtype=np.int32)
+        self.meta = meta
+        self.n_mask, self.n_doc = 0, 0
+
+    def add(self, logits, input_ids, labels, gt, normalized=False):
+        """one batch: model logits (or probabilities), input ids, labels and a dict of gt tensors"""
+        scores = prompt_utils.mask_scores(logits, input_ids, normalized)
+        golds = prompt_utils.label_tokens(labels, input_ids)
+        for i, ((top1, verb, prev), gold) in enumerate(zip(scores, golds)):
+            n = len(top1)
+            s = slice(self.n_mask, self.n_mask + n)
+            self.verb[s], self.top1[s], self.prev[s], self.gold[s] = verb, top1, prev, gold
+            self.gt[self.n_doc] = [int(gt[k][i]) if k in gt else 0 for k in gt_keys]
+            self.n_mask += n
+            self.n_doc += 1
+            self.offsets[self.n_doc] = self.n_mask
+
+    def close(self):
+        for array in (self.verb, self.top1, self.prev, self.gold):
+            array.flush()
+        np.save(os.path.join(self.path, 'offsets.npy'), self.offsets[:self.n_doc + 1])
+        np.save(os.path.join(self.path, 'gt.npy'), self.gt[:self.n_doc])
+        self.meta.update(n_docs=self.n_doc, n_masks=self.n_mask)
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+
+
+def write_fold(store, fold, task, logits, input_ids, labels, gt, normalized=True, **meta):
+    """store a whole test pass at once, as collected by the --test_only branch of the task scripts"""
+    n_masks = int((input_ids == prompt_utils.mask_id).sum())
+    meta.update(task=task, fold=fold)
+    writer = FoldWriter(store, fold, n_masks, len(input_ids), meta)
+    writer.add(logits, input_ids.long(), labels.long(), gt, normalized)
+    writer.close()
+
+
+def load_fold(store, fold):
+    path = fold_dir(store, fold)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+              for name in ('verb', 'top1', 'prev', 'gold', 'offsets', 'gt')}
+    return meta, arrays
+
+
+def store_folds(store):
+    return sorted(int(name[4:]) for name in os.listdir(store)
+                  if name.startswith('fold') and os.path.exists(os.path.join(store, name, 'meta.json')))
+
+
+def score_fold(task, arrays, window_size=2, none_margin=0., yes_rule='argmax'):
+    """prompt_utils counters of one stored fold under a decoding variant"""
+    counts = prompt_utils.new_counts()
+    verb_all = np.asarray(arrays['verb'], dtype=np.float32)
+    top1_all = np.asarray(arrays['top1'])
+    if yes_rule == 'verbalizer':
+        top1_all = np.where(verb_all[:, 0] > verb_all[:, 1], prompt_utils.yes_id, prompt_utils.no_id)
+    if none_margin:
+        verb_all = verb_all.copy()
+        verb_all[:, prompt_utils.verb_none] += none_margin
+    offsets, gt = arrays['offsets'], arrays['gt']
+    for d in range(len(gt)):
+        s = slice(offsets[d], offsets[d + 1])
+        pred = prompt_utils.decode_slots(task, top1_all[s], verb_all[s], arrays['prev'][s], window_size)
+        gold = prompt_utils.decode_labels(task, arrays['gold'][s])
+        prompt_utils.add_counts(counts, task, pred, gold, dict(zip(gt_keys, gt[d].tolist())))
+    return counts
+
+
+def dump(opt):
+    tokenizer = BertTokenizer.from_pretrained(opt.bert_path)
+    for fold in [int(f) for f in opt.folds.split(',') if f]:
+        test_file = opt.dataset + 'fold{}_test.txt'.format(fold)
+        checkpoint = os.path.join(opt.checkpointpath, 'fold{}.pth'.format(fold))
+        dataset = prompt_utils.PromptDataset(opt.task, prompt_utils.read_docs(test_file), tokenizer,
+                                             num_for_M=opt.num_for_M)
+        model = prompt_utils.load_checkpoint(checkpoint).eval()
+        n_masks = int((dataset.data['input_ids'] == prompt_utils.mask_id).sum())
+        writer = FoldWriter(opt.store, fold, n_masks, len(dataset),
+                            {'task': opt.task, 'fold': fold, 'checkpoint': checkpoint, 'test_file': test_file})
+        start = time.time()
+        with torch.no_grad():
+            for batch in DataLoader(dataset, batch_size=opt.batch_size, shuffle=False):
+                _, logits = model(batch['input_ids'], None)
+                writer.add(logits, batch['input_ids'], batch['label'], batch)
+        writer.close()
+        print('fold {}: {} documents, {} masks stored in {:.1f}s'.format(fold, writer.n_doc, writer.n_mask,
+                                                                        time.time() - start))
+
+
+def rescore(opt):
+    folds = store_folds(opt.store)
+    stored = [load_fold(opt.store, fold) for fold in folds]
+    task = stored[0][0]['task']
+    variants = itertools.product([int(w) for w in opt.window_size.split(',')],
+                                 [float(m) for m in opt.none_margin.split(',')], opt.yes_rule.split(','))
+    report = []
+    for window_size, none_margin, yes_rule in variants:
+        start = time.time()
+        per_fold = [prompt_utils.prf(task, score_fold(task, arrays, window_size, none_margin, yes_rule))
+                    for _, arrays in stored]
+        average = {t: tuple(float(np.mean([r[t][k] for r in per_fold])) for k in range(3))
+                   for t in prompt_utils.targets[task]}
+        print('window {:2d} none_margin {:.2f} yes {:10s} {} ({:.1f}s, {} folds)'.format(
+            window_size, none_margin, yes_rule, prompt_utils.format_prf(task, average), time.time() - start,
+            len(folds)))
+        report.append({'window_size': window_size, 'none_margin': none_margin, 'yes_rule': yes_rule,
+                       'average': average, 'folds': dict(zip(folds, per_fold))})
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump({'task': task, 'store': opt.store, 'variants': report}, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='store mask scores per fold and re-score them')
+    parser.add_argument('mode', choices=['dump', 'rescore'])
+    parser.add_argument('--store', type=str, default='scores/ECPE', help='directory of the fold stores')
+    parser.add_argument('--task', type=str, default='ECPE', choices=prompt_utils.tasks)
+    parser.add_argument('--dataset', type=str, default='data_combine_ECPE/', help='path for dataset')
+    parser.add_argument('--checkpointpath', type=str, default='checkpoint/ECPE/', help='fold checkpoints')
+    parser.add_argument('--bert_path', type=str, default='./bert-base-chinese', help='tokenizer')
+    parser.add_argument('--folds', type=str, default='1,2,3,4,5,6,7,8,9,10', help='comma separated folds')
+    parser.add_argument('--batch_size', type=int, default=8, help='number of example per batch')
+    parser.add_argument('--num_for_M', type=int, default=2, help='for M2M module')
+    parser.add_argument('--window_size', type=str, default='2', help='comma separated pair windows')
+    parser.add_argument('--none_margin', type=str, default='0', help='comma separated margins added to p(无)')
+    parser.add_argument('--yes_rule', type=str, default='argmax', help='argmax and/or verbalizer')
+    parser.add_argument('--output', type=str, default='', help='json file for the rescoring report')
+    opt = parser.parse_args()
+    dump(opt) if opt.mode == 'dump' else rescore(opt)
+
+
+if __name__ == '__main__':
+    main()
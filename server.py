@@ -0,0 +1,199 @@
+"""
+local inference service for one task / fold checkpoint.
+
+the checkpoint is loaded once. requests are queued and gathered into micro-batches of at most
+--batch_size prompts: a batch runs as soon as it is full or --max_latency_ms after its first
+prompt arrived. over-length documents are split with chunking.py and stitched back.
+
+    python server.py --task ECPE --checkpoint checkpoint/ECPE/fold1.pth --port 8500
+    python server.py --task ECPE --checkpoint checkpoint/ECPE/fold1.pth --unix_socket /tmp/ecpe.sock
+
+    curl -s localhost:8500/predict -d '{"documents": [{"clauses": ["当 我 看到 建议 被 采纳", "...", "激动 地 说"]}]}'
+    curl -s --unix-socket /tmp/ecpe.sock http://localhost/predict -d '...'
+
+a document is {"clauses": [...]}; ECE also needs "emotions" (1-based emotion clauses) and CCRC
+"pairs" ([[emotion, cause], ...], the candidate causes of one emotion). the answer holds, per
+document, "emotions", "causes", "pairs" as [emotion, cause] and for CCRC "conditional".
+GET /health returns the task, the checkpoint, the batching counters and the cache counters
+(--cache_size, --cache_path, see pred_cache.py).
+"""
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+import prompt_utils
+from pred_cache import PredictionCache
+from predictor import Predictor
+
+
+class MicroBatcher(object):
+    """
+    single worker thread that owns the model. submit() returns a Future for the decoded slots of one
+    prompt; prompts queued within max_latency of each other run together through run(input_ids).
+    """
+
+    def __init__(self, run, batch_size=8, max_latency=0.01):
+        self.run = run
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.stats = {'batches': 0, 'prompts': 0, 'busy_seconds': 0.}
+        self.worker = threading.Thread(target=self.loop, daemon=True)
+        self.worker.start()
+
+    def submit(self, input_ids):
+        future = Future()
+        self.queue.put((input_ids, future))
+        return future
+
+    def collect(self):
+        items = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_latency
+        while len(items) < self.batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                items.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return items
+
+    def loop(self):
+        while True:
+            items = self.collect()
+            start = time.perf_counter()
+            try:
+                slots = self.run([ids for ids, _ in items])
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            for (_, future), s in zip(items, slots):
+                future.set_result(s)
+            self.stats['batches'] += 1
+            self.stats['prompts'] += len(items)
+            self.stats['busy_seconds'] += time.perf_counter() - start
+
+
+class InferenceService(object):
+    def __init__(self, task, checkpoint, bert_path='./bert-base-chinese', batch_size=8, max_latency_ms=10,
+                 **kwargs):
+        self.task = task
+        self.checkpoint = checkpoint
+        self.predictor = Predictor.from_checkpoint(task, checkpoint, bert_path, **kwargs)
+        self.batcher = MicroBatcher(self.predictor.run_slots, batch_size, max_latency_ms / 1000.)
+
+    def predict(self, documents):
+        docs = [self.predictor.to_doc(d, i) for i, d in enumerate(documents)]
+        input_ids, plans = self.predictor.prompts(docs)
+        slots = self.predictor.cached_slots(input_ids, lambda ids: [f.result() for f in
+                                                                    [self.batcher.submit(i) for i in ids]])
+        return self.predictor.results(docs, plans, slots)
+
+    def health(self):
+        stats = dict(self.batcher.stats)
+        stats['mean_batch'] = stats['prompts'] / max(stats['batches'], 1)
+        health = {'task': self.task, 'checkpoint': self.checkpoint, 'stats': stats}
+        if self.predictor.cache is not None:
+            health['cache'] = self.predictor.cache.stats()
+        return health
+
+
+class Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def reply(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.reply(200, self.service.health())
+        else:
+            self.reply(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.reply(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            documents = body['documents'] if isinstance(body, dict) and 'documents' in body else [body]
+            start = time.perf_counter()
+            results = self.service.predict(documents)
+        except (ValueError, KeyError, TypeError) as e:
+            self.reply(400, {'error': '{}: {}'.format(type(e).__name__, e)})
+            return
+        except Exception as e:
+            # a failure of the model or the batcher, not of the request
+            self.log_error('predict failed: %r', e)
+            self.reply(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+            return
+        self.reply(200, {'results': results, 'ms': (time.perf_counter() - start) * 1000})
+
+    def address_string(self):
+        # unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'unix'
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super(UnixHTTPServer, self).get_request()
+        return request, ('unix', 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='micro-batching inference server')
+    parser.add_argument('--task', type=str, default='ECPE', choices=prompt_utils.tasks)
+    parser.add_argument('--checkpoint', type=str, default='checkpoint/ECPE/fold1.pth', help='fold checkpoint')
+    parser.add_argument('--bert_path', type=str, default='./bert-base-chinese', help='tokenizer')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8500)
+    parser.add_argument('--unix_socket', type=str, default='', help='listen on this socket path instead of tcp')
+    parser.add_argument('--batch_size', type=int, default=8, help='prompts per micro-batch')
+    parser.add_argument('--max_latency_ms', type=float, default=10, help='longest wait for a batch to fill')
+    parser.add_argument('--window_size', type=int, default=2, help='size of the emotion cause pair window')
+    parser.add_argument('--overlap', type=int, default=4, help='clauses shared by chunk windows')
+    parser.add_argument('--num_for_M', type=int, default=2, help='for M2M module')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+    parser.add_argument('--cache_size', type=int, default=0, help='prompts kept in the prediction cache, 0 disables')
+    parser.add_argument('--cache_path', type=str, default='', help='sqlite file backing the prediction cache')
+    opt = parser.parse_args()
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    cache = PredictionCache(opt.cache_size, opt.cache_path or None) if opt.cache_size > 0 else None
+    Handler.service = InferenceService(opt.task, opt.checkpoint, opt.bert_path, opt.batch_size, opt.max_latency_ms,
+                                       window_size=opt.window_size, overlap=opt.overlap, num_for_M=opt.num_for_M,
+                                       cache=cache)
+    if opt.unix_socket:
+        if os.path.exists(opt.unix_socket):
+            os.remove(opt.unix_socket)
+        server = UnixHTTPServer(opt.unix_socket, Handler)
+        print('serving {} on unix socket {}'.format(opt.task, opt.unix_socket))
+    else:
+        server = ThreadingHTTPServer((opt.host, opt.port), Handler)
+        print('serving {} on http://{}:{}'.format(opt.task, opt.host, opt.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
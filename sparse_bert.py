@@ -0,0 +1,259 @@
+"""
+clause-window sparse attention for prompts longer than 512 tokens.
+
+every token of clause i attends to the tokens of clauses i - window_size .. i + window_size and to
+the global [CLS], which itself attends to the whole document. cost and memory grow linearly with the
+number of clauses instead of quadratically, so documents are encoded whole instead of being cut at
+512 tokens. the weights are those of bert-base-chinese (or of a fine-tuned fold checkpoint), the
+position embeddings are tiled to --max_positions.
+
+    # fine-tune from bert-base-chinese and evaluate on the untruncated test folds
+    python sparse_bert.py --task ECPE --dataset data_combine_ECPE/ --window_size 2 --save_path prompt_ECPE_long
+    # evaluate fine-tuned prompt_bert checkpoints with the sparse attention
+    python sparse_bert.py --task ECPE --dataset data_combine_ECPE/ --init_checkpoint checkpoint/ECPE/ --test_only True
+
+with window_size >= the number of clauses the encoder computes exactly the full attention of BERT.
+"""
+import argparse
+import math
+import os
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from transformers import BertConfig, BertTokenizer, BertForMaskedLM
+import prompt_utils
+from prompt_utils import sep_id
+
+
+def clause_bounds(input_ids):
+    """
+    token ranges [start, end) of the clauses of one prompt, the [SEP] closing a clause belongs to it.
+    token 0 is the global [CLS] and is left out, a trailing [SEP] added by the tokenizer joins the last clause.
+    """
+    seps = (input_ids == sep_id).nonzero().flatten().tolist()
+    bounds = []
+    start = 1
+    for sep in seps:
+        if sep + 1 > start:
+            bounds.append((start, sep + 1))
+            start = sep + 1
+    if start < len(input_ids):
+        bounds.append((start, len(input_ids)))
+    if len(bounds) > 1 and bounds[-1][1] - bounds[-1][0] == 1 and int(input_ids[bounds[-1][0]]) == sep_id:
+        bounds[-2] = (bounds[-2][0], bounds[-1][1])
+        bounds.pop()
+    return bounds
+
+
+def tile_position_embeddings(bert, max_positions):
+    """repeat the learnt 512 positions up to max_positions, as Longformer does when it extends RoBERTa"""
+    embeddings = bert.bert.embeddings
+    old = embeddings.position_embeddings.weight.data
+    if max_positions <= old.shape[0]:
+        return
+    new = old.new_empty(max_positions, old.shape[1])
+    for k in range(0, max_positions, old.shape[0]):
+        n = min(old.shape[0], max_positions - k)
+        new[k:k + n] = old[:n]
+    embeddings.position_embeddings = torch.nn.Embedding.from_pretrained(new, freeze=False)
+    embeddings.register_buffer('position_ids', torch.arange(max_positions).unsqueeze(0), persistent=False)
+    if hasattr(embeddings, 'token_type_ids'):
+        embeddings.register_buffer('token_type_ids', torch.zeros(1, max_positions, dtype=torch.long),
+                                   persistent=False)
+    bert.config.max_position_embeddings = max_positions
+
+
+class ClauseWindowBert(torch.nn.Module):
+    """BertForMaskedLM whose self attention is restricted to a window of clauses"""
+
+    def __init__(self, bert, window_size=2, max_positions=4096):
+        super(ClauseWindowBert, self).__init__()
+        self.bert = bert
+        self.window_size = window_size
+        tile_position_embeddings(bert, max_positions)
+
+    @classmethod
+    def from_pretrained(cls, bert_path, window_size=2, max_positions=4096):
+        return cls(BertForMaskedLM.from_pretrained(bert_path), window_size, max_positions)
+
+    @classmethod
+    def from_checkpoint(cls, path, window_size=2, max_positions=4096, bert_path=None):
+        """
+        start from a fold checkpoint: one written by save(), a bare BERT state_dict (on the
+        architecture of bert_path) or the pickled model of a task script
+        """
+        checkpoint = prompt_utils.load_checkpoint(path)
+        if not isinstance(checkpoint, dict):
+            return cls(checkpoint.bert, window_size, max_positions)
+        if 'state_dict' in checkpoint:
+            bert = BertForMaskedLM(BertConfig.from_dict(checkpoint['config']))
+            state_dict = checkpoint['state_dict']
+        else:
+            if bert_path is None:
+                raise ValueError('{} is a bare state_dict, give the bert_path of its architecture'.format(path))
+            bert, state_dict = BertForMaskedLM.from_pretrained(bert_path), checkpoint
+            tile_position_embeddings(bert, state_dict['bert.embeddings.position_embeddings.weight'].shape[0])
+        bert.load_state_dict(state_dict)
+        return cls(bert, window_size, max_positions)
+
+    def save(self, path):
+        """the BERT weights with their config (tiled positions included), read by from_checkpoint"""
+        torch.save({'config': self.bert.config.to_dict(), 'window_size': self.window_size,
+                    'state_dict': self.bert.state_dict()}, path)
+
+    def attention(self, self_attn, hidden, bounds):
+        """clause-window attention of one document, hidden is [seq, hidden_size]"""
+        n_heads = self_attn.num_attention_heads
+        head_size = self_attn.attention_head_size
+        seq = hidden.shape[0]
+        q = self_attn.query(hidden).view(seq, n_heads, head_size).transpose(0, 1)
+        k = self_attn.key(hidden).view(seq, n_heads, head_size).transpose(0, 1)
+        v = self_attn.value(hidden).view(seq, n_heads, head_size).transpose(0, 1)
+        scale = 1.0 / math.sqrt(head_size)
+        dropout = self_attn.dropout
+        context = []
+        # global [CLS] over the whole document
+        probs = dropout(F.softmax(torch.matmul(q[:, :1], k.transpose(1, 2)) * scale, dim=-1))
+        context.append(torch.matmul(probs, v))
+        for i, (start, end) in enumerate(bounds):
+            key_start = bounds[max(0, i - self.window_size)][0]
+            key_end = bounds[min(len(bounds) - 1, i + self.window_size)][1]
+            keys = torch.cat([k[:, :1], k[:, key_start:key_end]], 1)
+            values = torch.cat([v[:, :1], v[:, key_start:key_end]], 1)
+            probs = dropout(F.softmax(torch.matmul(q[:, start:end], keys.transpose(1, 2)) * scale, dim=-1))
+            context.append(torch.matmul(probs, values))
+        return torch.cat(context, 1).transpose(0, 1).reshape(seq, n_heads * head_size)
+
+    def encode(self, input_ids):
+        """[seq] token ids of one document -> [seq, vocab] logits"""
+        bounds = clause_bounds(input_ids)
+        hidden = self.bert.bert.embeddings(input_ids=input_ids.unsqueeze(0))[0]
+        for layer in self.bert.bert.encoder.layer:
+            context = self.attention(layer.attention.self, hidden, bounds)
+            attention_output = layer.attention.output(context, hidden)
+            hidden = layer.output(layer.intermediate(attention_output), attention_output)
+        return self.bert.cls(hidden)
+
+    def forward(self, docs, labels=None):
+        """
+        docs is a list of 1-d token id tensors of any length. returns (loss, list of logits); the loss
+        is the token mean over the whole batch, like BertForMaskedLM on a padded batch
+        """
+        logits = [self.encode(ids) for ids in docs]
+        loss = None
+        if labels is not None:
+            loss = F.cross_entropy(torch.cat(logits), torch.cat([l.long() for l in labels]), ignore_index=-100)
+        return loss, logits
+
+
+def collate(batch):
+    """keep the variable-length arrays as lists of tensors, stack the scalar targets"""
+    out = {}
+    for key in batch[0]:
+        values = [torch.as_tensor(b[key]) for b in batch]
+        out[key] = torch.stack(values) if values[0].dim() == 0 else values
+    return out
+
+
+def load_fold(opt, tokenizer, fold, split):
+    path = opt.dataset + 'fold{}_{}.txt'.format(fold, split)
+    return prompt_utils.PromptDataset(opt.task, prompt_utils.read_docs(path), tokenizer, max_length=None,
+                                      num_for_M=opt.num_for_M)
+
+
+def evaluate(opt, model, loader):
+    counts = prompt_utils.new_counts()
+    model.eval()
+    with torch.no_grad():
+        for batch in loader:
+            _, logits = model(batch['input_ids'])
+            for i, (ids, doc_logits) in enumerate(zip(batch['input_ids'], logits)):
+                (top1, verb, prev), = prompt_utils.mask_scores(doc_logits.unsqueeze(0), ids.unsqueeze(0))
+                gold, = prompt_utils.label_tokens(batch['label'][i].unsqueeze(0), ids.unsqueeze(0))
+                pred = prompt_utils.decode_slots(opt.task, top1, verb, prev, opt.window_size)
+                prompt_utils.add_counts(counts, opt.task, pred, prompt_utils.decode_labels(opt.task, gold),
+                                        prompt_utils.batch_gt(batch, i))
+    return prompt_utils.prf(opt.task, counts)
+
+
+def build_model(opt, fold):
+    if opt.init_checkpoint:
+        path = os.path.join(opt.init_checkpoint, 'fold{}.pth'.format(fold))
+        return ClauseWindowBert.from_checkpoint(path, opt.attention_window, opt.max_positions, opt.bert_path)
+    return ClauseWindowBert.from_pretrained(opt.bert_path, opt.attention_window, opt.max_positions)
+
+
+def run(opt):
+    tokenizer = BertTokenizer.from_pretrained(opt.bert_path)
+    target = prompt_utils.main_target[opt.task]
+    best = []
+    for fold in [int(f) for f in opt.folds.split(',') if f]:
+        print('############# fold {} begin ###############'.format(fold))
+        model = build_model(opt, fold)
+        test_loader = DataLoader(load_fold(opt, tokenizer, fold, 'test'), batch_size=opt.batch_size,
+                                 shuffle=False, collate_fn=collate)
+        if opt.test_only:
+            result = evaluate(opt, model, test_loader)
+            print(prompt_utils.format_prf(opt.task, result))
+            best.append(result)
+            continue
+        train_loader = DataLoader(load_fold(opt, tokenizer, fold, 'train'), batch_size=opt.batch_size,
+                                  shuffle=True, collate_fn=collate)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=opt.learning_rate, weight_decay=opt.weight_decay)
+        fold_best = None
+        for i in range(opt.training_iter):
+            model.train()
+            start_time = time.time()
+            for index, batch in enumerate(train_loader):
+                loss, _ = model(batch['input_ids'], batch['mask_label'])
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                if index % 20 == 0:
+                    print('iter: {} step: {} loss: {:.4f}'.format(i, index, loss.item()))
+            result = evaluate(opt, model, test_loader)
+            print('iter: {} time: {:.1f}s {}'.format(i, time.time() - start_time,
+                                                     prompt_utils.format_prf(opt.task, result)))
+            if fold_best is None or result[target][2] > fold_best[target][2]:
+                fold_best = result
+                if opt.save_path:
+                    if not os.path.exists(opt.save_path):
+                        os.makedirs(opt.save_path)
+                    model.save(os.path.join(opt.save_path, 'fold{}.pth'.format(fold)))
+        print('max result---- ' + prompt_utils.format_prf(opt.task, fold_best))
+        best.append(fold_best)
+    for t in prompt_utils.targets[opt.task]:
+        p, r, f = (np.mean([b[t][k] for b in best]) for k in range(3))
+        print('average {}: p {:.4f} r {:.4f} f {:.4f}'.format(t, p, r, f))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='prompt tuning with clause-window sparse attention')
+    parser.add_argument('--task', type=str, default='ECPE', choices=prompt_utils.tasks)
+    parser.add_argument('--dataset', type=str, default='data_combine_ECPE/', help='path for dataset')
+    parser.add_argument('--bert_path', type=str, default='./bert-base-chinese', help='pretrained bert')
+    parser.add_argument('--init_checkpoint', type=str, default='',
+                        help='start from the fold checkpoints of the task scripts instead of bert_path')
+    parser.add_argument('--folds', type=str, default='1,2,3,4,5,6,7,8,9,10', help='comma separated folds')
+    parser.add_argument('--window_size', type=int, default=2, help='size of the emotion cause pair window')
+    parser.add_argument('--attention_window', type=int, default=-1,
+                        help='clauses on each side a clause attends to, -1 uses window_size')
+    parser.add_argument('--max_positions', type=int, default=4096, help='longest prompt in tokens')
+    parser.add_argument('--num_for_M', type=int, default=2, help='for M2M module')
+    parser.add_argument('--training_iter', type=int, default=20, help='number of train iterator')
+    parser.add_argument('--batch_size', type=int, default=8, help='number of example per batch')
+    parser.add_argument('--learning_rate', type=float, default=0.00001, help='learning rate')
+    parser.add_argument('--weight_decay', type=float, default=0.01, help='weight decay for bert')
+    parser.add_argument('--test_only', type=bool, default=False, help='no training')
+    parser.add_argument('--save_path', type=str, default='',
+                        help='save the best model per fold, --init_checkpoint reads it')
+    opt = parser.parse_args()
+    if opt.attention_window < 0:
+        opt.attention_window = opt.window_size
+    run(opt)
+
+
+if __name__ == '__main__':
+    main()
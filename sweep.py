@@ -0,0 +1,266 @@
+"""
+hyperparameter sweep over learning_rate, batch_size, window_size and num_for_M.
+
+the fold datasets are built once (multitask.SharedData) and saved as .npy arrays under --prep_dir;
+the trials read them with mmap. (trial, fold) jobs run on a pool of --workers processes with
+--threads torch threads and an optional address space limit of --memory_gb each. a fold of a
+trial stops early when its main F1 is below the median of the other trials at the same fold and
+epoch (after --grace epochs), or has not improved for --patience epochs.
+
+    python sweep.py --task ECPE --space '{"learning_rate": [1e-5, 2e-5], "batch_size": [8, 16], "window_size": [1, 2]}'
+    python sweep.py --task M2M --search random --n_trials 8 \
+        --space '{"learning_rate": {"low": 5e-6, "high": 5e-5, "log": true}, "num_for_M": [2, 3]}'
+
+--space is JSON or a JSON file: a list of values per parameter, or {"low", "high", "log"} for
+random search. the results table (one row per trial, sorted by mean F1, with the time spent) is
+printed and written to --output as CSV.
+"""
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import time
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from transformers import BertTokenizer
+import corpus_bin
+import corpus_store
+import multitask
+import prompt_utils
+
+params = ('learning_rate', 'batch_size', 'window_size', 'num_for_M')
+_worker = {}
+
+
+def read_space(text):
+    if os.path.exists(text):
+        with open(text) as f:
+            return json.load(f)
+    return json.loads(text)
+
+
+def sample(spec, rng):
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    if spec.get('log'):
+        return math.exp(rng.uniform(math.log(spec['low']), math.log(spec['high'])))
+    return rng.uniform(spec['low'], spec['high'])
+
+
+def make_trials(space, defaults, search='grid', n_trials=10, seed=0):
+    """list of parameter dicts; grid needs a list of values for every parameter"""
+    unknown = set(space) - set(params)
+    if unknown:
+        raise ValueError('unknown parameters {}, expected some of {}'.format(sorted(unknown), params))
+    names = sorted(space)
+    if search == 'grid':
+        combos = itertools.product(*[space[n] for n in names])
+    else:
+        rng = random.Random(seed)
+        combos = ([sample(space[n], rng) for n in names] for _ in range(n_trials))
+    trials = []
+    for combo in combos:
+        trial = dict(defaults)
+        trial.update(zip(names, combo))
+        for name in ('batch_size', 'window_size', 'num_for_M'):
+            trial[name] = int(trial[name])
+        trials.append(trial)
+    return trials
+
+
+def prep_path(prep_dir, task, num_for_M, fold, split):
+    # only M2M prompts depend on num_for_M
+    variant = 'M{}'.format(num_for_M) if task == 'M2M' else 'M'
+    return os.path.join(prep_dir, task, variant, 'fold{}_{}'.format(fold, split))
+
+
+def file_hash(path):
+    """sha1 of the file a fold path reads (the text file, or its binary corpus)"""
+    h = hashlib.sha1()
+    with open(corpus_bin.resolve(path), 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def prepare(opt, trials, folds):
+    """
+    build every dataset the trials need once, as one .npy file per field. a prepared dataset is
+    rebuilt when its source (dataset path or corpus store), tokenizer or max_length changed, and
+    when its content changed: the fold file (sha1) or the view of the corpus store, from the
+    examples kept in the store
+    """
+    shared = multitask.SharedData(BertTokenizer.from_pretrained(opt.bert_path))
+    store = corpus_store.CorpusStore(opt.corpus_store) if opt.corpus_store else None
+    tokenizer = corpus_store.tokenizer_hash(shared.tokenizer)
+    count = 0
+    for num_for_M in sorted(set(t['num_for_M'] for t in trials)):
+        for fold, split in itertools.product(folds, ('train', 'test')):
+            path = prep_path(opt.prep_dir, opt.task, num_for_M, fold, split)
+            done = os.path.join(path, 'done')
+            source = opt.dataset + 'fold{}_{}.txt'.format(fold, split)
+            version = json.dumps({
+                'source': os.path.abspath(opt.corpus_store or source), 'tokenizer': tokenizer,
+                'max_length': shared.max_length,
+                'view': store.fingerprint('fold{}_{}'.format(fold, split)) if store else file_hash(source)},
+                sort_keys=True)
+            if os.path.exists(done):
+                with open(done) as f:
+                    if f.read() == version:
+                        continue
+            shared.num_for_M = num_for_M
+            dataset = shared.dataset(opt.task, source, opt.corpus_store)
+            os.makedirs(path, exist_ok=True)
+            for key, value in dataset.data.items():
+                np.save(os.path.join(path, key + '.npy'), value)
+            with open(done, 'w') as f:
+                f.write(version)
+            count += 1
+    return count
+
+
+class PreparedDataset(Dataset):
+    """PromptDataset saved by prepare(), read with mmap"""
+
+    def __init__(self, path):
+        self.data = {name[:-4]: np.load(os.path.join(path, name), mmap_mode='r')
+                     for name in os.listdir(path) if name.endswith('.npy')}
+
+    def __getitem__(self, index):
+        return {k: np.array(v[index]) for k, v in self.data.items()}
+
+    def __len__(self):
+        return len(self.data['input_ids'])
+
+
+def init_worker(opt, board, lock):
+    torch.set_num_threads(opt.threads)
+    if opt.memory_gb > 0:
+        import resource
+        limit = int(opt.memory_gb * (1 << 30))
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    _worker.update(opt=opt, board=board, lock=lock)
+
+
+def should_stop(board, lock, trial_id, fold, epoch, f1, history, grace, patience):
+    """median rule against the other trials, plus patience within this fold"""
+    key = '{}/{}'.format(fold, epoch)
+    with lock:
+        others = [f for t, f in board.get(key, []) if t != trial_id]
+        board[key] = board.get(key, []) + [(trial_id, f1)]
+    if epoch + 1 >= grace and others and f1 < float(np.median(others)):
+        return True
+    if patience and len(history) > patience and max(history[-patience:]) <= max(history[:-patience]):
+        return True
+    return False
+
+
+def run_job(job):
+    trial_id, trial, fold = job
+    opt, board, lock = _worker['opt'], _worker['board'], _worker['lock']
+    torch.manual_seed(opt.seed + fold)
+    start = time.time()
+    target = prompt_utils.main_target[opt.task]
+    train_set = PreparedDataset(prep_path(opt.prep_dir, opt.task, trial['num_for_M'], fold, 'train'))
+    test_set = PreparedDataset(prep_path(opt.prep_dir, opt.task, trial['num_for_M'], fold, 'test'))
+    device = 'cuda' if opt.usegpu and torch.cuda.is_available() else 'cpu'
+    model = prompt_utils.prompt_bert(opt.bert_path).to(device)
+    f1s, stopped = [], [False]
+
+    def on_epoch(epoch, result):
+        f1s.append(result[target][2])
+        if should_stop(board, lock, trial_id, fold, epoch, f1s[-1], f1s, opt.grace, opt.patience):
+            stopped[0] = epoch + 1 < opt.training_iter
+            return False
+
+    best, _ = multitask.train_fold(opt.task, model, train_set, test_set, opt.training_iter, trial['batch_size'],
+                                   trial['learning_rate'], opt.weight_decay, trial['window_size'], device=device,
+                                   on_epoch=on_epoch)
+    return {'trial': trial_id, 'fold': fold, 'best': best, 'epochs': len(f1s), 'stopped': stopped[0],
+            'seconds': time.time() - start}
+
+
+def table(opt, trials, jobs_done):
+    target = prompt_utils.main_target[opt.task]
+    rows = []
+    for trial_id, trial in enumerate(trials):
+        done = [j for j in jobs_done if j['trial'] == trial_id]
+        f1 = [j['best'][target][2] for j in done]
+        row = dict(trial=trial_id, **trial)
+        row.update(mean_f1=float(np.mean(f1)) if f1 else float('nan'), folds=len(done),
+                   stopped=sum(j['stopped'] for j in done), epochs=sum(j['epochs'] for j in done),
+                   seconds=sum(j['seconds'] for j in done))
+        rows.append(row)
+    return sorted(rows, key=lambda r: -r['mean_f1'] if r['folds'] else float('inf'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='hyperparameter sweep')
+    parser.add_argument('--task', type=str, default='ECPE', choices=prompt_utils.tasks)
+    parser.add_argument('--dataset', type=str, default='data_combine_ECPE/', help='path for dataset')
+    parser.add_argument('--corpus_store', type=str, default='', help='corpus_store.py store instead of the fold files')
+    parser.add_argument('--bert_path', type=str, default='./bert-base-chinese', help='bert and tokenizer')
+    parser.add_argument('--space', type=str, required=True, help='JSON search space or a JSON file')
+    parser.add_argument('--search', type=str, default='grid', choices=['grid', 'random'])
+    parser.add_argument('--n_trials', type=int, default=10, help='trials of random search')
+    parser.add_argument('--folds', type=str, default='1,2,3,4,5,6,7,8,9,10', help='comma separated folds')
+    parser.add_argument('--training_iter', type=int, default=20, help='epochs per fold')
+    parser.add_argument('--learning_rate', type=float, default=0.00001, help='default outside the space')
+    parser.add_argument('--batch_size', type=int, default=8, help='default outside the space')
+    parser.add_argument('--window_size', type=int, default=2, help='default outside the space')
+    parser.add_argument('--num_for_M', type=int, default=2, help='default outside the space')
+    parser.add_argument('--weight_decay', type=float, default=0.01, help='weight decay for bert')
+    parser.add_argument('--grace', type=int, default=3, help='epochs before the median rule applies')
+    parser.add_argument('--patience', type=int, default=0, help='epochs without improvement, 0 disables')
+    parser.add_argument('--workers', type=int, default=2, help='parallel (trial, fold) jobs')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads per worker')
+    parser.add_argument('--memory_gb', type=float, default=0, help='address space limit per worker, 0 disables')
+    parser.add_argument('--prep_dir', type=str, default='sweep_prep', help='prepared datasets, reused across runs')
+    parser.add_argument('--output', type=str, default='sweep_results.csv', help='results table')
+    parser.add_argument('--seed', type=int, default=0, help='random search and model seeds')
+    parser.add_argument('--usegpu', type=bool, default=False, help='gpu')
+    opt = parser.parse_args()
+
+    defaults = {p: getattr(opt, p) for p in params}
+    trials = make_trials(read_space(opt.space), defaults, opt.search, opt.n_trials, opt.seed)
+    folds = [int(f) for f in opt.folds.split(',') if f]
+    start = time.time()
+    print('{} trials x {} folds, {} datasets prepared in {:.1f}s'.format(
+        len(trials), len(folds), prepare(opt, trials, folds), time.time() - start))
+
+    # interleave folds so that the median rule has results to compare against early
+    jobs = [(t, trials[t], fold) for fold in folds for t in range(len(trials))]
+    manager = multiprocessing.Manager()
+    board, lock = manager.dict(), manager.Lock()
+    pool = multiprocessing.get_context('spawn').Pool(opt.workers, initializer=init_worker,
+                                                     initargs=(opt, board, lock), maxtasksperchild=1)
+    done = []
+    try:
+        for result in pool.imap_unordered(run_job, jobs):
+            done.append(result)
+            print('trial {} fold {}: f1 {:.4f} after {} epochs{} ({:.0f}s)'.format(
+                result['trial'], result['fold'], result['best'][prompt_utils.main_target[opt.task]][2],
+                result['epochs'], ', stopped' if result['stopped'] else '', result['seconds']))
+    finally:
+        pool.terminate()
+    rows = table(opt, trials, done)
+    columns = ['trial'] + list(params) + ['mean_f1', 'folds', 'stopped', 'epochs', 'seconds']
+    print(' '.join('{:>13s}'.format(c) for c in columns))
+    for row in rows:
+        print(' '.join('{:>13.6g}'.format(row[c]) if isinstance(row[c], float) else '{:>13}'.format(row[c])
+                       for c in columns))
+    with open(opt.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    print('{} jobs in {:.1f}s, table written to {}'.format(len(done), time.time() - start, opt.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""
+synthetic corpus in the fold file format of data_combine_*, for scale and load tests.
+
+every document is a pure function of (--seed, its index and the settings), so a corpus is the same
+on every run. with --style ecpe or balance the first documents of a 10x corpus are those of a 1x
+corpus; the ccrc negatives borrow clauses from any document of the corpus, so they depend on its
+size. documents are written as they are made, ten folds as divide_fold.py lays them out (fold k
+tests on the k-th tenth and trains on the rest), so memory does not grow with --scale.
+
+    python synth_corpus.py --style ecpe --scale 10 --output_dir synth_ECPE/
+    python synth_corpus.py --style ccrc --scale 100 --variants 2 --output_dir synth_CCRC/
+    python synth_corpus.py --style balance --n_docs 5000 --max_clauses 75 --pair_density 1.5 \
+        --source data_combine_CCRC/original_ecpe.txt --output_dir synth_balance/
+
+styles:
+    ecpe     "id n" headers, " (e,c), (e,c)" pairs and emotion category + keyword columns
+             (data_combine_ECPE, data_combine_ECE)
+    balance  "(e, c)" pairs and the keyword in both emotion columns, emotion keywords drawn in
+             turn so they are equally frequent (data_combine_*_balance)
+    ccrc     "id n label conditional" headers, "(e, c)" pairs and one emotion per document; like
+             gen_nega_samples.py every document is followed by --variants copies with the context
+             clauses of an other document (label 1 - conditional) and --variants with its emotion
+             clause (label 0)
+
+clause counts are uniform in --min_clauses..--max_clauses (at most 75, the clause numbers of
+label_index), words per clause uniform in --min_words..--max_words. --pair_density is the mean
+number of pairs per document (at least one). words are drawn from the clauses of --source when
+given, by frequency, otherwise made of CJK characters.
+"""
+import argparse
+import collections
+import itertools
+import json
+import os
+import random
+import time
+import prompt_utils
+
+clause_limit = 75
+base_docs = 1945
+# emotion categories of the corpus with a few keywords each
+keywords = collections.OrderedDict([
+    ('happiness', ['激动', '高兴', '开心', '欣慰', '感动', '满意']),
+    ('sadness', ['伤心', '难过', '痛苦', '悲痛', '心疼', '忧虑']),
+    ('fear', ['担心', '害怕', '恐惧', '紧张', '不安', '担忧']),
+    ('disgust', ['郁闷', '不满', '厌恶', '反感', '讨厌', '烦恼']),
+    ('anger', ['愤怒', '生气', '气愤', '恼火', '愤慨', '发火']),
+    ('surprise', ['惊讶', '吃惊', '意外', '震惊', '惊奇', '惊喜']),
+])
+# cause offset from the emotion clause and its weight, most causes precede or are the emotion clause
+cause_offsets = [(0, 30), (-1, 35), (-2, 12), (1, 8), (-3, 6), (2, 4), (-4, 3), (-5, 2)]
+
+
+def source_words(path):
+    """words of the clauses of an ECPE format file, with their counts"""
+    counts = collections.Counter()
+    for doc in prompt_utils.read_docs(path):
+        for clause in doc['clauses']:
+            counts.update(clause.split())
+    return list(counts), list(counts.values())
+
+
+def cjk_words(n=20000, seed=0):
+    rng = random.Random(seed)
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 3000)]
+    return [''.join(rng.choice(chars) for _ in range(rng.choice((1, 2, 2, 2, 3, 4)))) for _ in range(n)], None
+
+
+class Generator(object):
+    def __init__(self, style='ecpe', seed=0, min_clauses=5, max_clauses=20, min_words=3, max_words=12,
+                 pair_density=1.2, variants=2, words=None, weights=None):
+        if not 1 <= min_clauses <= max_clauses <= clause_limit:
+            raise ValueError('clause counts must be within 1..{}'.format(clause_limit))
+        if pair_density < 1:
+            raise ValueError('pair_density is the mean number of pairs per document, at least 1')
+        self.style = style
+        self.seed = seed
+        self.min_clauses, self.max_clauses = min_clauses, max_clauses
+        self.min_words, self.max_words = min_words, max_words
+        self.pair_density = pair_density
+        self.variants = variants
+        self.words, self.weights = words or cjk_words(seed=seed)[0], weights
+        if self.weights is not None:
+            self.cum_weights = list(itertools.accumulate(self.weights))
+        self.categories = list(keywords)
+        self.all_keywords = [(c, k) for c in keywords for k in keywords[c]]
+
+    def rng(self, index):
+        return random.Random('{}/{}'.format(self.seed, index))
+
+    def clause(self, rng, keyword=None):
+        n = rng.randint(self.min_words, self.max_words)
+        if self.weights is None:
+            words = [rng.choice(self.words) for _ in range(n)]
+        else:
+            words = rng.choices(self.words, cum_weights=self.cum_weights, k=n)
+        if keyword is not None:
+            words.insert(rng.randint(0, len(words)), keyword)
+        return ' '.join(words)
+
+    def n_pairs(self, rng):
+        # one pair plus a geometric number of extra pairs with mean pair_density - 1
+        extra, p = 0, (self.pair_density - 1) / self.pair_density
+        while rng.random() < p:
+            extra += 1
+        return 1 + extra
+
+    def emotion(self, rng, index):
+        if self.style == 'balance':
+            return self.all_keywords[index % len(self.all_keywords)]
+        category = rng.choice(self.categories)
+        return category, rng.choice(keywords[category])
+
+    def base(self, index):
+        """clauses, pairs and emotion (category, keyword) per emotion clause of document index"""
+        rng = self.rng(index)
+        d_len = rng.randint(self.min_clauses, self.max_clauses)
+        offsets, weights = zip(*cause_offsets)
+        pairs, emotions = set(), {}
+        n_pairs = min(self.n_pairs(rng), d_len)
+        single = self.style == 'ccrc'
+        for _ in range(20 * n_pairs):
+            if len(pairs) == n_pairs:
+                break
+            if emotions and (single or rng.random() < 0.5):
+                e = rng.choice(sorted(emotions))
+            else:
+                e = rng.randint(1, d_len)
+            c = e + rng.choices(offsets, weights)[0]
+            if not 1 <= c <= d_len:
+                c = rng.randint(max(1, e - 2), e)
+            pairs.add((e, c))
+            emotions.setdefault(e, self.emotion(rng, index))
+        clauses = [self.clause(rng, emotions[i][1] if i in emotions else None) for i in range(1, d_len + 1)]
+        return clauses, sorted(pairs), emotions, rng
+
+    def lines(self, clauses, emotions):
+        out = []
+        for i, text in enumerate(clauses, 1):
+            if i in emotions:
+                category, keyword = emotions[i]
+                out.append('{},{},{},{}'.format(i, keyword if self.style == 'balance' else category, keyword, text))
+            else:
+                out.append('{},null,null,{}'.format(i, text))
+        return out
+
+    def format(self, doc_id, header, pairs, lines):
+        if self.style in ('balance', 'ccrc'):
+            pair_line = ', '.join('({}, {})'.format(e, c) for e, c in pairs)
+        else:
+            pair_line = ' ' + ', '.join('({},{})'.format(e, c) for e, c in pairs)
+        return '\n'.join([' '.join([str(doc_id), str(len(lines))] + header), pair_line] + lines) + '\n'
+
+    def group(self, index, n_base):
+        """the documents made from base document index: one, or 1 + 2 * variants for ccrc"""
+        clauses, pairs, emotions, rng = self.base(index)
+        if self.style != 'ccrc':
+            return [([], pairs, self.lines(clauses, emotions))]
+        conditional = rng.randint(0, 1)
+        emotion = pairs[0][0]
+        kept = {e for e, _ in pairs} | {c for _, c in pairs}
+        docs = [(['1', str(conditional)], pairs, self.lines(clauses, emotions))]
+        for kind in ('context', 'emotion'):
+            for _ in range(self.variants):
+                other = rng.randrange(n_base - 1) if n_base > 1 else index
+                other += other >= index and n_base > 1
+                other_clauses, other_pairs, other_emotions, _ = self.base(other)
+                if kind == 'context':
+                    # the emotion and cause clauses stay, the other clauses come from the other document
+                    context = [c for i, c in enumerate(other_clauses, 1) if i not in other_emotions]
+                    new = [clauses[i - 1] if i in kept or not context else context[(i - 1) % len(context)]
+                           for i in range(1, len(clauses) + 1)]
+                    docs.append((['{}'.format(1 - conditional), str(conditional)], pairs,
+                                 self.lines(new, emotions)))
+                else:
+                    other_e = other_pairs[0][0]
+                    new = list(clauses)
+                    new[emotion - 1] = other_clauses[other_e - 1]
+                    docs.append((['0', str(conditional)], pairs,
+                                 self.lines(new, {emotion: other_emotions[other_e]})))
+        return docs
+
+
+def write_corpus(generator, n_base, output_dir, folds=10, log=print):
+    """
+    write the documents of n_base base documents to fold{k}_train.txt / fold{k}_test.txt (or
+    data.txt with folds=0) under output_dir, documents numbered from 1. returns the statistics.
+    """
+    if folds and n_base < folds:
+        raise ValueError('{} documents cannot fill {} folds, give more documents or fewer folds'.format(
+            n_base, folds))
+    os.makedirs(output_dir, exist_ok=True)
+    if folds:
+        fold_size = n_base // folds
+        tests = [open(os.path.join(output_dir, 'fold{}_test.txt'.format(k)), 'w', encoding='utf-8')
+                 for k in range(1, folds + 1)]
+        trains = [open(os.path.join(output_dir, 'fold{}_train.txt'.format(k)), 'w', encoding='utf-8')
+                  for k in range(1, folds + 1)]
+        files = tests + trains
+    else:
+        files = [open(os.path.join(output_dir, 'data.txt'), 'w', encoding='utf-8')]
+    stats = collections.Counter()
+    start, doc_id = time.time(), 0
+    try:
+        for index in range(n_base):
+            fold = min(index // fold_size, folds - 1) if folds else -1
+            for header, pairs, lines in generator.group(index, n_base):
+                doc_id += 1
+                text = generator.format(doc_id, header, pairs, lines)
+                if folds:
+                    tests[fold].write(text)
+                    for k in range(folds):
+                        if k != fold:
+                            trains[k].write(text)
+                else:
+                    files[0].write(text)
+                stats['docs'] += 1
+                stats['clauses'] += len(lines)
+                stats['pairs'] += len(pairs)
+            if log and (index + 1) % 100000 == 0:
+                log('{} / {} documents, {:.0f}s'.format(index + 1, n_base, time.time() - start))
+    finally:
+        for f in files:
+            f.close()
+    stats = dict(stats, base_docs=n_base, folds=folds, seconds=time.time() - start)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='synthetic corpus in the ECPE fold format')
+    parser.add_argument('--style', type=str, default='ecpe', choices=['ecpe', 'balance', 'ccrc'])
+    parser.add_argument('--output_dir', type=str, default='synth_ECPE/', help='fold files are written here')
+    parser.add_argument('--scale', type=float, default=1, help='documents as a multiple of the 1945 of the corpus')
+    parser.add_argument('--n_docs', type=int, default=0, help='number of (base) documents, overrides --scale')
+    parser.add_argument('--min_clauses', type=int, default=5, help='clauses per document, from')
+    parser.add_argument('--max_clauses', type=int, default=20, help='clauses per document, to (at most 75)')
+    parser.add_argument('--min_words', type=int, default=3, help='words per clause, from')
+    parser.add_argument('--max_words', type=int, default=12, help='words per clause, to')
+    parser.add_argument('--pair_density', type=float, default=1.2, help='mean emotion cause pairs per document')
+    parser.add_argument('--variants', type=int, default=2, help='ccrc: negative documents of each kind per document')
+    parser.add_argument('--source', type=str, default='', help='ECPE format file to draw the words from')
+    parser.add_argument('--folds', type=int, default=10, help='number of folds, 0 writes one data.txt')
+    parser.add_argument('--seed', type=int, default=0, help='the corpus is determined by the seed and the settings')
+    opt = parser.parse_args()
+
+    words, weights = source_words(opt.source) if opt.source else cjk_words(seed=opt.seed)
+    generator = Generator(opt.style, opt.seed, opt.min_clauses, opt.max_clauses, opt.min_words, opt.max_words,
+                          opt.pair_density, opt.variants, words, weights)
+    n_base = opt.n_docs or int(round(base_docs * opt.scale))
+    stats = write_corpus(generator, n_base, opt.output_dir, opt.folds)
+    settings = {k: v for k, v in vars(opt).items()}
+    with open(os.path.join(opt.output_dir, 'synth.json'), 'w') as f:
+        json.dump({'settings': settings, 'stats': stats}, f, indent=2)
+    print('{docs} documents, {clauses} clauses, {pairs} pairs written to {dir} in {seconds:.1f}s'.format(
+        dir=opt.output_dir, **stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import numpy as np
+import pytest
+from transformers import BertTokenizer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
+import prompt_utils
+from corpus_store import CorpusStore
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    tokenizer = BertTokenizer.from_pretrained(bench.tiny_bert(str(tmp_path), ''))
+    docs = bench.synthetic_docs(tokenizer, 6)
+    ids = [doc['doc_id'] for doc in docs]
+    store = CorpusStore(str(tmp_path / 'store.sqlite'))
+    store.put(docs)
+    store.set_view('fold1_test', ids[:3])
+    store.set_view('fold1_train', ids[3:])
+    store.set_view('fold2_test', ids[3:])
+    store.set_view('fold2_train', ids[:3])
+    yield store, tokenizer, docs, ids
+    store.close()
+
+
+def test_put_rebuilds_only_the_changed_document(corpus):
+    store, tokenizer, docs, ids = corpus
+    store.examples('ECPE', ids, tokenizer)
+    assert store.counters['built'] == 6
+    store.counters.clear()
+    store.examples('ECPE', ids, tokenizer)
+    assert store.counters['built'] == 0 and store.counters['hits'] == 6
+
+    clauses = list(docs[2]['clauses'])
+    clauses[0] = docs[3]['clauses'][0]
+    changed = prompt_utils.raw_doc(clauses, docs[2]['pairs'], doc_id=ids[2])
+    assert store.put([changed] + docs[:2])['changed'] == 1
+    store.counters.clear()
+    examples = store.examples('ECPE', ids, tokenizer)
+    assert store.counters['built'] == 1 and store.counters['hits'] == 5
+    expected = prompt_utils.build_example('ECPE', changed, tokenizer)
+    assert np.array_equal(examples[2]['input_ids'], expected['input_ids'])
+
+
+def test_assign_and_remove_edit_the_views_in_place(corpus):
+    store, tokenizer, docs, ids = corpus
+    store.assign([ids[0]], 2)
+    assert store.view('fold1_test') == ids[1:3]
+    assert store.view('fold1_train') == ids[3:] + [ids[0]]
+    assert store.view('fold2_test') == ids[3:] + [ids[0]]
+    assert store.view('fold2_train') == ids[1:3]
+    with pytest.raises(ValueError):
+        store.assign([ids[0]], 3)
+
+    store.remove([ids[4]])
+    assert store.view('fold1_train') == [ids[3], ids[5], ids[0]]
+    assert store.view('fold2_test') == [ids[3], ids[5], ids[0]]
+    assert store.view('fold1_test') == ids[1:3]
+    with pytest.raises(KeyError):
+        store.doc(ids[4])
@@ -0,0 +1,36 @@
+import os
+import sys
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
+from sparse_bert import ClauseWindowBert
+
+ids = torch.tensor([101, 2769, 3221, 102, 872, 1962, 8024, 102, 103, 102])
+
+
+def same_weights(a, b):
+    a, b = a.bert.state_dict(), b.bert.state_dict()
+    return a.keys() == b.keys() and all(torch.equal(a[k], b[k]) for k in a)
+
+
+def test_save_then_from_checkpoint(tmp_path):
+    bert_path = bench.tiny_bert(str(tmp_path), '')
+    model = ClauseWindowBert.from_pretrained(bert_path, window_size=1, max_positions=1024).eval()
+    path = str(tmp_path / 'fold1.pth')
+    model.save(path)
+    loaded = ClauseWindowBert.from_checkpoint(path, window_size=1, max_positions=1024).eval()
+    assert same_weights(model, loaded)
+    with torch.no_grad():
+        assert torch.allclose(model.encode(ids), loaded.encode(ids))
+
+
+def test_bare_state_dict_checkpoint(tmp_path):
+    bert_path = bench.tiny_bert(str(tmp_path), '')
+    model = ClauseWindowBert.from_pretrained(bert_path, window_size=1, max_positions=1024).eval()
+    path = str(tmp_path / 'fold1.pth')
+    torch.save(model.bert.state_dict(), path)
+    loaded = ClauseWindowBert.from_checkpoint(path, window_size=1, max_positions=1024, bert_path=bert_path).eval()
+    assert same_weights(model, loaded)
+    with torch.no_grad():
+        assert torch.allclose(model.encode(ids), loaded.encode(ids))